@@ -0,0 +1,265 @@
+"""Micro-benchmarks for pattern matching.
+
+Run with: python bench_pat.py"""
+
+import json
+import timeit
+from functools import partial
+
+from pat import Var, Rest, Pattern, PatternSet, freeze
+from rete import Rete
+
+
+def report(name, stmt, number):
+    seconds = min(timeit.repeat(stmt, number=number, repeat=5))
+    print(f'{name:40s} {seconds / number * 1e9:8.0f} ns/call')
+
+
+def bench_compiled(number=100_000):
+    """Interpreted Pattern.match versus CompiledPattern.match on a typical
+    trigger pattern, for an event that matches and one that does not."""
+    y = Var(str)
+    a = Var(int)
+    pat = Pattern({'name': 'transfer', 'arg1': y, 'arg2': a})
+    compiled = pat.compile()
+    hit = {'name': 'transfer', 'arg1': 'acc1', 'arg2': 42}
+    miss = {'name': 'reconcile', 'arg1': 'acc1', 'arg2': 42}
+    for name, val in [('hit', hit), ('miss', miss)]:
+        report(f'Pattern.match ({name})', lambda: pat.match(val), number)
+        report(f'CompiledPattern.match ({name})',
+               lambda: compiled.match(val), number)
+
+
+def bench_mostly_failing(number=2_000):
+    """Route events through a list of trigger patterns, as a state machine
+    does: most patterns do not match most events, and the mismatch is often
+    found only a few levels deep."""
+    patterns = []
+    for i in range(50):
+        n = Var(int)
+        patterns.append(Pattern({'command': 'SetTicks', 'id': i,
+                                 'args': [n, n]}))
+    compiled = [p.compile() for p in patterns]
+    events = [{'command': 'SetTicks', 'id': i % 60, 'args': [i, i]}
+              for i in range(20)]
+
+    def route(matchers):
+        for e in events:
+            for m in matchers:
+                m(e)
+
+    report('mostly failing, Pattern.match',
+           lambda: route([p.match for p in patterns]), number)
+    report('mostly failing, CompiledPattern.match',
+           lambda: route([c.match for c in compiled]), number)
+
+
+def bench_pattern_set(number=10_000):
+    """Find the matching trigger among many, by a linear scan of compiled
+    patterns and by a PatternSet lookup."""
+    for n_patterns in (10, 100, 1000):
+        patterns = [Pattern({'command': f'cmd{i}', 'arg': Var(int)})
+                    for i in range(n_patterns)]
+        compiled = [p.compile().match for p in patterns]
+        pattern_set = PatternSet(patterns)
+        event = {'command': f'cmd{n_patterns // 2}', 'arg': 1}
+
+        def scan():
+            return [m(event) for m in compiled]
+
+        report(f'linear scan, {n_patterns} patterns', scan, number // 10)
+        report(f'PatternSet.match_all, {n_patterns} patterns',
+               lambda: pattern_set.match_all(event), number)
+
+
+def bench_match_many(number=10):
+    """Scan a stream of log records with a loop of Pattern.match calls and
+    with Pattern.match_many."""
+    level = Var(str)
+    pat = Pattern({'level': level, 'source': 'router', 'code': 500})
+    records = [{'level': 'error', 'source': ('router', 'db')[i % 2],
+                'code': (200, 500)[i % 3 == 0]}
+               for i in range(10_000)]
+
+    def loop():
+        return [(i, b) for i, r in enumerate(records)
+                if (b := pat.match(r)) is not None]
+
+    report('10k records, Pattern.match loop', loop, number)
+    report('10k records, Pattern.match_many',
+           lambda: list(pat.match_many(records)), number)
+
+
+def bench_template(number=10_000):
+    """Substitute into a large, mostly constant response pattern."""
+    task = Var(int)
+    pat = Pattern({'notification': 'Ready', 'arg': task,
+                   'header': {'version': 2, 'source': 'TaskControl',
+                              'tags': [f'tag{i}' for i in range(20)]},
+                   'payload': [{'slot': i, 'state': 'idle'}
+                               for i in range(20)]})
+    template = pat.template()
+    shared = pat.template(share_ground=True)
+    bindings = {task: 7}
+    report('Pattern.subst', lambda: pat.subst(bindings), number)
+    report('SubstTemplate.subst', lambda: template.subst(bindings), number)
+    report('SubstTemplate.subst, shared ground',
+           lambda: shared.subst(bindings), number)
+
+
+def bench_condition(number=100_000):
+    """Evaluate a guard like (t.y == x) & (m.state.total < 100) by walking
+    the expression, by its compiled function, and by hand-written Python."""
+    y = Var(str)
+    total = Var(int)
+    guard = (y == 'acc1') & ~(total > 99)
+    compiled = guard.compile()
+    bindings = {y: 'acc1', total: 42}
+
+    def by_hand(b):
+        return b[y] == 'acc1' and not b[total] > 99
+
+    report('Expr.evaluate', lambda: guard.evaluate(bindings), number)
+    report('compiled Expr', lambda: compiled(bindings), number)
+    report('hand-written', lambda: by_hand(bindings), number)
+
+
+def bench_match_cache(number=100_000):
+    """Match a repeated event by the compiled pattern and through a
+    MatchCache, as a frozen value and as a plain dict, which the cache of
+    Pattern.cached passes on to the compiled pattern."""
+    n = Var(int)
+    pat = Pattern({'command': 'Heartbeat', 'source': 'router',
+                   'args': {'seq': n, 'flags': [1, 2, 3]}})
+    event = {'command': 'Heartbeat', 'source': 'router',
+             'args': {'seq': 7, 'flags': [1, 2, 3]}}
+    compiled = pat.compile()
+    cache = pat.cached()
+    frozen = freeze(event)
+    report('CompiledPattern.match, frozen event',
+           lambda: compiled.match(frozen), number)
+    report('MatchCache.match, repeated frozen event',
+           lambda: cache.match(frozen), number)
+    report('CompiledPattern.match, repeated event',
+           lambda: compiled.match(event), number)
+    report('MatchCache.match, repeated event',
+           lambda: cache.match(event), number)
+
+
+def bench_json(number=10):
+    """Match a feed of JSON messages of which 1% match: json.loads and a
+    compiled pattern, versus a JSONMatcher on the bytes."""
+    n = Var(int)
+    pat = Pattern({'command': 'SetTicks', 'id': 7, 'args': [n, n]})
+    messages = []
+    for i in range(10_000):
+        command = 'SetTicks' if i % 100 == 0 else ('Status', 'Tick')[i % 2]
+        messages.append(json.dumps({
+            'command': command, 'id': 7, 'args': [i, i],
+            'payload': {'samples': list(range(20)), 'host': f'node{i % 9}'},
+        }).encode())
+    match = pat.compile().match
+    matcher = pat.json_matcher()
+
+    def decode_all():
+        return [match(json.loads(m)) for m in messages]
+
+    def scan_all():
+        return [matcher.match(m) for m in messages]
+
+    assert decode_all() == scan_all()
+    report('10k messages, json.loads + compiled match', decode_all, number)
+    report('10k messages, JSONMatcher', scan_all, number)
+    matcher = pat.json_matcher(prefilter=False)
+    report('10k messages, JSONMatcher without prefilter', scan_all, number)
+
+
+def bench_skewed(number=200):
+    """Match skewed traffic, where most events pass the first constant of
+    the pattern but fail a later, deeper one, with the static order and the
+    adaptive order of CompiledPattern."""
+    user = Var(str)
+    session = Var(int)
+    pat = Pattern({'user': user, 'session': session, 'name': 'transfer',
+                   'meta': {'tier': 'gold', 'region': 'eu'}})
+    events = [{'user': f'u{i}', 'session': i, 'name': 'transfer',
+               'meta': {'tier': 'gold',
+                        'region': 'eu' if i % 50 == 0 else 'us'}}
+              for i in range(1000)]
+    static = pat.compile().match
+    adaptive = pat.compile(adaptive=True, period=500).match
+    for e in events:
+        adaptive(e)  # let it adapt
+
+    def route(match):
+        for e in events:
+            match(e)
+
+    report('skewed, Pattern.match', lambda: route(pat.match), number // 10)
+    report('skewed, static order', lambda: route(static), number)
+    report('skewed, adaptive order', lambda: route(adaptive), number)
+
+
+def bench_rest(number=2_000):
+    """Match a SetTicks command with 10,000 arguments against patterns with
+    a Rest, which binds a view of the arguments, and against one that binds
+    the whole list to a Var and slices it."""
+    last = Var(int)
+    untyped = Pattern({'command': 'SetTicks', 'args': [0, Rest(), last]})
+    typed = Pattern({'command': 'SetTicks', 'args': [0, Rest(int), last]})
+    args = Var(list)
+    whole = Pattern({'command': 'SetTicks', 'args': args}).compile().match
+    event = {'command': 'SetTicks', 'args': list(range(10_000))}
+
+    def match_and_slice():
+        m = whole(event)
+        return m[args][1:-1], m[args][-1]
+
+    report('Rest(), interpreted', lambda: untyped.match(event), number)
+    report('Rest(), compiled', partial(untyped.compile().match, event),
+           number)
+    report('Rest(int), compiled', partial(typed.compile().match, event),
+           number // 10)
+    report('Var(list) and slice', match_and_slice, number)
+
+
+def bench_rete(number=10_000):
+    """Assert and retract a transfer event in a Rete whose working memory
+    holds n account facts, joined with the transfer on the account id; and
+    for comparison, find the partners of the event by matching the account
+    pattern against all facts."""
+    acc = Var(str)
+    transfer = {'name': 'transfer', 'arg1': acc, 'arg2': Var(int)}
+    account = {'account': acc, 'balance': Var(int)}
+    for n in (10_000, 100_000):
+        rete = Rete()
+        rete.add_rule([transfer, account])
+        facts = [{'account': f'acc{i}', 'balance': i} for i in range(n)]
+        for fact in facts:
+            rete.assert_fact(fact)
+        event = {'name': 'transfer', 'arg1': 'acc7', 'arg2': 5}
+        report(f'Rete assert and retract, {n} facts',
+               lambda: rete.retract_fact(rete.assert_fact(event)), number)
+        match_transfer = Pattern(transfer).compile().match
+        match_account = Pattern(account).compile().match
+
+        def rematch():
+            bindings = match_transfer(event)
+            return [fact for fact in facts
+                    if (m := match_account(fact)) is not None
+                    and m[acc] == bindings[acc]]
+        report(f'match against all, {n} facts', rematch, 10)
+
+
+if __name__ == '__main__':
+    bench_compiled()
+    bench_mostly_failing()
+    bench_pattern_set()
+    bench_match_many()
+    bench_template()
+    bench_condition()
+    bench_match_cache()
+    bench_json()
+    bench_skewed()
+    bench_rest()
+    bench_rete()
@@ -0,0 +1,382 @@
+"""A Rete network: rules whose Patterns match several facts of a working
+memory, agreeing on shared Vars, are matched incrementally as facts are
+asserted and retracted.
+
+Example: with
+    acc, amount, balance = Var(str), Var(int), Var(int)
+    rete = Rete()
+    rule = rete.add_rule([{'name': 'transfer', 'arg1': acc, 'arg2': amount},
+                          {'account': acc, 'balance': balance}])
+rule.matches holds a match for each pair of a transfer event and an
+account fact with the same account id."""
+
+import random
+import unittest
+
+from pat import Var, Pattern, PatternSet, FrozenPattern, ListView, canonical
+
+
+class AlphaNode:
+    """The facts that match a pattern shape, with the values of its slots.
+    Patterns that differ only in their Vars share an AlphaNode."""
+    __slots__ = ('shape', 'memory', 'joins')
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.memory = {}  # fact id -> tuple of slot values
+        self.joins = []  # JoinNodes that read this memory, deepest first
+
+
+class BetaMemory:
+    """The partial matches of the first patterns of a rule: tokens, i.e.
+    tuples of the ids of the facts that the patterns matched, with their
+    bindings. The tokens are indexed by the values of the Vars that the next
+    JoinNode joins on, and by the facts in them, for retraction."""
+    __slots__ = ('rule', 'join', 'tokens', 'index', 'by_fact')
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.join = None  # next JoinNode, or None for the last memory
+        self.tokens = {}  # token -> bindings
+        self.index = {}  # join key -> {token: bindings}
+        self.by_fact = {}  # fact id -> set of tokens
+
+    def add(self, token, bindings):
+        join = self.join
+        if join is None and not self.rule.accepts(bindings):
+            return
+        self.tokens[token] = bindings
+        for fact_id in token:
+            tokens = self.by_fact.get(fact_id)
+            if tokens is None:
+                tokens = self.by_fact[fact_id] = set()
+            tokens.add(token)
+        if join is None:
+            self.rule.matched(token, bindings)
+            return
+        key = tuple([join_key(bindings[var]) for var in join.join_vars])
+        entries = self.index.get(key)
+        if entries is None:
+            entries = self.index[key] = {}
+        entries[token] = bindings
+        join.left_activate(token, bindings, key)
+
+    def remove(self, fact_id):
+        """Remove the tokens that contain fact fact_id."""
+        tokens = self.by_fact.pop(fact_id, None)
+        if not tokens:
+            return
+        join = self.join
+        for token in tokens:
+            bindings = self.tokens.pop(token)
+            for other in token:
+                if other != fact_id:
+                    self.by_fact[other].discard(token)
+            if join is None:
+                self.rule.unmatched(token, bindings)
+                continue
+            key = tuple([join_key(bindings[var]) for var in join.join_vars])
+            entries = self.index[key]
+            del entries[token]
+            if not entries:
+                del self.index[key]
+
+
+class JoinNode:
+    """Extends the tokens of its left BetaMemory with the facts of its
+    AlphaNode whose values agree on the Vars bound by earlier patterns, and
+    puts the results in its output BetaMemory. The facts are indexed by the
+    values of these Vars, so each activation visits only partners that
+    agree."""
+    __slots__ = ('level', 'alpha', 'left', 'output', 'join_slots',
+                 'join_vars', 'new_slots', 'new_vars', 'index')
+
+    def __init__(self, level, alpha, pattern, bound, left, output):
+        self.level = level
+        self.alpha = alpha
+        self.left = left
+        self.output = output
+        self.join_slots = [i for i, var in enumerate(pattern.vars)
+                           if var in bound]
+        self.join_vars = [pattern.vars[i] for i in self.join_slots]
+        self.new_slots = [i for i, var in enumerate(pattern.vars)
+                          if var not in bound]
+        self.new_vars = [pattern.vars[i] for i in self.new_slots]
+        self.index = {}  # join key -> {fact id: slot values}
+
+    def key(self, values):
+        return tuple([join_key(values[i]) for i in self.join_slots])
+
+    def left_activate(self, token, bindings, key):
+        for fact_id, values in self.index.get(key, {}).items():
+            self.output.add(token + (fact_id,), self.extend(bindings, values))
+
+    def right_activate(self, fact_id, values):
+        key = self.key(values)
+        facts = self.index.get(key)
+        if facts is None:
+            facts = self.index[key] = {}
+        facts[fact_id] = values
+        for token, bindings in list(self.left.index.get(key, {}).items()):
+            self.output.add(token + (fact_id,), self.extend(bindings, values))
+
+    def right_remove(self, fact_id, values):
+        key = self.key(values)
+        facts = self.index[key]
+        del facts[fact_id]
+        if not facts:
+            del self.index[key]
+
+    def extend(self, bindings, values):
+        bindings = dict(bindings)
+        for var, i in zip(self.new_vars, self.new_slots):
+            bindings[var] = values[i]
+        return bindings
+
+
+def join_key(value):
+    """Return the hashable form of a value that is joined on: values join
+    if their canonical forms are equal, see canonical."""
+    if isinstance(value, ListView):
+        value = value.tolist()
+    return canonical(value)
+
+
+class Rule:
+    """A conjunction of patterns, each to be matched by a fact, with the
+    same value for each Var wherever it occurs, and an optional condition
+    (an Expr) on the bindings. Create Rules with Rete.add_rule.
+
+    Attribute matches maps each match, a tuple of the ids of the facts that
+    the patterns matched, to its bindings. on_match and on_unmatch, if
+    given, are called with the tuple and the bindings when a match appears
+    and when it disappears because one of its facts was retracted."""
+
+    def __init__(self, patterns, condition=None, on_match=None,
+                 on_unmatch=None):
+        self.patterns = patterns
+        self.condition = None if condition is None else condition.compile()
+        self.on_match = on_match
+        self.on_unmatch = on_unmatch
+        self.memories = [BetaMemory(self) for _ in range(len(patterns) + 1)]
+        self.matches = self.memories[-1].tokens
+
+    def __repr__(self):
+        return f'Rule({[str(p) for p in self.patterns]})'
+
+    def accepts(self, bindings):
+        return self.condition is None or self.condition(bindings)
+
+    def matched(self, token, bindings):
+        if self.on_match is not None:
+            self.on_match(token, bindings)
+
+    def unmatched(self, token, bindings):
+        if self.on_unmatch is not None:
+            self.on_unmatch(token, bindings)
+
+
+class Rete:
+    """A working memory of facts and the Rules that are matched against it.
+
+    A fact is first matched against the patterns of all rules at once: the
+    distinct pattern shapes are kept in a PatternSet, whose discrimination
+    tree selects the AlphaNodes whose constants agree with the fact. Each
+    rule is a chain of JoinNodes, one per pattern, that join on the Vars
+    the pattern shares with earlier ones through hash indexes. Asserting or
+    retracting a fact only visits the partial matches that it takes part
+    in, so its cost does not depend on the size of the working memory.
+
+    Facts are identified by the ids that assert_fact returns, so equal
+    facts may be asserted more than once; they must not be changed while
+    they are in the working memory. A fact may match several patterns of
+    a rule, also in the same match."""
+
+    def __init__(self):
+        self.facts = {}  # fact id -> fact
+        self.fact_alphas = {}  # fact id -> AlphaNodes that hold it
+        self.next_id = 0
+        self.alphas = []  # in the order of self.pattern_set
+        self.alpha_by_shape = {}  # PatternShape -> AlphaNode
+        self.pattern_set = PatternSet()
+        self.rules = []
+
+    def __len__(self):
+        return len(self.facts)
+
+    def add_rule(self, patterns, condition=None, on_match=None,
+                 on_unmatch=None):
+        """Add a Rule (see there) and match it against the facts in the
+        working memory. patterns are Patterns or pattern values."""
+        patterns = [FrozenPattern(p.val if isinstance(p, Pattern) else p)
+                    for p in patterns]
+        if not patterns:
+            raise ValueError('a rule needs at least one pattern')
+        rule = Rule(patterns, condition, on_match, on_unmatch)
+        bound = set()
+        for level, pattern in enumerate(patterns):
+            alpha = self.alpha(pattern.shape)
+            left = rule.memories[level]
+            join = JoinNode(level, alpha, pattern, bound, left,
+                            rule.memories[level + 1])
+            left.join = join
+            alpha.joins.append(join)
+            alpha.joins.sort(key=lambda j: -j.level)
+            for fact_id, values in alpha.memory.items():
+                facts = join.index.setdefault(join.key(values), {})
+                facts[fact_id] = values
+            bound.update(pattern.vars)
+        self.rules.append(rule)
+        rule.memories[0].add((), {})
+        return rule
+
+    def alpha(self, shape):
+        """Return the AlphaNode of shape, creating it if needed."""
+        alpha = self.alpha_by_shape.get(shape)
+        if alpha is not None:
+            return alpha
+        alpha = self.alpha_by_shape[shape] = AlphaNode(shape)
+        self.alphas.append(alpha)
+        match = shape.compiled.match
+        self.pattern_set.add(shape.pattern, match)
+        for fact_id, fact in self.facts.items():
+            bindings = match(fact)
+            if bindings is not None:
+                alpha.memory[fact_id] = tuple(bindings.values())
+                self.fact_alphas[fact_id].append(alpha)
+        return alpha
+
+    def assert_fact(self, fact):
+        """Add fact to the working memory, and return its id."""
+        fact_id = self.next_id
+        self.next_id += 1
+        self.facts[fact_id] = fact
+        alphas = self.fact_alphas[fact_id] = []
+        for i, _, match in self.pattern_set.candidates(fact):
+            bindings = match(fact)
+            if bindings is None:
+                continue
+            alpha = self.alphas[i]
+            alphas.append(alpha)
+            # the compiled matcher binds the slots in slot order
+            values = alpha.memory[fact_id] = tuple(bindings.values())
+            # deepest first, so that a fact that matches several patterns
+            # of a rule forms each match once
+            for join in alpha.joins:
+                join.right_activate(fact_id, values)
+        return fact_id
+
+    def retract_fact(self, fact_id):
+        """Remove the fact with id fact_id from the working memory, with
+        the matches it takes part in. Return the fact."""
+        fact = self.facts.pop(fact_id)
+        for alpha in self.fact_alphas.pop(fact_id):
+            values = alpha.memory.pop(fact_id)
+            for join in alpha.joins:
+                join.right_remove(fact_id, values)
+                for memory in join.left.rule.memories[join.level + 1:]:
+                    memory.remove(fact_id)
+        return fact
+
+
+class TestRete(unittest.TestCase):
+
+    def setUp(self):
+        self.acc = Var(str)
+        self.amount = Var(int)
+        self.balance = Var(int)
+        self.transfer = {'name': 'transfer', 'arg1': self.acc,
+                         'arg2': self.amount}
+        self.account = {'account': self.acc, 'balance': self.balance}
+
+    def test_join(self):
+        rete = Rete()
+        events = []
+        rule = rete.add_rule(
+            [self.transfer, self.account],
+            on_match=lambda token, b: events.append(('+', token)),
+            on_unmatch=lambda token, b: events.append(('-', token)))
+        acc1 = rete.assert_fact({'account': 'acc1', 'balance': 10})
+        rete.assert_fact({'account': 'acc2', 'balance': 20})
+        t1 = rete.assert_fact({'name': 'transfer', 'arg1': 'acc1',
+                               'arg2': 5})
+        rete.assert_fact({'name': 'transfer', 'arg1': 'acc3', 'arg2': 5})
+        rete.assert_fact({'name': 'other', 'arg1': 'acc1', 'arg2': 5})
+        self.assertEqual(rule.matches,
+                         {(t1, acc1): {self.acc: 'acc1', self.amount: 5,
+                                       self.balance: 10}})
+        t2 = rete.assert_fact({'name': 'transfer', 'arg1': 'acc1',
+                               'arg2': 7})
+        self.assertEqual(set(rule.matches), {(t1, acc1), (t2, acc1)})
+        rete.retract_fact(acc1)
+        self.assertEqual(rule.matches, {})
+        self.assertEqual(events[:2], [('+', (t1, acc1)), ('+', (t2, acc1))])
+        self.assertEqual(set(events[2:]), {('-', (t1, acc1)),
+                                           ('-', (t2, acc1))})
+
+    def test_rule_added_later_and_shared_alpha(self):
+        rete = Rete()
+        acc = rete.assert_fact({'account': 'acc1', 'balance': 10})
+        transfer = rete.assert_fact({'name': 'transfer', 'arg1': 'acc1',
+                                     'arg2': 50})
+        rule = rete.add_rule([Pattern(self.transfer), self.account],
+                             condition=self.amount > self.balance)
+        self.assertEqual(list(rule.matches), [(transfer, acc)])
+        other = Var(str)
+        rete.add_rule([{'account': other, 'balance': Var(int)}])
+        self.assertEqual(len(rete.alphas), 2)
+        # the alpha nodes share the compiled matchers of their shapes
+        candidates = rete.pattern_set.candidates({'account': 'acc1',
+                                                  'balance': 0})
+        self.assertEqual([match for _, _, match in candidates],
+                         [rete.alphas[1].shape.compiled.match])
+        rete.assert_fact({'name': 'transfer', 'arg1': 'acc1', 'arg2': 5})
+        self.assertEqual(list(rule.matches), [(transfer, acc)])
+        self.assertEqual(rete.retract_fact(transfer)['arg2'], 50)
+        self.assertEqual(rule.matches, {})
+        with self.assertRaises(ValueError):
+            rete.add_rule([])
+
+    def test_against_brute_force(self):
+        """Random asserts and retracts give the same matches as matching
+        each pattern against each combination of facts."""
+        x, y, z = Var(int), Var(int), Var(int)
+        rules = [[{'r': x, 's': y}, {'r': y, 's': z}],
+                 [{'r': x, 's': y}, {'r': y, 's': x}],
+                 [{'r': x, 's': x}],
+                 [{'r': x, 's': y}, {'t': y}, {'r': y, 's': z}, {'t': z}]]
+        rng = random.Random(1)
+        rete = Rete()
+        compiled = [(rete.add_rule(patterns), patterns)
+                    for patterns in rules]
+        ids = []
+        for step in range(300):
+            if ids and rng.random() < 0.3:
+                rete.retract_fact(ids.pop(rng.randrange(len(ids))))
+            elif rng.random() < 0.3:
+                ids.append(rete.assert_fact({'t': rng.randrange(6)}))
+            else:
+                ids.append(rete.assert_fact({'r': rng.randrange(6),
+                                             's': rng.randrange(6)}))
+            if step % 15:
+                continue
+            for rule, patterns in compiled:
+                expected = {}
+                self.match_each(rete.facts, patterns, (), {}, expected)
+                self.assertEqual(rule.matches, expected)
+
+    def match_each(self, facts, patterns, token, bindings, found):
+        """Put the matches of patterns in found, extending token and
+        bindings: try each pattern on each fact, in nested loops."""
+        if len(token) == len(patterns):
+            found[token] = bindings
+            return
+        for fact_id, fact in facts.items():
+            extended = dict(bindings)
+            if Pattern.match_any(patterns[len(token)], fact, extended):
+                self.match_each(facts, patterns, token + (fact_id,),
+                                extended, found)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,4 @@
-from pat2 import Var
+from pat2 import Var, BinaryExpr
 from statemachine import StateMachine, State, Location, Transition
 
 
@@ -7,6 +7,10 @@ class Acc(StateMachine):
     # machine that represents a single account. As is common in Python,
     # the __init__ method defines how to instantiate such a state machine,
     # given arguments for the account id and its initial balance.
+    # The instances share the locations, transitions and their compiled
+    # patterns and guards, which are built once, with symbolic arguments.
+    flyweight = True
+
     def __init__(m, x, init_balance):
         super().__init__()  # Acc is derived from StateMachine, which needs
         # to be init-ed as well.
@@ -43,7 +47,7 @@ class Acc(StateMachine):
 
         # initialize the state vector
         m.state.loc = m.A1
-        m.total = 0
+        m.state.total = init_balance
 
 
 class KickOff(StateMachine):  # instead of main, be more Pythonic (see below)
@@ -57,7 +61,9 @@ class KickOff(StateMachine):  # instead of main, be more Pythonic (see below)
         # (demonstrate that they may also be initialized here instead of after
         # defining the transitions)
         m.state = State()
+        m.state.loc = Var(Location)
         m.state.loc = m.M1
+        m.state.active_accounts = Var(set)
         m.state.active_accounts = set()  # init to empty set
 
         # transitions
@@ -65,7 +71,11 @@ class KickOff(StateMachine):  # instead of main, be more Pythonic (see below)
             t.y = Var(str)
             t.a = Var(int)
             t.trigger = {'name': 'transfer', 'arg1': t.y, 'arg2': t.a}
-            t.condition = (t.y not in m.state.active_accounts)  # needs work...
+            # Python does not allow overloading 'not in'. The condition
+            # refers to the Var, as the state variable is bound already, so
+            # it sees the set the state holds when the transition fires.
+            t.condition = BinaryExpr('not in', t.y,
+                                     m.state._vars['active_accounts'])
             def update():
                 m.state.active_accounts.add(t.y)
                 Acc(t.y, t.a).activate()
@@ -75,4 +85,4 @@ class KickOff(StateMachine):  # instead of main, be more Pythonic (see below)
 
 # Try it out.
 main = KickOff()  # instead of a main, we can just say where to start
-main.activate()  # doesn't do anything yet
+main.activate()  # doesn't do anything outside a Runtime (see runtime.py)
@@ -0,0 +1,319 @@
+"""Benchmark suite for matching, substitution, typed Vars, the bank and
+task control models, and journal replay.
+
+Run with: python bench.py [-h] [--quick] [--json PATH] [--baseline PATH]
+[--threshold FRACTION] [NAME ...]
+
+Each benchmark reports its throughput and the percentiles of its latency
+per operation. With --json the results are saved, and with --baseline they
+are compared with results saved earlier: a benchmark whose median latency
+grew by more than the threshold is reported as a regression, and the exit
+status is 1."""
+
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from pat2 import Var, Pattern
+from statemachine import StateMachine, current_runtime
+from shard import ShardWorker, account_key, transfer_key
+from journal import Journal, Replay
+
+
+class Benchmark:
+    """A benchmark: setup() returns a function of no arguments that performs
+    ops_per_call operations. Micro-benchmarks call it inner times per sample,
+    because single calls are too short to time."""
+
+    def __init__(self, name, setup, inner=1000, samples=200, ops_per_call=1):
+        self.name = name
+        self.setup = setup
+        self.inner = inner
+        self.samples = samples
+        self.ops_per_call = ops_per_call
+
+    def run(self, quick=False):
+        fn = self.setup()
+        samples = max(self.samples // 10, 5) if quick else self.samples
+        inner = range(self.inner)
+        for _ in inner:  # warm up
+            fn()
+        latencies = []
+        clock = time.perf_counter_ns
+        for _ in range(samples):
+            start = clock()
+            for _ in inner:
+                fn()
+            latencies.append((clock() - start)
+                             / (self.inner * self.ops_per_call))
+        return summarize(latencies)
+
+
+def summarize(latencies):
+    """Return the statistics of a list of latencies in ns per operation."""
+    latencies = sorted(latencies)
+    return {'ops_per_sec': 1e9 * len(latencies) / sum(latencies),
+            'p50_ns': percentile(latencies, 50),
+            'p90_ns': percentile(latencies, 90),
+            'p99_ns': percentile(latencies, 99),
+            'samples': len(latencies)}
+
+
+def percentile(sorted_values, p):
+    """Return the p-th percentile of sorted_values, interpolating between
+    the two nearest ranks."""
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    low, high = sorted_values[lo], sorted_values[hi]
+    return low + (high - low) * (k - lo)
+
+
+def nested(depth, width, leaf):
+    """Return a pattern of the given depth, where each dict has width - 1
+    constant entries besides the one that leads to leaf."""
+    term = leaf
+    for level in range(depth):
+        term = {**{f'key{i}': i for i in range(width - 1)}, 'next': term}
+    return term
+
+
+def match_case(depth, width, hit, compiled):
+    def setup():
+        pat = Pattern(nested(depth, width, Var(int)))
+        # a miss is found in the innermost dict, after all the other checks
+        ground = nested(depth, width, 42 if hit else 'x')
+        match = pat.compile().match if compiled else pat.match
+        return lambda: match(ground)
+    return setup
+
+
+def subst_case(template):
+    def setup():
+        task = Var(int)
+        pat = Pattern({'notification': 'Ready', 'arg': task,
+                       'payload': [{'slot': i, 'state': 'idle', 'arg': task}
+                                   for i in range(50)]})
+        bindings = {task: 7}
+        subst = pat.template().subst if template else pat.subst
+        return lambda: subst(bindings)
+    return setup
+
+
+def var_case(typ, value, sample=None):
+    def setup():
+        var = Var(typ, sample)
+        return lambda: var.match(value, {})
+    return setup
+
+
+def bank_case(n_accounts, n_events, journaled=False):
+    """Transfers to n_accounts existing Acc machines, routed by account as in
+    shard.py, so each goes to one Acc and the KickOff. If journaled, the
+    steps are recorded in a Journal."""
+    def setup():
+        from bank import KickOff
+        worker = ShardWorker(0, 1, account_key)
+        current_runtime.set(worker)
+        journal = Journal(temporary_path('bank.journal')) if journaled \
+            else None
+        StateMachine.journal = journal
+        worker.run_batch([(0, KickOff, (), {})], [])
+        events = []
+        for seq in range(1, n_accounts + n_events + 1):
+            event = {'name': 'transfer', 'arg1': f'acc{seq % n_accounts}',
+                     'arg2': 1}
+            events.append([(seq, transfer_key(event), event)])
+        batches = iter(events)
+        for _ in range(n_accounts):  # the first transfers create the Accs
+            worker.run_batch((), next(batches))
+        StateMachine.journal = None
+        if not journaled:
+            return lambda: worker.run_batch((), next(batches))
+
+        def run_batch():
+            StateMachine.journal = journal
+            try:
+                worker.run_batch((), next(batches))
+            finally:
+                StateMachine.journal = None
+        return run_batch
+    return setup
+
+
+def replay_case(n_accounts, n_events):
+    """Replay a Journal of bank_case with n_accounts and n_events, from the
+    start: this creates the Accs and steps them, and steps the KickOff
+    only for the transfers that created an Acc (see Replay)."""
+    def setup():
+        from bank import KickOff
+        path = temporary_path('replay.journal')
+        journal = Journal(path)
+        StateMachine.journal = journal
+        worker = ShardWorker(0, 1, account_key)
+        current_runtime.set(worker)
+        events = []
+        for seq in range(1, n_accounts + n_events + 1):
+            event = {'name': 'transfer', 'arg1': f'acc{seq % n_accounts}',
+                     'arg2': 1}
+            events.append((seq, transfer_key(event), event))
+        worker.run_batch([(0, KickOff, (), {})], events)
+        StateMachine.journal = None
+        journal.close()
+
+        def replay():
+            r = Replay(path)
+            r.run()
+            r.close()
+        return replay
+    return setup
+
+
+def temporary_path(name):
+    """Return a path in a temporary directory that is removed at exit."""
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    return os.path.join(directory, name)
+
+
+def task_control_case(n_machines):
+    """Start a task on each of n_machines TaskControl machines; each Start
+    activates a ReadyCompleted, which sends its two notifications."""
+    def setup():
+        from task_control import TaskControl
+        worker = ShardWorker(0, 1, lambda cls, args, kwargs: None)
+        current_runtime.set(worker)
+        machines = iter([TaskControl() for _ in range(n_machines)])
+        task_ids = iter(range(n_machines))
+
+        def start():
+            worker.deliver(next(machines),
+                           {'command': 'Start', 'arg': next(task_ids)})
+            worker.responses.clear()
+        return start
+    return setup
+
+
+BENCHMARKS = []
+for depth in (1, 4, 8):
+    for width in (1, 16):
+        for hit in (True, False):
+            for compiled in (False, True):
+                BENCHMARKS.append(Benchmark(
+                    f"match {'compiled' if compiled else 'interpreted'} "
+                    f"{'hit' if hit else 'miss'} depth={depth} width={width}",
+                    match_case(depth, width, hit, compiled),
+                    inner=100))
+BENCHMARKS += [
+    Benchmark('subst interpreted 50 items', subst_case(False), inner=20),
+    Benchmark('subst template 50 items', subst_case(True), inner=20),
+    Benchmark('Var(int) match hit', var_case(int, 42)),
+    Benchmark('Var(int) match miss', var_case(int, 'x')),
+    Benchmark('Var(object) match', var_case(object, [1, 2])),
+    Benchmark('Var(list[int]) match 100k ticks',
+              var_case(list[int], list(range(100_000))), inner=1,
+              samples=50),
+    Benchmark('Var(list[int], sample=1000) match 100k ticks',
+              var_case(list[int], list(range(100_000)), 1000), inner=10),
+    Benchmark('bank 10k accounts, per transfer', bank_case(10_000, 100_000),
+              inner=50, samples=1000),
+    Benchmark('bank 10k accounts, per transfer, journaled',
+              bank_case(10_000, 100_000, journaled=True), inner=50,
+              samples=1000),
+    Benchmark('journal replay bank 1k accounts, per event',
+              replay_case(1000, 20_000), inner=1, samples=10,
+              ops_per_call=21_000),
+    Benchmark('task_control Start, with activation',
+              task_control_case(10_010), inner=10, samples=1000),
+]
+
+
+def compare(results, baseline, threshold):
+    """Return (name, ratio of median latencies, is a regression) for the
+    benchmarks in both results and baseline."""
+    comparison = []
+    for name, result in results.items():
+        if name in baseline:
+            ratio = result['p50_ns'] / baseline[name]['p50_ns']
+            comparison.append((name, ratio, ratio > 1 + threshold))
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('names', nargs='*',
+                        help='run only benchmarks whose name contains one '
+                             'of these')
+    parser.add_argument('--quick', action='store_true',
+                        help='take fewer samples')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--baseline', help='compare with the results saved '
+                                           'in this file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fraction by which the median may grow before '
+                             'it counts as a regression (default 0.1)')
+    args = parser.parse_args(argv)
+
+    results = {}
+    print(f'{"benchmark":52s} {"ops/s":>11s} {"p50 ns":>9s} '
+          f'{"p90 ns":>9s} {"p99 ns":>9s}')
+    for benchmark in BENCHMARKS:
+        if args.names and not any(n in benchmark.name for n in args.names):
+            continue
+        r = results[benchmark.name] = benchmark.run(args.quick)
+        print(f'{benchmark.name:52s} {r["ops_per_sec"]:11.0f} '
+              f'{r["p50_ns"]:9.0f} {r["p90_ns"]:9.0f} {r["p99_ns"]:9.0f}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'results': results}, f, indent=2)
+
+    regressions = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        print(f'\ncompared with {args.baseline}:')
+        for name, ratio, regression in compare(results, baseline,
+                                               args.threshold):
+            regressions += regression
+            print(f'{name:52s} {ratio:6.2f}x'
+                  f'{"  REGRESSION" if regression else ""}')
+    return 1 if regressions else 0
+
+
+class TestBench(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([1, 2], 50), 1.5)
+
+    def test_compare(self):
+        baseline = {'a': {'p50_ns': 100}, 'b': {'p50_ns': 100}}
+        results = {'a': {'p50_ns': 105}, 'b': {'p50_ns': 150},
+                   'c': {'p50_ns': 1}}
+        self.assertEqual(compare(results, baseline, 0.1),
+                         [('a', 1.05, False), ('b', 1.5, True)])
+
+    def test_run(self):
+        benchmark = Benchmark('Var', var_case(int, 1), inner=10, samples=10)
+        result = benchmark.run(quick=True)
+        self.assertEqual(result['samples'], 5)
+        self.assertLessEqual(result['p50_ns'], result['p99_ns'])
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['test']:
+        unittest.main(argv=sys.argv[:1] + sys.argv[2:])
+    else:
+        sys.exit(main())
@@ -0,0 +1,470 @@
+"""Checkpoints of the state vectors of many StateMachines, with incremental
+deltas in between, and lazy loading through a memory-mapped file."""
+
+import functools
+import importlib
+import marshal
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from statemachine import State, Location, add_write_hook, remove_write_hook
+
+MAGIC = b'SMCKPT02'
+# index offset, number of machines, classes offset, checkpoint id
+FOOTER = struct.Struct('<QQQQ')
+LENGTH = struct.Struct('<I')  # prefix of a record in the delta log
+DELTA_HEADER = struct.Struct('<Q')  # checkpoint id
+CONTAINERS = (set, list, dict, bytearray)  # changed without assignment
+
+
+class Checkpointer:
+    """Writes the states of a population of machines to path.
+
+    Method checkpoint writes a full snapshot: per machine its class, the
+    arguments of its constructor (see StateMachine.init_args), the index of
+    its location, and the values of its bound data variables. Method
+    save_delta appends to path + '.delta' only what changed since the last
+    checkpoint or delta: the variables that an update assigned or unbound,
+    and machines that were created in the meantime. A checkpoint empties
+    the delta log. Only the machines whose State was assigned to in the
+    meantime are encoded again (see add_write_hook), and those that hold a
+    set, list, dict or bytearray, because changes inside a container are
+    not assignments, or whose State is not a State. So the cost of a delta
+    grows with the number of changes, not with the number of machines.
+
+    Each snapshot has a random id, which also starts its delta log, so that
+    after a crash between replacing the snapshot and emptying the delta
+    log, the deltas of the old snapshot are not applied to the new one.
+
+    Values are encoded with marshal, so they must be of builtin types. A
+    snapshot is written to a temporary file that replaces path once it is
+    complete; deltas are flushed but not synced."""
+
+    def __init__(self, path):
+        self.path = path
+        self.delta_path = path + '.delta'
+        self.numbers = {}  # machine -> number in the snapshot
+        self.machines = []
+        self.saved = []  # per machine: (location index, {var index: bytes})
+        self.classes = {}  # machine class -> class entry (see class_entry)
+        self.delta_file = None
+        self.hooks = {}  # machine -> write hook
+        self.dirty = set()  # machines whose State was assigned to
+        self.unwatched = set()  # machines to encode for every delta
+
+    def checkpoint(self, machines):
+        """Write a full snapshot of machines, and empty the delta log."""
+        self.unhook()
+        self.numbers = {}
+        self.machines = []
+        self.saved = []
+        self.classes = {}
+        class_ids = {}
+        checkpoint_id = int.from_bytes(os.urandom(8), 'little')
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            offsets = [f.tell()]
+            for m in machines:
+                entry = self.class_entry(m)
+                class_id = class_ids.setdefault(entry, len(class_ids))
+                loc, values = self.remember(m)
+                args, kwargs = m.init_args
+                f.write(marshal.dumps((class_id, args, kwargs, loc, values)))
+                offsets.append(f.tell())
+            f.write(bytes(-f.tell() % 8))  # align the index
+            index_offset = f.tell()
+            f.write(struct.pack(f'{len(offsets)}Q', *offsets))
+            classes_offset = f.tell()
+            f.write(marshal.dumps(list(class_ids)))
+            f.write(FOOTER.pack(index_offset, len(self.machines),
+                                classes_offset, checkpoint_id))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        if self.delta_file is not None:
+            self.delta_file.close()
+        self.delta_file = open(self.delta_path, 'wb')
+        self.delta_file.write(DELTA_HEADER.pack(checkpoint_id))
+        self.delta_file.flush()
+
+    def save_delta(self, machines):
+        """Append the changes of machines since the last checkpoint or delta
+        to the delta log. Machines that are not in the snapshot yet are
+        written in full."""
+        if self.delta_file is None:
+            raise ValueError('save_delta needs a checkpoint first')
+        f = self.delta_file
+        numbers = self.numbers
+        for m in machines:
+            if m not in numbers:
+                entry = self.class_entry(m)
+                loc, values = self.remember(m)
+                args, kwargs = m.init_args
+                self.write_record(('new', entry, args, kwargs, loc, values))
+        written = self.dirty | self.unwatched
+        self.dirty = set()
+        for number in sorted(numbers[m] for m in written):
+            m = self.machines[number]
+            old_loc, old_values = self.saved[number]
+            loc, values = self.encode(m)
+            if loc == old_loc and values == old_values:
+                continue
+            self.saved[number] = (loc, values)
+            assigned = {i: marshal.loads(v) for i, v in values.items()
+                        if old_values.get(i) != v}
+            unbound = [i for i in old_values if i not in values]
+            self.write_record(('set', number,
+                               loc if loc != old_loc else None, assigned,
+                               unbound))
+        f.flush()
+
+    def write_record(self, record):
+        data = marshal.dumps(record)
+        self.delta_file.write(LENGTH.pack(len(data)))
+        self.delta_file.write(data)
+
+    def close(self):
+        self.unhook()
+        if self.delta_file is not None:
+            self.delta_file.close()
+            self.delta_file = None
+
+    def remember(self, m):
+        """Number m, watch the writes to its State, and return its location
+        index and values."""
+        self.numbers[m] = len(self.machines)
+        self.machines.append(m)
+        state = m.state
+        if not isinstance(state, State) or any(
+                type(getattr(state, name)) in CONTAINERS
+                for name in state._vars):
+            self.unwatched.add(m)  # e.g. a ColumnState, see columnar.py
+        else:
+            hook = self.hooks[m] = functools.partial(self.written, m)
+            add_write_hook(state, hook)
+        loc, values = self.encode(m)
+        self.saved.append((loc, values))
+        return loc, {i: marshal.loads(v) for i, v in values.items()}
+
+    def written(self, m, var):
+        self.dirty.add(m)
+
+    def unhook(self):
+        """Stop watching the machines of the last checkpoint."""
+        for m, hook in self.hooks.items():
+            remove_write_hook(m.state, hook)
+        self.hooks = {}
+        self.dirty = set()
+        self.unwatched = set()
+
+    def encode(self, m):
+        """Return the location index of m, and the marshalled values of its
+        bound data variables by index."""
+        loc, values = state_values(m, self.class_entry(m))
+        return loc, {i: marshal.dumps(v) for i, v in values.items()}
+
+    def class_entry(self, m):
+        entry = self.classes.get(type(m))
+        if entry is None:
+            entry = self.classes[type(m)] = class_entry(m)
+        return entry
+
+
+class Snapshot:
+    """The machines of a checkpoint and its delta log, loaded lazily.
+
+    The snapshot file is memory-mapped, and only its small footer and class
+    table are read when it is opened. Machine number i is created by
+    self[i]: its class is called with the recorded arguments, and then its
+    location and variables are set to the recorded values. So opening takes
+    the same time for any number of machines; the delta log is read in full,
+    but it only holds the changes since the last checkpoint. A torn record
+    at the end of the delta log, left by a crash, is ignored, and so is a
+    delta log of another snapshot."""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a checkpoint')
+        index_offset, self.n_snapshot, classes_offset, self.checkpoint_id = \
+            FOOTER.unpack(self.mmap[-FOOTER.size:])
+        self.view = memoryview(self.mmap)
+        self.index = self.view[
+            index_offset:index_offset + 8 * (self.n_snapshot + 1)].cast('Q')
+        self.classes = marshal.loads(
+            self.view[classes_offset:len(self.mmap) - FOOTER.size])
+        self.loaded = {}  # number -> machine
+        # number -> (location index, {var index: value}, unbound indices)
+        self.changes = {}
+        self.new = []  # records of machines created after the checkpoint
+        self.read_deltas(path + '.delta')
+
+    def read_deltas(self, delta_path):
+        try:
+            with open(delta_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if len(data) < DELTA_HEADER.size or \
+                DELTA_HEADER.unpack_from(data)[0] != self.checkpoint_id:
+            return  # the deltas of another snapshot
+        pos = DELTA_HEADER.size
+        while pos + LENGTH.size <= len(data):
+            (size,) = LENGTH.unpack_from(data, pos)
+            pos += LENGTH.size
+            if pos + size > len(data):
+                break
+            record = marshal.loads(data[pos:pos + size])
+            pos += size
+            if record[0] == 'new':
+                self.new.append(list(record[1:]))
+                continue
+            _, number, loc, assigned, unbound = record
+            if number >= self.n_snapshot:
+                new = self.new[number - self.n_snapshot]
+                if loc is not None:
+                    new[3] = loc
+                values = new[4]
+            else:
+                old_loc, values, unbound_before = self.changes.get(
+                    number, (None, {}, set()))
+                unbound_before.difference_update(assigned)
+                unbound_before.update(unbound)
+                self.changes[number] = (loc if loc is not None else old_loc,
+                                        values, unbound_before)
+            values.update(assigned)
+            for i in unbound:
+                values.pop(i, None)
+
+    def __len__(self):
+        return self.n_snapshot + len(self.new)
+
+    def __getitem__(self, number):
+        if not 0 <= number < len(self):
+            raise IndexError(number)
+        m = self.loaded.get(number)
+        if m is None:
+            m = self.materialize(number)
+            self.loaded[number] = m
+        return m
+
+    def __iter__(self):
+        for number in range(len(self)):
+            yield self[number]
+
+    def materialize(self, number):
+        if number >= self.n_snapshot:
+            entry, args, kwargs, loc, values = \
+                self.new[number - self.n_snapshot]
+        else:
+            start, end = self.index[number], self.index[number + 1]
+            class_id, args, kwargs, loc, values = marshal.loads(
+                self.view[start:end])
+            entry = self.classes[class_id]
+            new_loc, assigned, unbound = self.changes.get(
+                number, (None, {}, ()))
+            if new_loc is not None:
+                loc = new_loc
+            values = {**values, **assigned}
+            for i in unbound:
+                values.pop(i, None)
+        m = find_class(entry[0])(*args, **kwargs)
+        restore_state(m, entry, loc, values)
+        return m
+
+    def close(self):
+        self.index.release()
+        self.view.release()
+        self.mmap.close()
+        self.file.close()
+
+
+def class_entry(m):
+    """Return (class name, location names, data variable names) for the
+    class of m."""
+    cls = type(m)
+    location_names = tuple(name for name, value in vars(m).items()
+                           if isinstance(value, Location))
+    var_names = tuple(name for name in m.state._vars if name != 'loc')
+    return (f'{cls.__module__}:{cls.__qualname__}', location_names,
+            var_names)
+
+
+def state_values(m, entry):
+    """Return the location index of m, or -1 if its location is unbound,
+    and the values of its bound data variables by index in entry (see
+    class_entry)."""
+    _, location_names, var_names = entry
+    state = m.state
+    state_vars = state._vars
+    loc = state.loc
+    loc = -1 if loc is state_vars['loc'] else location_names.index(loc.name)
+    values = {}
+    for i, name in enumerate(var_names):
+        value = getattr(state, name)
+        if value is not state_vars[name]:
+            values[i] = value
+    return loc, values
+
+
+def restore_state(m, entry, loc, values):
+    """Set the location and data variables of m as given by state_values;
+    the variables that are not in values become unbound."""
+    _, location_names, var_names = entry
+    state = m.state
+    state_vars = state._vars
+    if loc >= 0:
+        state.loc = getattr(m, location_names[loc])
+    else:
+        object.__setattr__(state, 'loc', state_vars['loc'])
+    for i, name in enumerate(var_names):
+        if i in values:
+            setattr(state, name, values[i])
+        else:
+            object.__setattr__(state, name, state_vars[name])
+
+
+def find_class(class_name):
+    module_name, qualname = class_name.split(':')
+    obj = importlib.import_module(module_name)
+    for name in qualname.split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'machines.ckpt')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_checkpoint_and_deltas(self):
+        from bank import Acc, KickOff
+        from task_control import TaskControl
+        kick_off = KickOff()
+        accounts = [Acc(f'acc{i}', i) for i in range(5)]
+        tc = TaskControl()
+        machines = [kick_off, tc] + accounts
+        checkpointer = Checkpointer(self.path)
+        checkpointer.checkpoint(machines)
+        kick_off.step({'name': 'transfer', 'arg1': 'acc9', 'arg2': 9})
+        accounts[2].step({'name': 'transfer', 'arg1': 'acc2', 'arg2': 40})
+        checkpointer.save_delta(machines)
+        size = os.path.getsize(self.path + '.delta')
+        checkpointer.save_delta(machines)  # nothing changed
+        self.assertEqual(os.path.getsize(self.path + '.delta'), size)
+        new_account = Acc('acc9', 9)
+        machines.append(new_account)
+        new_account.step({'name': 'transfer', 'arg1': 'acc9', 'arg2': 1})
+        checkpointer.save_delta(machines)
+        new_account.step({'name': 'transfer', 'arg1': 'acc9', 'arg2': 5})
+        checkpointer.save_delta(machines)
+        checkpointer.close()
+
+        snapshot = Snapshot(self.path)
+        self.assertEqual(len(snapshot), 8)
+        self.assertEqual(snapshot.loaded, {})
+        restored = snapshot[2 + 2]
+        self.assertEqual(list(snapshot.loaded), [4])
+        self.assertEqual((restored.init_args, restored.state.total),
+                         ((('acc2', 2), {}), 42))
+        self.assertEqual([m.state._bindings.get(m.state._vars.get('total'))
+                          for m in snapshot][2:], [0, 1, 42, 3, 4, 15])
+        restored_kick_off = snapshot[0]
+        self.assertEqual(restored_kick_off.state.active_accounts, {'acc9'})
+        self.assertIs(restored_kick_off.state.loc, restored_kick_off.M1)
+        # the condition still sees the restored set
+        self.assertIsNone(restored_kick_off.step(
+            {'name': 'transfer', 'arg1': 'acc9', 'arg2': 1}))
+        self.assertIs(snapshot[1].state.loc, snapshot[1].off)
+        snapshot.close()
+
+    def test_deltas_of_other_snapshot_are_ignored(self):
+        from bank import Acc
+        account = Acc('acc1', 1)
+        checkpointer = Checkpointer(self.path)
+        checkpointer.checkpoint([account])
+        account.step({'name': 'transfer', 'arg1': 'acc1', 'arg2': 10})
+        checkpointer.save_delta([account])
+        old_deltas = self.path + '.old'
+        shutil.copy(self.path + '.delta', old_deltas)
+        account.step({'command': 'reconcile'})
+        checkpointer.checkpoint([account])
+        checkpointer.close()
+        # a crash after the new snapshot replaced the old one, but before
+        # the delta log was emptied
+        os.replace(old_deltas, self.path + '.delta')
+        snapshot = Snapshot(self.path)
+        self.assertEqual(snapshot[0].state.total, 0)
+        snapshot.close()
+
+    def test_delta_encodes_only_assigned_machines(self):
+        from bank import Acc, KickOff
+        encoded = []
+
+        class CountingCheckpointer(Checkpointer):
+            def encode(self, m):
+                encoded.append(m)
+                return super().encode(m)
+        kick_off = KickOff()  # holds a set, so it is always encoded
+        accounts = [Acc(f'acc{i}', i) for i in range(100)]
+        checkpointer = CountingCheckpointer(self.path)
+        checkpointer.checkpoint([kick_off] + accounts)
+        encoded.clear()
+        accounts[7].step({'name': 'transfer', 'arg1': 'acc7', 'arg2': 1})
+        checkpointer.save_delta([kick_off] + accounts)
+        self.assertEqual(encoded, [kick_off, accounts[7]])
+        encoded.clear()
+        checkpointer.save_delta([kick_off] + accounts)
+        self.assertEqual(encoded, [kick_off])
+        checkpointer.close()
+        self.assertIsNone(accounts[7].state._on_write)
+        snapshot = Snapshot(self.path)
+        self.assertEqual(snapshot[8].state.total, 8)
+        snapshot.close()
+
+    def test_delta_records_unbinding(self):
+        from bank import Acc
+        account = Acc('acc1', 1)
+        new_account = Acc('acc2', 2)
+        checkpointer = Checkpointer(self.path)
+        checkpointer.checkpoint([account])
+        checkpointer.save_delta([account, new_account])
+        for m in (account, new_account):
+            object.__setattr__(m.state, 'total', m.state._vars['total'])
+            m.state.loc = m.A1  # a write, so that m is encoded again
+        checkpointer.save_delta([account, new_account])
+        checkpointer.close()
+        snapshot = Snapshot(self.path)
+        for m in snapshot:
+            self.assertIs(m.state.total, m.state._vars['total'])
+        snapshot.close()
+
+    def test_new_checkpoint_empties_deltas(self):
+        from bank import Acc
+        account = Acc('acc1', 1)
+        checkpointer = Checkpointer(self.path)
+        checkpointer.checkpoint([account])
+        account.step({'command': 'reconcile'})
+        checkpointer.save_delta([account])
+        checkpointer.checkpoint([account])
+        checkpointer.close()
+        self.assertEqual(os.path.getsize(self.path + '.delta'),
+                         DELTA_HEADER.size)
+        snapshot = Snapshot(self.path)
+        self.assertEqual(snapshot[0].state.total, 0)
+        snapshot.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
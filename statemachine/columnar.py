@@ -0,0 +1,506 @@
+"""Columnar storage of the states of many StateMachines, using NumPy."""
+
+import unittest
+
+from pat2 import Var, BinaryExpr, UnaryExpr
+from statemachine import StateMachine, State, Location, Transition, \
+    RunQueue
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class Population:
+    """The instances of a StateMachine subclass, with their state vectors
+    stored column-wise: each data Var of the State is one NumPy array over
+    all machines, and the locations form an array of location indices.
+
+    A machine that is added gets a ColumnState, which reads and writes its
+    row in the columns, so that step() works on it as before, and keeps
+    the write hooks of its State (see add_write_hook). Method
+    broadcast delivers an event to all machines at once: per location, the
+    condition of each candidate transition is evaluated on whole columns,
+    and its update is executed once, with the state variables bound to
+    arrays instead of single values. So an update such as
+    'm.state.total += t.a' is one vectorized operation.
+
+    A transition is executed in this vectorized way only if its trigger and
+    condition have the same shape, including constants, in all machines
+    (in Acc, add_money compares with the account id x, so it is not),
+    it has no response, and its update only reads and assigns state
+    variables. Updates with other effects, such as activating a new
+    machine, would happen only once, so the names of such transitions must
+    be passed in exclude. For the machines and transitions that do not
+    qualify, broadcast falls back to calling step() per machine. The write
+    hooks of the machines that executed a transition at once are called
+    after the columns are written.
+
+    Columns are int64 for Var(int), float64 for Var(float), bool for
+    Var(bool), and object arrays otherwise. Data Vars of a machine that is
+    added must be bound, except those in object columns."""
+
+    dtypes = {int: 'int64', float: 'float64', bool: 'bool'}
+
+    def __init__(self, machine_class, exclude=(), capacity=1024):
+        if np is None:
+            raise ImportError('Population requires NumPy')
+        self.machine_class = machine_class
+        self.exclude = set(exclude)
+        self.capacity = capacity
+        self.machines = []
+        self.representative = None
+        self.columns = {}  # state attribute name -> array
+        self.loc = np.full(capacity, -1, dtype='int32')
+        self.hooked = np.zeros(capacity, dtype=bool)  # see ColumnState
+        self.location_names = []
+        self.location_index = {}  # location name -> index
+        self.uniform = []  # per edge of the structure graph
+        self.vector_guards = {}  # edge index -> compiled guard, or None
+
+    def __len__(self):
+        return len(self.machines)
+
+    def add(self, machine):
+        """Move the state of machine into the columns."""
+        if self.representative is None:
+            self.init_columns(machine)
+        state = machine.state
+        if set(state._vars) != set(self.columns) | {'loc'}:
+            raise ValueError(f'{machine} has other state variables than '
+                             f'{self.representative}')
+        row = len(self.machines)
+        if row == self.capacity:
+            self.grow()
+        for name, var in state._vars.items():
+            value = getattr(state, name)
+            if name == 'loc':
+                self.loc[row] = (-1 if value is var
+                                 else self.location_index[value.name])
+                continue
+            column = self.columns[name]
+            if value is var and column.dtype != object:
+                raise ValueError(f'state variable {name} of {machine} is '
+                                 f'unbound')
+            column[row] = value
+        column_state = ColumnState(self, row, machine, state._vars)
+        object.__setattr__(column_state, '_on_write', state._on_write)
+        object.__setattr__(machine, 'state', column_state)
+        self.machines.append(machine)
+        rep_graph = self.representative.structure.graph
+        for i, (rep_trans, bound_trans) in enumerate(
+                zip(rep_graph, machine.structure.graph)):
+            self.uniform[i] = self.uniform[i] and same_shape(
+                rep_trans['transition'], bound_trans['transition'])
+
+    def init_columns(self, machine):
+        self.representative = machine
+        for name, value in vars(machine).items():
+            if isinstance(value, Location):
+                self.location_index[name] = len(self.location_names)
+                self.location_names.append(name)
+        for name, var in machine.state._vars.items():
+            if name != 'loc':
+                dtype = self.dtypes.get(var.typ, object)
+                self.columns[name] = np.empty(self.capacity, dtype=dtype)
+        self.uniform = [bound_trans['transition'].name not in self.exclude
+                        and not bound_trans['transition'].response
+                        for bound_trans in machine.structure.graph]
+        self.edge_index = {id(bound_trans): i for i, bound_trans
+                           in enumerate(machine.structure.graph)}
+
+    def grow(self):
+        self.capacity *= 2
+        for name, column in self.columns.items():
+            new = np.empty(self.capacity, dtype=column.dtype)
+            new[:len(column)] = column
+            self.columns[name] = new
+        loc = np.full(self.capacity, -1, dtype='int32')
+        loc[:len(self.loc)] = self.loc
+        self.loc = loc
+        hooked = np.zeros(self.capacity, dtype=bool)
+        hooked[:len(self.hooked)] = self.hooked
+        self.hooked = hooked
+
+    def broadcast(self, event):
+        """Deliver event to every machine in the population. Return a list
+        of pairs (machine, response) for the machines that executed a
+        transition with a non-empty response."""
+        rep = self.representative
+        if rep is None:
+            return []
+        responses = []
+        loc = self.loc[:len(self.machines)]
+        # group the machines by location before any of them moves
+        groups = [(name, np.flatnonzero(loc == i))
+                  for i, name in enumerate(self.location_names)]
+        for name, rows in groups:
+            if not len(rows):
+                continue
+            for bound_trans, params in rep.structure.candidates(
+                    getattr(rep, name), event):
+                if not len(rows):
+                    break
+                enabled = self.evaluate_guard(bound_trans, params, rows)
+                if enabled is None:
+                    break  # the rest is done per machine
+                fire_rows = rows[enabled]
+                if len(fire_rows):
+                    written = self.execute_update(bound_trans, params,
+                                                  fire_rows)
+                    if written is None:
+                        break
+                    target = bound_trans['target'].name
+                    self.loc[fire_rows] = self.location_index[target]
+                    self.notify(fire_rows, written + ['loc'])
+                rows = rows[~enabled]
+            else:
+                continue
+            for row in rows:
+                machine = self.machines[row]
+                response = machine.step(event)
+                if response:
+                    responses.append((machine, response))
+        return responses
+
+    def evaluate_guard(self, bound_trans, params, rows):
+        """Return a bool array over rows that tells which machines have
+        bound_trans enabled, or None if that cannot be computed here."""
+        i = self.edge_index[id(bound_trans)]
+        if not self.uniform[i]:
+            return None
+        if i not in self.vector_guards:
+            self.vector_guards[i] = self.compile_guard(
+                bound_trans['transition'].condition)
+        guard = self.vector_guards[i]
+        if guard is None:
+            return None
+        try:
+            enabled = guard(self.columns, params, rows)
+        except Exception:
+            return None
+        return np.broadcast_to(np.asarray(enabled, dtype=bool),
+                               rows.shape).copy()
+
+    def compile_guard(self, condition):
+        """Compile condition into a function of the columns, the parameter
+        bindings and the rows, which works on whole arrays. Return None if
+        the condition cannot be vectorized."""
+        names = {var: name for name, var
+                 in self.representative.state._vars.items()}
+        namespace = {'np': np}
+
+        def source(t):
+            if isinstance(t, BinaryExpr):
+                left, right = source(t.left), source(t.right)
+                if t.operator == '&':
+                    return f'np.logical_and({left}, {right})'
+                elif t.operator == '|':
+                    return f'np.logical_or({left}, {right})'
+                elif t.operator in ('>', '<', '=='):
+                    return f'({left} {t.operator} {right})'
+            elif isinstance(t, UnaryExpr):
+                if t.operator == 'not':
+                    return f'np.logical_not({source(t.operand)})'
+            elif isinstance(t, Var):
+                if t not in names:
+                    return f'p[{const(t)}]'
+                elif names[t] != 'loc':
+                    return f'c[{names[t]!r}][rows]'
+            elif type(t) in (int, float, str, bool):
+                return repr(t)
+            raise NotVectorizable
+
+        def const(value):
+            name = f'_c{len(namespace)}'
+            namespace[name] = value
+            return name
+
+        condition = True if condition is None else condition
+        try:
+            code = f'def guard(c, p, rows):\n    return {source(condition)}\n'
+        except NotVectorizable:
+            return None
+        exec(compile(code, '<Population>', 'exec'), namespace)
+        return namespace['guard']
+
+    def execute_update(self, bound_trans, params, rows):
+        """Execute the update of bound_trans once for all rows. Return the
+        names of the state variables it wrote, or None if it fails, in which
+        case nothing is changed."""
+        trans = bound_trans['transition']
+        if trans.update is None:
+            return []
+        rep = self.representative
+        rep_state = rep.state
+        proxy = ColumnProxy(self, rows)
+        object.__setattr__(rep, 'state', proxy)
+        trans.param_bindings = params
+        try:
+            trans.update(rep)
+            writes = proxy.converted_writes()
+        except Exception:
+            return None
+        finally:
+            object.__setattr__(rep, 'state', rep_state)
+            trans.param_bindings = {}
+        for name, value in writes.items():
+            self.columns[name][rows] = value
+        return list(writes)
+
+    def notify(self, rows, names):
+        """Call the write hooks of the machines in rows with the Vars of the
+        state variables names."""
+        machines = self.machines
+        for row in rows[self.hooked[rows]].tolist():
+            state = machines[row].state
+            for name in names:
+                state._hook(state._vars[name])
+
+
+class NotVectorizable(Exception):
+    pass
+
+
+def same_shape(trans1, trans2):
+    """Return whether two transitions have the same trigger and condition,
+    up to the identity of their Vars."""
+    return (same_term(trans1.trigger, trans2.trigger)
+            and same_term(trans1.condition, trans2.condition))
+
+
+def same_term(t1, t2):
+    if isinstance(t1, Var) or isinstance(t2, Var):
+        return (isinstance(t1, Var) and isinstance(t2, Var)
+                and t1.typ is t2.typ and t1.name == t2.name)
+    elif type(t1) is not type(t2):
+        return False
+    elif isinstance(t1, BinaryExpr):
+        return (t1.operator == t2.operator and same_term(t1.left, t2.left)
+                and same_term(t1.right, t2.right))
+    elif isinstance(t1, UnaryExpr):
+        return (t1.operator == t2.operator
+                and same_term(t1.operand, t2.operand))
+    elif isinstance(t1, dict):
+        return (list(t1) == list(t2)
+                and all(same_term(t1[k], t2[k]) for k in t1))
+    elif isinstance(t1, list):
+        return (len(t1) == len(t2)
+                and all(same_term(a, b) for a, b in zip(t1, t2)))
+    return t1 == t2
+
+
+class ColumnState:
+    """The State of a machine in a Population. Its attributes are read from
+    and written to the row of the machine in the columns. As in State,
+    _on_write is called with the Var of each attribute that is assigned a
+    value, if it is set; setting it also marks the row in
+    Population.hooked, so that broadcast only visits the hooked rows."""
+    __slots__ = ('_population', '_row', '_machine', '_vars', '_hook')
+
+    def __init__(self, population, row, machine, state_vars):
+        object.__setattr__(self, '_population', population)
+        object.__setattr__(self, '_row', row)
+        object.__setattr__(self, '_machine', machine)
+        object.__setattr__(self, '_vars', state_vars)
+        object.__setattr__(self, '_hook', None)
+
+    @property
+    def _on_write(self):
+        return self._hook
+
+    @_on_write.setter
+    def _on_write(self, hook):
+        object.__setattr__(self, '_hook', hook)
+        self._population.hooked[self._row] = hook is not None
+
+    def __getattr__(self, name):
+        population = self._population
+        if name == 'loc':
+            i = population.loc[self._row]
+            if i < 0:
+                return self._vars['loc']
+            return getattr(self._machine, population.location_names[i])
+        if name not in population.columns:
+            raise AttributeError(name)
+        value = population.columns[name][self._row]
+        return value.item() if isinstance(value, np.generic) else value
+
+    def __setattr__(self, name, new_value):
+        var = self._vars.get(name)
+        if var is None:
+            print(f'error: cannot declare state attribute {name} of a '
+                  f'machine in a Population')
+            return
+        if not var.accepts(new_value):
+            print('type error')
+            return
+        population = self._population
+        if name == 'loc':
+            population.loc[self._row] = \
+                population.location_index[new_value.name]
+        else:
+            population.columns[name][self._row] = new_value
+        if self._hook is not None:
+            self._hook(var)
+
+    @property
+    def _bindings(self):
+        bindings = {}
+        for name, var in self._vars.items():
+            value = getattr(self, name)
+            if value is not var:
+                bindings[var] = value
+        return bindings
+
+
+class ColumnProxy:
+    """Stands in for the State of the representative of a Population while
+    an update is executed for many rows at once: attributes are the arrays
+    of values of those rows. Assignments are collected, and written to the
+    columns only if the whole update succeeds."""
+
+    def __init__(self, population, rows):
+        object.__setattr__(self, '_population', population)
+        object.__setattr__(self, '_rows', rows)
+        object.__setattr__(self, '_writes', {})
+
+    def __getattr__(self, name):
+        if name in self._writes:
+            return self._writes[name]
+        columns = self._population.columns
+        if name not in columns:
+            raise AttributeError(name)
+        return columns[name][self._rows]
+
+    def __setattr__(self, name, new_value):
+        if name not in self._population.columns:
+            raise AttributeError(name)
+        self._writes[name] = new_value
+
+    def converted_writes(self):
+        """Return the assigned values as arrays of the types of their
+        columns; raise TypeError if that is not possible."""
+        writes = {}
+        for name, value in self._writes.items():
+            dtype = self._population.columns[name].dtype
+            writes[name] = np.asarray(value).astype(dtype, casting='same_kind')
+        return writes
+
+
+class Counter(StateMachine):
+    """Test machine: a guard and update that can be vectorized, and one
+    with a per-instance constant that cannot."""
+    def __init__(m, ident, init):
+        super().__init__()
+        m.locations('low', 'high')
+        m.state = State()
+        m.state.loc = Var(Location)
+        m.state.total = Var(int)
+        with Transition(m, 'bonus', m.low, m.low) as t:
+            t.a = Var(int)
+            t.trigger = {'command': 'bonus', 'arg': t.a}
+            t.condition = (m.state.total < 100) & ~(t.a > 50)
+            def update():
+                m.state.total += t.a
+            t.update = update
+            t.response = []
+        with Transition(m, 'promote', m.low, m.high) as t:
+            t.trigger = {'command': 'promote'}
+            t.condition = m.state.total > 99
+            t.update = None
+            t.response = []
+        with Transition(m, 'credit', m.high, m.high) as t:
+            t.a = Var(int)
+            t.trigger = {'command': 'bonus', 'arg': t.a}
+            t.condition = m.state.total < ident
+            def update():
+                m.state.total += 2 * t.a
+            t.update = update
+            t.response = []
+        with Transition(m, 'reset', m.low, m.low) as t:
+            t.trigger = {'command': 'reconcile'}
+            t.condition = True
+            def update():
+                m.state.total = 0
+            t.update = update
+            t.response = []
+        m.state.loc = m.low
+        m.state.total = init
+
+
+@unittest.skipIf(np is None, 'NumPy is not installed')
+class TestPopulation(unittest.TestCase):
+
+    def test_broadcast_same_as_step(self):
+        events = [{'command': 'bonus', 'arg': 30},
+                  {'command': 'promote'},
+                  {'command': 'bonus', 'arg': 60},
+                  {'command': 'bonus', 'arg': 20},
+                  {'command': 'reconcile'},
+                  {'command': 'bonus', 'arg': 5}]
+        n = 300  # more than the capacity, to test grow
+        population = Population(Counter, capacity=128)
+        machines = [Counter(i, i) for i in range(n)]
+        for m in machines:
+            population.add(m)
+        reference = [Counter(i, i) for i in range(n)]
+        for event in events:
+            population.broadcast(event)
+            for m in reference:
+                m.step(event)
+        self.assertEqual([(m.state.loc.name, m.state.total)
+                          for m in machines],
+                         [(m.state.loc.name, m.state.total)
+                          for m in reference])
+        self.assertEqual(population.uniform, [True, True, False, True])
+
+    def test_exclude_and_step(self):
+        population = Population(Counter, exclude=['reset'])
+        m = Counter(1, 7)
+        population.add(m)
+        population.broadcast({'command': 'reconcile'})
+        self.assertEqual(m.state.total, 0)
+        self.assertEqual(m.step({'command': 'bonus', 'arg': 3}), [])
+        self.assertEqual(m.state.total, 3)
+        self.assertIsInstance(m.state.total, int)
+        m.state.total = 'x'  # type error, ignored
+        self.assertEqual(m.state.total, 3)
+
+    def test_run_queue(self):
+        class Settling(Counter):
+            def __init__(m, ident, init):
+                super().__init__(ident, init)
+                with Transition(m, 'settle', m.high, m.low) as t:
+                    t.trigger = None
+                    t.condition = m.state._vars['total'] > 199
+                    def update():
+                        m.state.total = 0
+                    t.update = update
+                    t.response = []
+        population = Population(Settling)
+        machines = [Settling(i, 100) for i in range(3)]
+        queue = RunQueue()
+        queue.watch(machines[0])  # the hook moves along into the columns
+        for m in machines:
+            population.add(m)
+        for m in machines[1:]:
+            queue.watch(m)
+        queue.run(lambda m: m.step())
+        population.broadcast({'command': 'promote'})  # vectorized
+        self.assertEqual(len(queue), 3)
+        queue.run(lambda m: m.step())  # total is 100, so settle is not
+        m = machines[1]
+        m.state.total = 'x'  # type error, not a write
+        self.assertEqual(len(queue), 0)
+        m.state.total = 300
+        self.assertEqual(list(queue.queue), [m])
+        queue.run(lambda m: m.step())
+        self.assertEqual((m.state.loc.name, m.state.total), ('low', 0))
+        self.assertEqual([m.state.loc.name for m in machines],
+                         ['high', 'low', 'high'])
+
+
+if __name__ == '__main__':
+    unittest.main()
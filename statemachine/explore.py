@@ -0,0 +1,462 @@
+"""Exhaustive exploration of the states of a system of StateMachines, for
+StateMachine.check: deadlocks, unreachable locations and transitions that
+never fire."""
+
+import array
+import contextlib
+import hashlib
+import io
+import marshal
+import multiprocessing
+import unittest
+
+from checkpoint import class_entry, find_class, restore_state, state_values
+from statemachine import current_runtime
+
+
+class FingerprintSet:
+    """A set of 64-bit state fingerprints (hash compaction): a table with
+    open addressing in an array of 8-byte slots, at most half full. Two
+    states with the same fingerprint are taken to be the same; with n
+    states the probability that this happens is about n ** 2 / 2 ** 65."""
+
+    def __init__(self, capacity=1 << 16):
+        self.slots = array.array('Q', bytes(8 * capacity))
+        self.mask = capacity - 1
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, fingerprint):
+        """Add fingerprint; return whether it was new."""
+        fingerprint = fingerprint or 1  # 0 marks an empty slot
+        slots = self.slots
+        i = fingerprint & self.mask
+        while True:
+            slot = slots[i]
+            if slot == 0:
+                break
+            if slot == fingerprint:
+                return False
+            i = (i + 1) & self.mask
+        slots[i] = fingerprint
+        self.count += 1
+        if 2 * self.count > len(slots):
+            self.grow()
+        return True
+
+    def grow(self):
+        old = self.slots
+        self.slots = array.array('Q', bytes(16 * len(old)))
+        self.mask = len(self.slots) - 1
+        self.count = 0
+        for fingerprint in old:
+            if fingerprint:
+                self.add(fingerprint)
+
+    def omission_probability(self):
+        """The probability that some state was taken for another one."""
+        return min(1.0, self.count ** 2 / 2 ** 65)
+
+    def memory(self):
+        return len(self.slots) * 8
+
+
+class BitState:
+    """A Bloom filter of state fingerprints (bit-state hashing): each state
+    sets hashes bits of a bit array of the given size, so a state takes a
+    few bits, whatever the size of the state space. A state all of whose
+    bits are set already is taken to be visited, so some states may be
+    missed; omission_probability estimates the chance of that, per
+    state."""
+
+    def __init__(self, bits=1 << 27, hashes=3):
+        self.bits = bytearray(bits // 8)
+        self.size = len(self.bits) * 8
+        self.hashes = hashes
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, fingerprint):
+        """Add fingerprint; return whether some of its bits were unset."""
+        bits = self.bits
+        h1 = fingerprint & 0xFFFFFFFF
+        h2 = (fingerprint >> 32) | 1
+        new = False
+        for k in range(self.hashes):
+            i = (h1 + k * h2) % self.size
+            byte, bit = i >> 3, 1 << (i & 7)
+            if not bits[byte] & bit:
+                bits[byte] |= bit
+                new = True
+        self.count += new
+        return new
+
+    def omission_probability(self):
+        fill = 1 - (1 - 1 / self.size) ** (self.hashes * self.count)
+        return fill ** self.hashes
+
+    def memory(self):
+        return len(self.bits)
+
+
+def fingerprint(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          'little')
+
+
+class Expander:
+    """Computes the successors of encoded system states, for an alphabet
+    of events. It is the current runtime while it steps machines, so that
+    it is told about the machines that updates activate.
+
+    A system state is encoded as the marshalled tuple of the records of
+    its machines, each a marshalled (class name, args, kwargs, location
+    index, {variable index: value}); see checkpoint.state_values. The
+    records are sorted, so that states that differ only in the order in
+    which machines were created are the same. Machines are not created
+    anew for each state: an Expander keeps the instances it needs and
+    restores their state before each move."""
+
+    def __init__(self, alphabet):
+        self.alphabet = alphabet
+        self.instances = {}  # (class name, args, kwargs) -> machines
+        self.classes = {}  # class name -> class entry
+        self.spawned = []
+        self.fired = set()  # (class name, transition name)
+        self.locations = set()  # (class name, location name)
+        self.transitions = {}  # class name -> names of its transitions
+
+    def add(self, machine):
+        self.spawned.append(machine)
+
+    def encode(self, machines):
+        records = []
+        for m in machines:
+            entry = self.entry(m)
+            args, kwargs = m.init_args
+            loc, values = state_values(m, entry)
+            records.append(marshal.dumps((entry[0], args, kwargs, loc,
+                                          values)))
+        records.sort()
+        return marshal.dumps(tuple(records))
+
+    def entry(self, m):
+        class_name = f'{type(m).__module__}:{type(m).__qualname__}'
+        entry = self.classes.get(class_name)
+        if entry is None:
+            entry = self.classes[class_name] = class_entry(m)
+            self.transitions[class_name] = [
+                bound_trans['transition'].name
+                for bound_trans in m.structure.graph]
+        return entry
+
+    def restore(self, records):
+        """Return machines in the states that the decoded records give."""
+        machines = []
+        used = {}
+        for record in records:
+            class_name, args, kwargs, loc, _ = record
+            key = marshal.dumps((class_name, args, kwargs))
+            i = used.get(key, 0)
+            used[key] = i + 1
+            instances = self.instances.setdefault(key, [])
+            if i == len(instances):
+                instances.append(find_class(class_name)(*args, **kwargs))
+            m = instances[i]
+            self.restore_machine(m, record)
+            if loc >= 0:
+                self.locations.add((class_name, self.entry(m)[1][loc]))
+            machines.append(m)
+        return machines
+
+    def restore_machine(self, m, record):
+        # the values are decoded anew, as updates may change them in place
+        _, _, _, loc, values = marshal.loads(marshal.dumps(record))
+        restore_state(m, self.entry(m), loc, values)
+
+    def successors(self, data):
+        """Return the list of encoded successors of system state data, one
+        per move that executes a transition, and the list of errors raised
+        by updates. A move is an event of the alphabet, which is delivered
+        to all machines, or a transition without trigger of one machine."""
+        records = [marshal.loads(record) for record in marshal.loads(data)]
+        moves = [(event, None) for event in self.alphabet]
+        moves += [(None, i) for i in range(len(records))]
+        result = []
+        errors = []
+        machines = self.restore(records)
+        # only the machines that executed a transition need to be restored
+        # after a move, as guards do not change the state
+        changed = []
+        for event, target in moves:
+            for i in changed:
+                self.restore_machine(machines[i], records[i])
+            changed = []
+            self.spawned = []
+            token = current_runtime.set(self)
+            try:
+                fired = False
+                for i, m in enumerate(machines):
+                    if target is not None and i != target:
+                        continue
+                    outcome = m.fire(event)
+                    if outcome is not None:
+                        fired = True
+                        changed.append(i)
+                        self.fired.add((self.entry(m)[0],
+                                        outcome[0]['transition'].name))
+            except Exception as e:
+                errors.append((event, repr(e)))
+                changed = range(len(machines))
+                continue
+            finally:
+                current_runtime.reset(token)
+            if fired:
+                result.append(self.encode(machines + self.spawned))
+        return result, errors
+
+
+def expand(expander, states, max_machines):
+    """Expand a list of encoded states. Return the fingerprints and
+    encodings of their successors, the deadlocked states, the errors, the
+    number of moves and the number of successors left out because they
+    have more than max_machines machines."""
+    successors = {}
+    deadlocks = []
+    errors = []
+    moves = 0
+    pruned = 0
+    for data in states:
+        found, state_errors = expander.successors(data)
+        errors.extend((data, event, error) for event, error in state_errors)
+        if not found and not state_errors:
+            deadlocks.append(data)
+        moves += len(found)
+        for successor in found:
+            if (max_machines is not None
+                    and len(marshal.loads(successor)) > max_machines):
+                pruned += 1
+                continue
+            successors.setdefault(fingerprint(successor), successor)
+    return list(successors.items()), deadlocks, errors, moves, pruned
+
+
+# the Expander of a worker process
+worker_expander = None
+
+
+def init_worker(alphabet):
+    global worker_expander
+    worker_expander = Expander(alphabet)
+
+
+def expand_in_worker(states, max_machines):
+    result = expand(worker_expander, states, max_machines)
+    return result + (worker_expander.fired, worker_expander.locations,
+                     worker_expander.transitions, worker_expander.classes)
+
+
+class Report:
+    """The outcome of an exploration, see explore."""
+
+    def __init__(self):
+        self.states = 0  # distinct states visited
+        self.moves = 0  # moves that executed a transition
+        self.depth = 0  # of the breadth-first search
+        self.complete = True  # False if a bound left out states
+        self.deadlocks = []  # decoded states without moves
+        self.n_deadlocks = 0
+        self.errors = []  # (decoded state, event, repr of the exception)
+        self.unreachable_locations = {}  # class name -> location names
+        self.unfired_transitions = {}  # class name -> transition names
+        self.omission_probability = 0.0
+        self.visited_bytes = 0
+
+    def __str__(self):
+        lines = [f'{self.states} states, {self.moves} moves, depth '
+                 f'{self.depth}'
+                 f'{"" if self.complete else " (incomplete)"}',
+                 f'{self.n_deadlocks} deadlocks, {len(self.errors)} errors']
+        for class_name, names in self.unreachable_locations.items():
+            lines.append(f'unreachable in {class_name}: {", ".join(names)}')
+        for class_name, names in self.unfired_transitions.items():
+            lines.append(f'never fired in {class_name}: {", ".join(names)}')
+        return '\n'.join(lines)
+
+
+def decode(data, classes):
+    """Return a readable form of an encoded system state: per machine its
+    class name, arguments, location name and {variable name: value}."""
+    machines = []
+    for record in marshal.loads(data):
+        class_name, args, kwargs, loc, values = marshal.loads(record)
+        _, location_names, var_names = classes[class_name]
+        machines.append((class_name, args, kwargs,
+                         location_names[loc] if loc >= 0 else None,
+                         {var_names[i]: v for i, v in values.items()}))
+    return machines
+
+
+def explore(machines, alphabet, max_depth=None, max_states=None,
+            max_machines=None, processes=None, bitstate_bits=None,
+            max_reported=10):
+    """Explore breadth first the states that the system of machines can
+    reach through moves (see Expander.successors), starting from their
+    current states, and return a Report.
+
+    The visited states are kept as 64-bit fingerprints in a FingerprintSet,
+    or, if bitstate_bits is given, in a BitState of that many bits, which
+    may miss states but takes a fixed amount of memory. Only the frontier
+    of the search is kept in full, encoded. With processes set, each level
+    of the search is expanded in that many worker processes; the machine
+    classes must then be importable, as for ShardedExecutor.
+
+    The search stops at max_depth moves from the start, or at the first
+    level at which max_states states have been expanded, and does not go
+    into states with more than max_machines machines. Report.complete
+    tells whether no states were left out because of these bounds. Values
+    of data variables must be of builtin types (see checkpoint.py).
+    Containers that are equal but were built in a different order may be
+    encoded differently, which only costs duplicate states."""
+    report = Report()
+    visited = (FingerprintSet() if bitstate_bits is None
+               else BitState(bitstate_bits))
+    expander = Expander(alphabet)
+    start = expander.encode(machines)
+    visited.add(fingerprint(start))
+    frontier = [start]
+    fired = set()
+    locations = set()
+    transitions = {}
+    classes = dict(expander.classes)
+    pool = None
+    if processes:
+        pool = multiprocessing.Pool(processes, init_worker, (alphabet,))
+    try:
+        while frontier:
+            if (max_depth is not None and report.depth >= max_depth
+                    or max_states is not None
+                    and report.states >= max_states):
+                report.complete = False
+                break
+            if pool is None:
+                results = [expand(expander, frontier, max_machines)
+                           + (expander.fired, expander.locations,
+                              expander.transitions, expander.classes)]
+            else:
+                size = -(-len(frontier) // (4 * processes))
+                chunks = [frontier[i:i + size]
+                          for i in range(0, len(frontier), size)]
+                results = pool.starmap(expand_in_worker,
+                                       [(chunk, max_machines)
+                                        for chunk in chunks])
+            report.states += len(frontier)
+            frontier = []
+            for (successors, deadlocks, errors, moves, pruned, worker_fired,
+                 worker_locations, worker_transitions,
+                 worker_classes) in results:
+                if pruned:
+                    report.complete = False
+                fired |= worker_fired
+                locations |= worker_locations
+                transitions.update(worker_transitions)
+                classes.update(worker_classes)
+                report.moves += moves
+                report.n_deadlocks += len(deadlocks)
+                for data in deadlocks[:max_reported - len(report.deadlocks)]:
+                    report.deadlocks.append(decode(data, classes))
+                for data, event, error in errors:
+                    if len(report.errors) < max_reported:
+                        report.errors.append((decode(data, classes), event,
+                                              error))
+                for fp, data in successors:
+                    if visited.add(fp):
+                        frontier.append(data)
+            if frontier:
+                report.depth += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    for class_name, (_, location_names, _) in classes.items():
+        missing = [name for name in location_names
+                   if (class_name, name) not in locations]
+        if missing:
+            report.unreachable_locations[class_name] = missing
+    for class_name, names in transitions.items():
+        missing = [name for name in dict.fromkeys(names)
+                   if (class_name, name) not in fired]
+        if missing:
+            report.unfired_transitions[class_name] = missing
+    report.omission_probability = visited.omission_probability()
+    report.visited_bytes = visited.memory()
+    return report
+
+
+class TestExplore(unittest.TestCase):
+
+    def test_fingerprint_set(self):
+        visited = FingerprintSet(capacity=4)
+        for fp in range(100):
+            self.assertTrue(visited.add(fp * 7919))
+        self.assertFalse(visited.add(7919))
+        self.assertFalse(visited.add(0))
+        self.assertEqual(len(visited), 100)
+        self.assertEqual(visited.memory(), 256 * 8)
+
+    def test_bitstate(self):
+        visited = BitState(bits=1 << 16)
+        new = sum(visited.add(fingerprint(bytes([i, j])))
+                  for i in range(100) for j in range(10))
+        self.assertGreater(new, 990)
+        self.assertFalse(visited.add(fingerprint(bytes([0, 0]))))
+        self.assertLess(visited.omission_probability(), 0.01)
+
+    def test_task_control(self):
+        from task_control import TaskControl
+        alphabet = [{'command': 'Start', 'arg': 1},
+                    {'command': 'Stop', 'arg': 1},
+                    {'command': 'Stop', 'arg': 2}]
+        # Stop sets the int task_id to None, which prints a type error
+        with contextlib.redirect_stdout(io.StringIO()):
+            report = explore([TaskControl()], alphabet, max_machines=3)
+            parallel = explore([TaskControl()], alphabet, max_machines=3,
+                               processes=2)
+            bitstate = explore([TaskControl()], alphabet, max_machines=3,
+                               bitstate_bits=1 << 20)
+        # states with a third ReadyCompleted are left out
+        self.assertFalse(report.complete)
+        self.assertEqual((report.states, report.moves), (19, 39))
+        self.assertEqual(report.errors, [])
+        self.assertEqual(report.n_deadlocks, 0)
+        self.assertEqual(report.unreachable_locations, {})
+        self.assertEqual(report.unfired_transitions, {})
+        self.assertEqual((parallel.states, parallel.moves), (19, 39))
+        self.assertLessEqual(bitstate.states, 19)
+
+    def test_check(self):
+        from statemachine import TestStateMachine
+        m = TestStateMachine.Task()
+        report = m.check([{'command': 'Start', 'arg': 5},
+                          {'command': 'Stop'}])
+        # count grows by 5 per Start: 0, 5, then 10 leads to done, where
+        # nothing is enabled
+        self.assertTrue(report.complete)
+        self.assertEqual(report.n_deadlocks, 1)
+        self.assertEqual(report.deadlocks[0][0][3], 'done')
+        self.assertEqual(report.unfired_transitions, {})
+        report = m.check([{'command': 'Stop'}])
+        self.assertEqual(report.states, 1)
+        self.assertEqual(report.n_deadlocks, 1)
+        self.assertEqual(list(report.unreachable_locations.values()),
+                         [['on', 'done']])
+        self.assertEqual(list(report.unfired_transitions.values()),
+                         [['start', 'stop', 'finish']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,234 @@
+"""Opt-in instrumentation of StateMachines: counts and latency histograms
+per transition and per trigger pattern."""
+
+import json
+import unittest
+
+from statemachine import Transition
+
+
+class Histogram:
+    """A histogram of non-negative integers (latencies in ns), with buckets
+    in the style of HdrHistogram: each power of two is divided into
+    2 ** sub_bucket_bits buckets of equal width, so the relative error of
+    a reported value is at most 2 ** -sub_bucket_bits, whatever its
+    magnitude. Values below 2 ** (sub_bucket_bits + 1) are counted
+    exactly. Buckets are kept in a dict, so only those that are used take
+    space."""
+
+    def __init__(self, sub_bucket_bits=5):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_buckets = 1 << sub_bucket_bits
+        self.buckets = {}  # bucket index -> count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        n = self.sub_buckets
+        if value < 2 * n:
+            i = value
+        else:
+            shift = value.bit_length() - self.sub_bucket_bits - 1
+            i = (shift + 1) * n + (value >> shift) - n
+        self.buckets[i] = self.buckets.get(i, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def bucket_range(self, i):
+        """Return the lowest and highest value that go into bucket i."""
+        n = self.sub_buckets
+        if i < 2 * n:
+            return i, i
+        shift = i // n - 1
+        sub = i % n + n
+        return sub << shift, ((sub + 1) << shift) - 1
+
+    def percentile(self, p):
+        """Return the highest value of the bucket that holds the p-th
+        percentile, or None if nothing was recorded."""
+        if not self.count:
+            return None
+        rank = max(1, -(-self.count * p // 100))  # ceil
+        seen = 0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen >= rank:
+                return min(self.bucket_range(i)[1], self.max)
+
+    def to_dict(self):
+        return {'count': self.count,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'p999': self.percentile(99.9),
+                'buckets': [[self.bucket_range(i)[0], self.buckets[i]]
+                            for i in sorted(self.buckets)]}
+
+
+class TransitionStats:
+    """Per transition: how often its trigger matched (or, for a transition
+    without trigger, it was tried), how often its condition rejected it
+    and how often it fired, with the latencies of its phases."""
+    __slots__ = ('matches', 'rejections', 'firings', 'guard', 'update',
+                 'response')
+
+    def __init__(self):
+        self.matches = 0
+        self.rejections = 0
+        self.firings = 0
+        self.guard = Histogram()
+        self.update = Histogram()
+        self.response = Histogram()
+
+    def to_dict(self):
+        return {'matches': self.matches,
+                'rejections': self.rejections,
+                'firings': self.firings,
+                'guard_ns': self.guard.to_dict(),
+                'update_ns': self.update.to_dict(),
+                'response_ns': self.response.to_dict()}
+
+
+class PatternStats:
+    """Per trigger pattern: how often it was tried and did or did not match,
+    with the latency of matching. Patterns that the index of a location
+    rules out are not tried, and are not counted."""
+    __slots__ = ('matches', 'misses', 'match')
+
+    def __init__(self):
+        self.matches = 0
+        self.misses = 0
+        self.match = Histogram()
+
+    def to_dict(self):
+        return {'matches': self.matches,
+                'misses': self.misses,
+                'match_ns': self.match.to_dict()}
+
+
+class Instrumentation:
+    """Collects statistics of the StateMachines it is given to, see
+    StateMachine.instrument. Transitions are identified by the name of the
+    machine class and the transition, e.g. 'Acc.add_money', and patterns
+    by the edge of the structure they trigger: the transition with its
+    source and target locations, followed by the pattern, e.g.
+    "Acc.reset A1->A1 {'command': 'reconcile'}". So the instances of a
+    class are counted together, but transitions whose triggers look the
+    same are not."""
+
+    def __init__(self):
+        self.transitions = {}  # key -> TransitionStats
+        self.patterns = {}  # key -> PatternStats
+
+    def transition(self, machine, bound_trans):
+        key = bound_trans.get('stats_key')
+        if key is None:
+            key = bound_trans['stats_key'] = \
+                f'{type(machine).__name__}.{bound_trans["transition"].name}'
+        stats = self.transitions.get(key)
+        if stats is None:
+            stats = self.transitions[key] = TransitionStats()
+        return stats
+
+    def pattern(self, machine, bound_trans):
+        key = bound_trans.get('pattern_key')
+        if key is None:
+            trans = bound_trans['transition']
+            key = bound_trans['pattern_key'] = (
+                f'{type(machine).__name__}.{trans.name} '
+                f'{bound_trans["source"].name}->{bound_trans["target"].name}'
+                f' {trans.trigger}')
+        stats = self.patterns.get(key)
+        if stats is None:
+            stats = self.patterns[key] = PatternStats()
+        return stats
+
+    def snapshot(self):
+        """Return the statistics as a dict of builtin values."""
+        return {'transitions': {key: stats.to_dict() for key, stats
+                                in self.transitions.items()},
+                'patterns': {key: stats.to_dict() for key, stats
+                             in self.patterns.items()}}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def reset(self):
+        self.transitions = {}
+        self.patterns = {}
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_histogram(self):
+        h = Histogram(sub_bucket_bits=3)
+        for value in range(1000):
+            h.record(value)
+        self.assertEqual(h.count, 1000)
+        self.assertEqual((h.min, h.max), (0, 999))
+        self.assertEqual(h.percentile(1), 9)  # exact below 16
+        for p in (50, 90, 99):
+            self.assertAlmostEqual(h.percentile(p) / (p * 10), 1, delta=1 / 8)
+        self.assertEqual(h.percentile(100), 999)
+        # bucket ranges cover the values without gaps
+        ranges = [h.bucket_range(i) for i in range(200)]
+        for (_, high), (low, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(low, high + 1)
+        self.assertIsNone(Histogram().percentile(50))
+
+    def test_bank(self):
+        from bank import Acc
+        instrumentation = Instrumentation()
+        m = Acc('acc1', 10)
+        m.instrument(instrumentation)
+        for a in (50, 50, 1):
+            m.step({'name': 'transfer', 'arg1': 'acc1', 'arg2': a})
+        m.step({'name': 'transfer', 'arg1': 'acc2', 'arg2': 5})
+        m.step({'command': 'reconcile'})
+        m.step({'command': 'unknown'})
+        snapshot = json.loads(instrumentation.to_json())
+        add_money = snapshot['transitions']['Acc.add_money']
+        self.assertEqual((add_money['matches'], add_money['rejections'],
+                          add_money['firings']), (4, 2, 2))
+        self.assertEqual(add_money['guard_ns']['count'], 4)
+        self.assertEqual(add_money['update_ns']['count'], 2)
+        reset = snapshot['transitions']['Acc.reset']
+        self.assertEqual(reset['firings'], 1)
+        self.assertEqual(sum(p['matches'] for p
+                             in snapshot['patterns'].values()), 5)
+        self.assertEqual(m.state.total, 0)
+        m.instrument(None)
+        m.step({'command': 'reconcile'})
+        self.assertEqual(instrumentation.transitions['Acc.reset'].firings, 1)
+
+    def test_same_trigger(self):
+        from statemachine import TestStateMachine
+        instrumentation = Instrumentation()
+        m = TestStateMachine.Task()
+        with Transition(m, 'halt', m.off, m.done) as t:
+            t.trigger = {'command': 'Stop'}  # prints the same as stop's
+        m.instrument(instrumentation)
+        m.step({'command': 'Stop'})  # halt from off
+        m2 = TestStateMachine.Task()
+        m2.instrument(instrumentation)
+        m2.step({'command': 'Start', 'arg': 1})
+        m2.step({'command': 'Stop'})  # stop from on
+        keys = sorted(key for key in instrumentation.patterns
+                      if 'Stop' in key)
+        self.assertEqual([key.split(' {')[0] for key in keys],
+                         ['Task.halt off->done', 'Task.stop on->off'])
+        self.assertEqual([instrumentation.patterns[key].matches
+                          for key in keys], [1, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,448 @@
+"""An append-only journal of the events delivered to StateMachines, which
+can be replayed to rebuild their states."""
+
+import contextlib
+import io
+import marshal
+import mmap
+import os
+import struct
+import tempfile
+import unittest
+
+from statemachine import StateMachine, current_runtime
+from checkpoint import Checkpointer, Snapshot, find_class
+
+MAGIC = b'SMJRNL02'
+INDEX_ENTRY = struct.Struct('<QQQ')  # offset, number of records, machines
+HEADER = struct.Struct('<IBI')  # size of the payload, kind, machine number
+
+# kinds of records
+SPAWN, STEP, AGAIN, RESPONSE = range(4)
+MISSED = 0x80  # flag of a STEP or AGAIN that executed no transition
+NO_EVENT = marshal.dumps(None)
+
+
+class Journal:
+    """Records the steps of the machines that it is given to (see
+    StateMachine.record) in the file at path.
+
+    A record is a HEADER (size of the payload, kind, machine number) and a
+    payload of marshalled values, which must be of builtin types. Machines
+    are numbered in the order in which they are activated or first
+    stepped, and each gets a SPAWN record of (class name, args, kwargs),
+    see StateMachine.init_args. A step gets a STEP record of its event,
+    or an AGAIN record without payload if the event marshals to the same
+    bytes as the last one in a STEP record, as in a broadcast. The record
+    of a step is written before anything that its update records, such
+    as spawns, and otherwise once the step is done: then a step that
+    executed no transition is flagged MISSED, since it changed nothing,
+    and a step without event is not recorded at all. A non-empty
+    response gets a RESPONSE record.
+
+    Every index_interval records, between steps, an index point is made:
+    a checkpoint of all machines in path.K, where K is the number of the
+    index point, and an entry (offset, number of records, number of
+    machines) in path.index. A Replay can start from there.
+
+    Writes are buffered; flush or close the journal to write them out.
+    Changes to the state of a machine made outside of a step are not
+    recorded."""
+
+    def __init__(self, path, index_interval=1_000_000, buffer_size=1 << 20):
+        self.path = path
+        self.index_interval = index_interval
+        self.file = open(path, 'wb', buffering=buffer_size)
+        self.file.write(MAGIC)
+        self.index_file = open(path + '.index', 'wb')
+        self.n_index_points = 0
+        self.numbers = {}  # machine -> number
+        self.machines = []
+        self.class_names = {}  # machine class -> name, see find_class
+        self.records = 0
+        self.next_index = index_interval
+        self.depth = 0  # number of steps in progress
+        self.pending = None  # (kind, number, payload) of a step, not written
+        self.last_event = None  # marshalled event of the last STEP record
+
+    def step(self, m, event):
+        """Step m with event, and record that."""
+        number = self.number(m)
+        if self.pending is not None:
+            self.write_pending()  # a step inside a step
+        if event is None:
+            pending = (STEP, number, NO_EVENT)
+        else:
+            # by content, since a caller may reuse an event object
+            data = marshal.dumps(event)
+            if data == self.last_event:
+                pending = (AGAIN, number, b'')
+            else:
+                self.last_event = data
+                pending = (STEP, number, data)
+        self.pending = pending
+        fired = None
+        failed = True
+        self.depth += 1
+        try:
+            fired = m.fire(event, instrumentation=m.instrumentation)
+            failed = False
+        finally:
+            self.depth -= 1
+            if self.pending is pending:
+                # nothing was recorded during the step
+                if fired is not None or failed:
+                    self.write_pending()
+                elif event is None:
+                    self.pending = None
+                else:
+                    self.write_pending(MISSED)
+        response = None if fired is None else fired[1]
+        if response:
+            self.write(RESPONSE, number, marshal.dumps(response))
+        if not self.depth and self.records >= self.next_index:
+            self.index_point()
+        return response
+
+    def spawned(self, m):
+        """Record that m is activated, unless it has a number already."""
+        self.number(m)
+
+    def number(self, m):
+        number = self.numbers.get(m)
+        if number is None:
+            number = self.numbers[m] = len(self.machines)
+            self.machines.append(m)
+            cls = type(m)
+            name = self.class_names.get(cls)
+            if name is None:
+                name = self.class_names[cls] = \
+                    f'{cls.__module__}:{cls.__qualname__}'
+            args, kwargs = m.init_args
+            self.write(SPAWN, number, marshal.dumps((name, args, kwargs)))
+        return number
+
+    def write(self, kind, number, payload=b''):
+        if self.pending is not None:
+            self.write_pending()
+        self.file.write(HEADER.pack(len(payload), kind, number) + payload)
+        self.records += 1
+
+    def write_pending(self, flag=0):
+        (kind, number, payload), self.pending = self.pending, None
+        self.write(kind | flag, number, payload)
+
+    def index_point(self):
+        """Write a checkpoint of all machines, and an index entry that
+        points to the current end of the journal."""
+        self.next_index = self.records + self.index_interval
+        # a Replay that starts here does not know the last event
+        self.last_event = None
+        checkpointer = Checkpointer(f'{self.path}.{self.n_index_points}')
+        checkpointer.checkpoint(self.machines)
+        checkpointer.close()
+        self.file.flush()
+        self.index_file.write(INDEX_ENTRY.pack(
+            self.file.tell(), self.records, len(self.machines)))
+        self.index_file.flush()
+        self.n_index_points += 1
+
+    def flush(self):
+        self.file.flush()
+        self.index_file.flush()
+
+    def close(self):
+        self.file.close()
+        self.index_file.close()
+
+
+class Replay:
+    """Replays the journal at path, to rebuild the states of its machines.
+
+    The journal is memory-mapped and its records are executed in order:
+    a spawn creates the machine, unless its number was taken already by a
+    machine that an update activated (the Replay is the current runtime
+    while it runs), and a step calls fire on the machine, so that nothing
+    is instrumented or recorded, and responses are not even computed.
+    Steps flagged MISSED are skipped, and their events are only decoded
+    if an AGAIN record needs them. So replay does less than the recorded
+    run did, e.g. it does not step the KickOff of the bank for transfers
+    to existing accounts. With check_responses, each recorded response is
+    compared with the replayed one of the same machine, which may have
+    been replayed before nested steps, and the differences are collected
+    in mismatches. An exception in a step is printed, as by a runtime.
+
+    If index_point is given (a negative number counts from the last one),
+    the machines are loaded lazily from its checkpoint, and replay starts
+    there. A torn record at the end of the journal, left by a crash, is
+    ignored. The machines are self[number]."""
+
+    def __init__(self, path, index_point=None, check_responses=False):
+        self.file = open(path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a journal')
+        self.view = memoryview(self.mmap)
+        self.pos = len(MAGIC)
+        self.records = 0  # number of records replayed, or skipped
+        self.snapshot = None
+        self.base = 0  # number of machines in the snapshot
+        if index_point is not None:
+            entries = index_points(path)
+            if index_point < 0:
+                index_point += len(entries)
+            self.pos, self.records, self.base = entries[index_point]
+            self.snapshot = Snapshot(f'{path}.{index_point}')
+        self.machines = []  # the machines numbered from base on
+        self.numbers = {}  # machine -> number
+        self.check_responses = check_responses
+        self.mismatches = []  # (record, number, recorded, replayed)
+        self.last_event = None  # decoded, or None if only in last_payload
+        self.last_payload = None  # (start, end) of the last STEP event
+        self.responses = {}  # number -> replayed response, to compare
+        self.steps = 0
+
+    def __len__(self):
+        return self.base + len(self.machines)
+
+    def __getitem__(self, number):
+        if not 0 <= number < len(self):
+            raise IndexError(number)
+        if number >= self.base:
+            return self.machines[number - self.base]
+        m = self.snapshot[number]
+        self.numbers[m] = number
+        return m
+
+    def __iter__(self):
+        for number in range(len(self)):
+            yield self[number]
+
+    def add(self, machine):
+        """Number machine, which was activated by an update."""
+        if machine not in self.numbers:
+            self.numbers[machine] = len(self)
+            self.machines.append(machine)
+
+    def run(self, max_steps=None):
+        """Replay the rest of the journal, or only up to max_steps steps.
+        Return the number of steps replayed."""
+        view = self.view
+        end = len(view)
+        pos = self.pos
+        loads = marshal.loads
+        unpack_header = HEADER.unpack_from
+        header_size = HEADER.size
+        check = self.check_responses
+        steps = 0
+        records = self.records
+        token = current_runtime.set(self)
+        try:
+            while pos + header_size <= end and steps != max_steps:
+                size, kind, number = unpack_header(view, pos)
+                start = pos + header_size
+                if start + size > end:
+                    break  # torn record
+                pos = start + size
+                records += 1
+                if kind == STEP | MISSED:
+                    self.last_event = None
+                    self.last_payload = (start, pos)
+                elif kind == STEP or kind == AGAIN:
+                    if kind == STEP:
+                        event = loads(view[start:pos])
+                        if event is not None:
+                            self.last_event = event
+                            self.last_payload = (start, pos)
+                    else:
+                        event = self.last_event
+                        if event is None:
+                            event = self.last_event = loads(
+                                view[slice(*self.last_payload)])
+                    m = self[number]
+                    steps += 1
+                    try:
+                        fired = m.fire(event, check)
+                    except Exception as e:
+                        print(f'error: {m} failed on event {event}: {e!r}')
+                        fired = None
+                    if check and fired is not None and fired[1]:
+                        self.responses[number] = fired[1]
+                elif kind == SPAWN:
+                    self.spawn(number, *loads(view[start:pos]))
+                elif kind == RESPONSE and check:
+                    response = loads(view[start:pos])
+                    replayed = self.responses.pop(number, None)
+                    if replayed != response:
+                        self.mismatches.append(
+                            (records - 1, number, response, replayed))
+        finally:
+            current_runtime.reset(token)
+            self.pos = pos
+            self.records = records
+            self.steps += steps
+        return steps
+
+    def spawn(self, number, class_name, args, kwargs):
+        if number < len(self):
+            return  # activated by the update of the step before
+        if number > len(self):
+            raise ValueError(f'machine {number} is spawned, but there are '
+                             f'{len(self)} machines')
+        m = find_class(class_name)(*args, **kwargs)
+        self.numbers[m] = number
+        self.machines.append(m)
+
+    def close(self):
+        self.view.release()
+        self.mmap.close()
+        self.file.close()
+        if self.snapshot is not None:
+            self.snapshot.close()
+
+
+def index_points(path):
+    """Return the entries of the index of the journal at path: per index
+    point (offset, number of records, number of machines)."""
+    try:
+        with open(path + '.index', 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    n = len(data) // INDEX_ENTRY.size  # ignore a torn entry
+    return [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size)
+            for i in range(n)]
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'events.journal')
+
+    def tearDown(self):
+        StateMachine.journal = None
+        self.dir.cleanup()
+
+    def run_worker(self, machine_key, spawns, events, index_interval=10):
+        """Record the steps of a ShardWorker that runs spawns and events.
+        Return its machines and responses."""
+        from shard import ShardWorker
+        journal = Journal(self.path, index_interval)
+        StateMachine.journal = journal
+        worker = ShardWorker(0, 1, machine_key)
+        token = current_runtime.set(worker)
+        try:
+            responses, _ = worker.run_batch(spawns, events)
+        finally:
+            current_runtime.reset(token)
+            StateMachine.journal = None
+            journal.close()
+        return [m for m, _ in worker.entries()], responses
+
+    def test_bank(self):
+        from bank import KickOff
+        from shard import account_key, transfer_key
+        events = []
+        for seq in range(1, 41):
+            event = {'name': 'transfer', 'arg1': f'acc{seq % 7}',
+                     'arg2': seq}
+            events.append((seq, transfer_key(event), event))
+        events.append((41, None, {'command': 'reconcile'}))
+        events += events[:20]
+        machines, _ = self.run_worker(account_key, [(0, KickOff, (), {})],
+                                      events)
+
+        def balances(machines):
+            return sorted((m.init_args[0], m.state._bindings.get(
+                m.state._vars.get('total'))) for m in machines)
+        expected = balances(machines)
+        self.assertEqual(len(expected), 8)
+        self.assertGreater(len(index_points(self.path)), 3)
+
+        replay = Replay(self.path)
+        self.assertEqual(replay.run(10), 10)
+        replay.run()
+        self.assertEqual(balances(replay), expected)
+        self.assertEqual(replay.run(), 0)
+        steps = replay.steps
+        # the steps that executed no transition, such as those of the
+        # KickOff for existing accounts, are skipped
+        self.assertLess(steps, replay.records - len(machines))
+        replay.close()
+
+        for index_point in (0, -1):
+            replay = Replay(self.path, index_point=index_point)
+            replay.run()
+            self.assertEqual(balances(replay), expected)
+            self.assertLess(replay.steps, steps)
+            replay.close()
+
+    def test_index_point_in_broadcast(self):
+        from bank import Acc
+        journal = Journal(self.path, index_interval=3)
+        StateMachine.journal = journal
+        accounts = [Acc(f'acc{i}', 10) for i in range(4)]
+        reconcile = {'command': 'reconcile'}
+        for m in accounts:
+            m.step(reconcile)
+        StateMachine.journal = None
+        journal.close()
+        self.assertEqual([m.state.total for m in accounts], [0] * 4)
+        self.assertGreater(len(index_points(self.path)), 1)
+        for index_point in range(len(index_points(self.path))):
+            replay = Replay(self.path, index_point=index_point)
+            replay.run()
+            self.assertEqual([m.state.total for m in replay], [0] * 4)
+            replay.close()
+
+    def test_reused_event(self):
+        from bank import Acc
+        journal = Journal(self.path)
+        m = Acc('acc1', 0)
+        m.record(journal)
+        event = {'name': 'transfer', 'arg1': 'acc1', 'arg2': 0}
+        for a in (1, 2, 3, 3):
+            event['arg2'] = a
+            m.step(event)
+        journal.close()
+        self.assertEqual(m.state.total, 9)
+        replay = Replay(self.path)
+        replay.run()
+        self.assertEqual(replay[0].state.total, 9)
+        replay.close()
+
+    def test_responses(self):
+        from task_control import TaskControl
+        events = [(1, None, {'command': 'Start', 'arg': 1}),
+                  (2, None, {'command': 'Stop', 'arg': 1}),
+                  (3, None, {'command': 'Start', 'arg': 2})]
+        with contextlib.redirect_stdout(io.StringIO()):  # Stop: type error
+            machines, responses = self.run_worker(
+                lambda cls, args, kwargs: None, [(0, TaskControl, (), {})],
+                events)
+        self.assertEqual(len(responses), 7)
+        replay = Replay(self.path, check_responses=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            replay.run()
+        self.assertEqual(replay.mismatches, [])
+        self.assertEqual([type(m).__name__ for m in replay],
+                         [type(m).__name__ for m in machines])
+        self.assertIs(replay[1].state.loc, replay[1].completed)
+        records = replay.records
+        replay.close()
+
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(size - 3)  # torn last record
+        replay = Replay(self.path, check_responses=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            replay.run()
+        self.assertEqual(replay.mismatches, [])
+        self.assertEqual(replay.records, records - 1)
+        self.assertLess(replay.pos, replay.view.nbytes)
+        replay.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,29 @@
+import array
+import itertools
+import json
+import operator
+import re
+import sys
+import types
+import typing
 import unittest
+import weakref
+from collections import OrderedDict
+from collections.abc import (Collection, Iterable, Mapping, Sequence,
+                             Set as AbstractSet)
+from functools import partial
+from json.decoder import scanstring
 
 
 class Var:
-    """A placeholder for a value of the specified type."""
+    """A placeholder for a value of the specified type. The type may be
+    parameterized, e.g. list[int] or Optional[dict[str, float]]; see
+    type_check, also for sample."""
 
-    def __init__(self, typ=object):
+    def __init__(self, typ=object, sample=None):
         self.typ = typ
+        self.sample = sample
+        self.check = type_check(typ, sample)  # None: use isinstance
         self.name = None
 
     def __repr__(self):
@@ -15,8 +33,8 @@ class Var:
 
     def __str__(self):
         if self.name is None:
-            return f'{self.__class__.__name__}({self.typ.__name__})'
-        return f'{self.__class__.__name__}({self.name}:{self.typ.__name__})'
+            return f'{self.__class__.__name__}({type_name(self.typ)})'
+        return f'{self.__class__.__name__}({self.name}:{type_name(self.typ)})'
         #return f'{m.__class__}({self.typ})'
 
     def __gt__(self, other):
@@ -32,23 +50,330 @@ class Var:
     def __hash__(self):
         return id(self)
 
+    def accepts(self, value):
+        """Return whether value is of the type of this Var."""
+        if self.check is None:
+            return isinstance(value, self.typ)
+        return self.check(value)
+
     def subst(self, bindings):
-        if self in bindings and isinstance(bindings[self], self.typ):
+        if self in bindings and self.accepts(bindings[self]):
             return bindings[self]
         return self  # no binding for var, or type mismatch
 
     def match(self, ground_val, current_bindings):
-        if not isinstance(ground_val, self.typ):
-            raise MatchException
+        """Bind ground_val, or check it against the existing binding.
+        Return whether this succeeded."""
+        if self.check is None:
+            if not isinstance(ground_val, self.typ):
+                return False
+        elif not self.check(ground_val):
+            return False
         if self not in current_bindings:
             current_bindings[self] = ground_val
-        elif current_bindings[self] == ground_val:
-            return
-        else:
-            raise MatchException
+            return True
+        return current_bindings[self] == ground_val
+
+
+class Rest(Var):
+    """A segment variable: in a list pattern, a Rest stands for any number
+    of consecutive elements, each of type typ. It is bound to a ListView of
+    that part of the matched list, so the list is not copied. A list
+    pattern may contain at most one Rest, so that a list is matched in time
+    linear in its length, without backtracking (in constant time for the
+    Rest itself if typ is object). A Rest may only occur as an element of
+    a list. Substituting a bound Rest splices its elements into the list.
+    The elements are checked in bulk, see elements_check."""
+
+    def __init__(self, typ=object, sample=None):
+        super().__init__(typ, sample)
+        self.check = (None if typ is object
+                      else elements_check(typ, sample))
+
+    def subst(self, bindings):
+        value = bindings.get(self, self)
+        if isinstance(value, (list, ListView)):
+            return value
+        return self
+
+    def match(self, ground_val, current_bindings):
+        if not isinstance(ground_val, ListView):
+            raise ValueError('a Rest may only occur as an element of a list')
+        if self.check is not None and not self.check(ground_val):
+            return False
+        if self not in current_bindings:
+            current_bindings[self] = ground_val
+            return True
+        return current_bindings[self] == ground_val
+
+    @staticmethod
+    def position(lst):
+        """Return the index of the Rest in list pattern lst, or None."""
+        position = None
+        for i, el in enumerate(lst):
+            if isinstance(el, Rest):
+                if position is not None:
+                    raise ValueError('a list pattern may contain at most '
+                                     'one Rest')
+                position = i
+        return position
+
+    @staticmethod
+    def splice(bindings, rest):
+        """Return the elements to put in place of rest by substitution."""
+        value = rest.subst(bindings)
+        return (rest,) if value is rest else value
+
+
+class ListView(Sequence):
+    """A read-only view of base[start:stop], for a list base, made without
+    copying. It compares equal to lists and ListViews with equal elements.
+    Since it shares base, it shows later changes of base; use tolist for a
+    copy."""
+    __slots__ = ('base', 'start', 'stop')
+
+    def __init__(self, base, start, stop):
+        self.base = base
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step == 1:
+                return ListView(self.base, self.start + start,
+                                self.start + max(start, stop))
+            return self.tolist()[i]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('ListView index out of range')
+        return self.base[self.start + i]
+
+    def __iter__(self):
+        return itertools.islice(self.base, self.start, self.stop)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, ListView)):
+            return (len(self) == len(other)
+                    and all(map(operator.eq, self, other)))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'ListView({self.tolist()!r})'
+
+    def tolist(self):
+        return self.base[self.start:self.stop]
+
+
+def type_name(typ):
+    """Return typ as it is written in Python, e.g. int or list[int]."""
+    if isinstance(typ, type) and typing.get_origin(typ) is None:
+        return typ.__name__
+    return repr(typ).replace('typing.', '')
+
+
+# typecodes of array.array and kinds of NumPy dtypes whose elements are, as
+# Python values, instances of the key
+ARRAY_TYPECODES = {int: frozenset('bBhHiIlLqQ'), float: frozenset('fd')}
+DTYPE_KINDS = {int: frozenset('iu'), float: frozenset('f'),
+               bool: frozenset('b')}
+MAPPINGS = (dict, Mapping)
+COLLECTIONS = (list, set, frozenset, tuple, Sequence, Collection, Iterable,
+               AbstractSet)
+
+
+def type_check(typ, sample=None):
+    """Return a function that tells whether a value is of type typ, or None
+    if isinstance(value, typ) tells that. Besides classes and unions of
+    classes, typ may be a parameterized collection type such as list[int],
+    dict[str, float] or tuple[int, ...], a union of such types, such as
+    Optional[list[str]], or typing.Any. Of other parameterized types only
+    the origin is checked.
+
+    The elements of a collection are checked in bulk, see elements_check.
+    With sample set, at most that many elements of each collection are
+    checked, spread evenly over it if it is a sequence."""
+    origin = typing.get_origin(typ)
+    if origin is None:
+        if typ is typing.Any:
+            return lambda value: True
+        return None
+    args = typing.get_args(typ)
+    if origin is typing.Union or origin is types.UnionType:
+        checks = [type_check(arg, sample) for arg in args]
+        classes = tuple(arg for arg, check in zip(args, checks)
+                        if check is None)
+        checks = [check for check in checks if check is not None]
+        if not checks:
+            return None
+
+        def check_union(value):
+            return (isinstance(value, classes)
+                    or any(check(value) for check in checks))
+        return check_union
+    if origin is tuple and args[-1:] != (Ellipsis,):
+        checks = [type_check(arg, sample) or partial(isinstance_of, arg)
+                  for arg in args]
+
+        def check_tuple(value):
+            return (isinstance(value, tuple) and len(value) == len(checks)
+                    and all(check(el) for check, el in zip(checks, value)))
+        return check_tuple
+    if origin in MAPPINGS and len(args) == 2:
+        keys_ok = elements_check(args[0], sample)
+        values_ok = elements_check(args[1], sample)
+
+        def check_mapping(value):
+            return (isinstance(value, origin) and keys_ok(value.keys())
+                    and values_ok(value.values()))
+        return check_mapping
+    if origin in COLLECTIONS and args:
+        elements_ok = elements_check(args[0], sample)
+        # NumPy arrays are not registered as Sequences
+        numpy_ok = origin is not list and origin is not tuple
 
+        def check_collection(value):
+            if isinstance(value, origin):
+                return elements_ok(value)
+            return (numpy_ok and getattr(value, 'ndim', None) == 1
+                    and elements_ok(value))
+        return check_collection
+    return lambda value: isinstance(value, origin)
 
-class BinaryExpr:
+
+def isinstance_of(typ, value):
+    return isinstance(value, typ)
+
+
+def elements_check(typ, sample=None):
+    """Return a function that tells whether all elements of a collection
+    are of type typ. For a class, the set of the types of the elements is
+    computed, which runs at C speed, and each type in it is checked once.
+    The typecode of an array.array, and the dtype of a NumPy array, tell
+    the types of its elements without looking at them."""
+    if typ is object or typ is typing.Any:
+        return lambda values: True
+    check = type_check(typ, sample)
+    typecodes = ARRAY_TYPECODES.get(typ, ())
+    kinds = DTYPE_KINDS.get(typ, ())
+
+    def check_all(values):
+        dtype = getattr(values, 'dtype', None)
+        if dtype is not None:
+            if dtype.kind in kinds:
+                return True
+            values = values.tolist()
+        elif getattr(values, 'typecode', None) in typecodes:
+            return True
+        values = sampled(values, sample)
+        if check is not None:
+            return all(map(check, values))
+        return all(issubclass(t, typ) for t in set(map(type, values)))
+    return check_all
+
+
+def sampled(values, sample):
+    """Return at most sample of values, evenly spread if values is a
+    sequence, or values itself if sample is None."""
+    if sample is None or len(values) <= sample:
+        return values
+    if isinstance(values, Sequence):
+        step = len(values) // sample
+        return map(values.__getitem__, range(0, step * sample, step))
+    return itertools.islice(values, sample)
+
+
+class Expr:
+    """Expression over Vars, such as the condition of a transition.
+
+    Expressions are built by the comparison operators of Var, and combined
+    with & (and), | (or) and ~ (not); these are evaluated with short
+    circuiting. Python does not allow overloading 'in', so membership tests
+    are built explicitly, as in BinaryExpr('not in', x, s). An expression
+    is evaluated with respect to a binding, i.e. a dict that maps Vars to
+    values; every Var in the expression must be bound. Method compile
+    translates the expression into a Python function once, so that
+    evaluating it involves no walking of the expression."""
+
+    # operator -> Python operator
+    python_operators = {'>': '>', '<': '<', '==': '==',
+                        'in': 'in', 'not in': 'not in',
+                        '&': 'and', '|': 'or', 'not': 'not'}
+
+    def __and__(self, other):
+        return BinaryExpr('&', self, other)
+
+    def __or__(self, other):
+        return BinaryExpr('|', self, other)
+
+    def __invert__(self):
+        return UnaryExpr('not', self)
+
+    def evaluate(self, bindings):
+        raise NotImplementedError
+
+    def compile(self):
+        """Return a function that takes a binding and returns the value of
+        this expression."""
+        return Expr.compile_term(self)
+
+    @staticmethod
+    def evaluate_term(term, bindings):
+        """Evaluate term, which is an Expr, a Var, or a constant."""
+        if isinstance(term, Expr):
+            return term.evaluate(bindings)
+        elif isinstance(term, Var):
+            return bindings[term]
+        return term
+
+    @staticmethod
+    def variables(term):
+        """Return the set of Vars in term, which is an Expr, a Var, or a
+        constant."""
+        if isinstance(term, BinaryExpr):
+            return Expr.variables(term.left) | Expr.variables(term.right)
+        elif isinstance(term, UnaryExpr):
+            return Expr.variables(term.operand)
+        elif isinstance(term, Var):
+            return {term}
+        return set()
+
+    @staticmethod
+    def compile_term(term):
+        """Compile term, which is an Expr, a Var, or a constant such as
+        True, into a function of a binding."""
+        namespace = {}
+
+        def source(t):
+            if isinstance(t, BinaryExpr):
+                op = Expr.python_operators[t.operator]
+                return f'({source(t.left)} {op} {source(t.right)})'
+            elif isinstance(t, UnaryExpr):
+                op = Expr.python_operators[t.operator]
+                return f'({op} {source(t.operand)})'
+            elif isinstance(t, Var):
+                return f'b[{source_const(t)}]'
+            return source_const(t)
+
+        def source_const(value):
+            if type(value) in (int, str, bool) or value is None:
+                return repr(value)
+            name = f'_c{len(namespace)}'
+            namespace[name] = value
+            return name
+
+        code = f'def condition(b):\n    return {source(term)}\n'
+        exec(compile(code, '<Expr>', 'exec'), namespace)
+        return namespace['condition']
+
+
+class BinaryExpr(Expr):
     """Binary expression"""
     operator: str
     left: object
@@ -59,12 +384,44 @@ class BinaryExpr:
         self.left = left
         self.right = right
 
-    def __and__(self, other):
-        return BinaryExpr('&', self, other)
+    def evaluate(self, bindings):
+        left = Expr.evaluate_term(self.left, bindings)
+        if self.operator == '&':
+            return left and Expr.evaluate_term(self.right, bindings)
+        elif self.operator == '|':
+            return left or Expr.evaluate_term(self.right, bindings)
+        right = Expr.evaluate_term(self.right, bindings)
+        if self.operator == '>':
+            return left > right
+        elif self.operator == '<':
+            return left < right
+        elif self.operator == '==':
+            return left == right
+        elif self.operator == 'in':
+            return left in right
+        elif self.operator == 'not in':
+            return left not in right
+        raise ValueError(f'unknown operator {self.operator}')
+
+
+class UnaryExpr(Expr):
+    """Unary expression"""
+    operator: str
+    operand: object
+
+    def __init__(self, op, operand):
+        self.operator = op
+        self.operand = operand
+
+    def evaluate(self, bindings):
+        if self.operator == 'not':
+            return not Expr.evaluate_term(self.operand, bindings)
+        raise ValueError(f'unknown operator {self.operator}')
 
 
 
 class MatchException(Exception):
+    # Matching no longer raises this; it signals failure by returning False.
     pass
 
 
@@ -99,13 +456,58 @@ class Pattern:
         #return Pattern.subst_any(self.val, bindings)
         return self.subst_any(self.val, bindings)  # or: self.__class__
 
+    def template(self, share_ground=False):
+        """Return a SubstTemplate, which substitutes like this pattern but
+        only rebuilds the parts of the value that contain Vars."""
+        return SubstTemplate(self, share_ground)
+
+    def subst_many(self, bindings_iter):
+        """Yield the result of substituting each binding of bindings_iter."""
+        return SubstTemplate(self).subst_many(bindings_iter)
+
     def match(self, ground_val):
         bindings = {}
-        try:
-            self.match_any(self.val, ground_val, bindings)
+        if self.match_any(self.val, ground_val, bindings):
             return MatchDict(bindings)
-        except MatchException:
-            return None
+        return None
+
+    def compile(self, adaptive=False, period=1000):
+        """Return a CompiledPattern, which matches like this pattern but
+        without walking the pattern tree on every call."""
+        return CompiledPattern(self, adaptive, period)
+
+    def cached(self, max_entries=1024, max_bytes=None, plain=False):
+        """Return a MatchCache, whose method match matches like this pattern
+        but remembers the results for recently seen values. By default only
+        frozen values are looked up (see MatchCache)."""
+        return MatchCache(self.compile().match, max_entries, max_bytes,
+                          plain)
+
+    def frozen(self):
+        """Return the FrozenPattern for the current value of this pattern."""
+        return FrozenPattern(self.val)
+
+    def json_matcher(self, prefilter=True):
+        """Return a JSONMatcher, which matches like this pattern against the
+        JSON text of a value, without decoding all of it."""
+        return JSONMatcher(self, prefilter)
+
+    def match_many(self, ground_vals):
+        """Match each value of iterable ground_vals, and yield a pair (index,
+        MatchDict) for each value that matches. The pattern is compiled once,
+        and the values are consumed lazily, one at a time."""
+        match = self.compile().match
+        for i, ground_val in enumerate(ground_vals):
+            bindings = match(ground_val)
+            if bindings is not None:
+                yield i, bindings
+
+    def filter(self, ground_vals):
+        """Yield the values of iterable ground_vals that match, lazily."""
+        match = self.compile().match
+        for ground_val in ground_vals:
+            if match(ground_val) is not None:
+                yield ground_val
 
     #@staticmethod
     @classmethod
@@ -130,43 +532,1062 @@ class Pattern:
 
     @classmethod
     def subst_list(cls, lst: list, bindings):
-        return [cls.subst_any(el, bindings) for el in lst]
+        result = []
+        for el in lst:
+            if isinstance(el, Rest):
+                result.extend(Rest.splice(bindings, el))
+            else:
+                result.append(cls.subst_any(el, bindings))
+        return result
 
+    # The match_* methods return False as soon as a mismatch is found, and
+    # True otherwise. Returning a flag is much cheaper than raising and
+    # catching an exception, and most matches fail.
     @staticmethod
     def match_any(term, ground_val, bindings):
         """Match base values, or dispatch according to container type."""
         if ((isinstance(term, int) and isinstance(ground_val, int))
             or
             (isinstance(term, str) and isinstance(ground_val, str))):
-            if term == ground_val:
-                return
-            else:
-                raise MatchException
+            return term == ground_val
         elif isinstance(term, Var):
-            term.match(ground_val, bindings)
+            return term.match(ground_val, bindings)
         elif isinstance(term, dict) and isinstance(ground_val, dict):
-            Pattern.match_dict(term, ground_val, bindings)
+            return Pattern.match_dict(term, ground_val, bindings)
         elif isinstance(term, list) and isinstance(ground_val, list):
-            Pattern.match_list(term, ground_val, bindings)
+            return Pattern.match_list(term, ground_val, bindings)
         else:
-            raise MatchException
+            return False
 
     @staticmethod
     def match_dict(term: dict, ground_val: dict, bindings):
         for k in term.keys():
             # ground_val must at least have all keys that term has
             if k not in ground_val:
-                raise MatchException
+                return False
             # if key is both in term and in ground_val, try to match the
             # associated values
-            Pattern.match_any(term[k], ground_val[k], bindings)
+            if not Pattern.match_any(term[k], ground_val[k], bindings):
+                return False
+        return True
 
     @staticmethod
     def match_list(lst: list, ground_val: list, bindings):
-        if len(lst) != len(ground_val):
-            raise MatchException
-        for l_el, ground_val_el in zip(lst, ground_val):
-            Pattern.match_any(l_el, ground_val_el, bindings)
+        rest = Rest.position(lst)
+        if rest is None:
+            if len(lst) != len(ground_val):
+                return False
+            for l_el, ground_val_el in zip(lst, ground_val):
+                if not Pattern.match_any(l_el, ground_val_el, bindings):
+                    return False
+            return True
+        # the elements before the Rest, the Rest, and those after it
+        n = len(ground_val)
+        n_after = len(lst) - rest - 1
+        if n < len(lst) - 1:
+            return False
+        for l_el, ground_val_el in zip(lst[:rest], ground_val):
+            if not Pattern.match_any(l_el, ground_val_el, bindings):
+                return False
+        if not lst[rest].match(ListView(ground_val, rest, n - n_after),
+                               bindings):
+            return False
+        for l_el, ground_val_el in zip(lst[rest + 1:],
+                                       ground_val[n - n_after:]):
+            if not Pattern.match_any(l_el, ground_val_el, bindings):
+                return False
+        return True
+
+
+class CompiledPattern:
+    """A Pattern translated into a Python function that is specialized to
+    the shape of the pattern.
+
+    The pattern tree is analyzed once, when the CompiledPattern is created:
+    constants become direct comparisons, dict keys become a fixed sequence of
+    lookups, and Vars become type checks (or nothing at all, for Var(object)).
+    A Var that occurs more than once is bound at its first occurrence and
+    compared at the others. Method match returns the same result as
+    Pattern.match, i.e. a MatchDict or None. The generated code is kept in
+    attribute source, which is handy for debugging.
+
+    The checks are not made in the order of the pattern: the constants are
+    compared first, the shallow ones before the deep ones, because most
+    values that do not match differ in a constant (like 'name': 'transfer').
+    Then the Vars are bound and compared, in the order of the pattern, so
+    the result is the same. A value is only taken out of a container once
+    the container has been checked, as far as a check needs it.
+
+    With adaptive set, match also counts for each constant how often it
+    rejected a value, and every period calls the constants are put in the
+    order of their observed rejection rates, highest first, and the code is
+    generated again. The function in attribute match stays the same object,
+    so it may be stored elsewhere (as in PatternSet). Method stats returns
+    the counts."""
+
+    pattern: Pattern
+
+    def __init__(self, pattern, adaptive=False, period=1000):
+        self.pattern = pattern
+        self.adaptive = adaptive
+        self.period = period
+        self.namespace = {'MatchDict': MatchDict, 'ListView': ListView}
+        self.const_names = {}  # id of value -> name in namespace
+        self.terms = {}  # path -> term at that path in the pattern
+        self.constants = []  # paths of the constants
+        self.vars = []  # paths of the Var occurrences
+        self.containers = []  # paths of the dicts and lists
+        self.dead = False  # set when the pattern can never match
+        self.analyze(pattern.val, ())
+        # shallow constants first; sorted is stable
+        self.order = sorted(range(len(self.constants)),
+                            key=lambda i: len(self.constants[i]))
+        self.rejections = [0] * len(self.constants)
+        self.calls = [0]
+        self.reorders = 0
+        if adaptive:
+            self.namespace.update(_rejections=self.rejections,
+                                  _calls=self.calls, _reorder=self.reorder)
+        self.match = self.generate()
+
+    def __repr__(self):
+        return f'CompiledPattern({self.pattern.val})'
+
+    def analyze(self, term, path):
+        """Collect the paths of the parts of term, following the case
+        analysis of Pattern.match_any."""
+        self.terms[path] = term
+        if isinstance(term, (int, str)):
+            self.constants.append(path)
+        elif isinstance(term, Var):
+            if isinstance(term, Rest):
+                raise ValueError('a Rest may only occur as an element of a '
+                                 'list')
+            self.vars.append(path)
+        elif isinstance(term, dict):
+            self.containers.append(path)
+            for k, v in term.items():
+                self.analyze(v, path + (k,))
+        elif isinstance(term, list):
+            self.containers.append(path)
+            for step, el in zip(self.list_steps(term), term):
+                if step == '*':
+                    self.terms[path + (step,)] = el
+                    self.vars.append(path + (step,))
+                else:
+                    self.analyze(el, path + (step,))
+        else:
+            # no other kind of term matches anything
+            self.dead = True
+
+    def generate(self):
+        """Generate the match function for the current order, and return
+        it."""
+        self.lines = []
+        self.locals = {(): 'g'}  # path -> local holding the value there
+        self.checked = set()  # paths of the containers that were checked
+        self.bindings = {}  # Var -> name of local holding its bound value
+        self.n_locals = 0
+        self.counter = None  # index of the constant being checked
+        if self.adaptive:
+            self.lines.append('_calls[0] += 1')
+            self.lines.append(f'if _calls[0] >= {self.period}: _reorder()')
+        if self.dead:
+            self.lines.append('return None')
+        else:
+            for i in self.order:
+                self.counter = i
+                path = self.constants[i]
+                self.emit_constant(self.terms[path], self.access(path))
+            self.counter = None
+            for path in self.vars:
+                self.emit_var(self.terms[path], self.access(path))
+            for path in self.containers:
+                self.check_container(path, self.access(path))
+            items = ', '.join(f'{self.const(var)}: {local}'
+                              for var, local in self.bindings.items())
+            self.lines.append(f'return MatchDict({{{items}}})')
+        self.source = 'def match(g):\n' + ''.join(
+            f'    {line}\n' for line in self.lines)
+        exec(compile(self.source, '<CompiledPattern>', 'exec'),
+             self.namespace)
+        return self.namespace['match']
+
+    def const(self, value):
+        """Return an expression for value in the generated code."""
+        if type(value) in (int, str, bool):
+            return repr(value)
+        # the same value keeps its name when the code is generated again
+        name = self.const_names.get(id(value))
+        if name is None:
+            name = self.const_names[id(value)] = f'_c{len(self.const_names)}'
+            self.namespace[name] = value
+        return name
+
+    def new_local(self):
+        self.n_locals += 1
+        return f'g{self.n_locals}'
+
+    def fail_unless(self, cond):
+        if self.adaptive and self.counter is not None:
+            self.lines.append(f'if not ({cond}): '
+                              f'_rejections[{self.counter}] += 1; return None')
+        else:
+            self.lines.append(f'if not ({cond}): return None')
+
+    def access(self, path):
+        """Return the local that holds the value at path, after emitting the
+        checks and lookups needed to get it."""
+        local = self.locals.get(path)
+        if local is None:
+            parent_path = path[:-1]
+            parent = self.access(parent_path)
+            self.check_container(parent_path, parent)
+            if path not in self.locals:  # not unpacked from a list
+                key = self.const(path[-1])
+                local = self.locals[path] = self.new_local()
+                self.fail_unless(f'{key} in {parent}')
+                self.lines.append(f'{local} = {parent}[{key}]')
+            local = self.locals[path]
+        return local
+
+    @staticmethod
+    def list_steps(term):
+        """Return the steps in the paths of the elements of list pattern
+        term: their index, counted from the end after a Rest, or '*' for
+        the Rest."""
+        rest = Rest.position(term)
+        if rest is None:
+            return list(range(len(term)))
+        return ([*range(rest), '*']
+                + [i - len(term) for i in range(rest + 1, len(term))])
+
+    def check_container(self, path, local):
+        if path in self.checked:
+            return
+        self.checked.add(path)
+        term = self.terms[path]
+        if isinstance(term, dict):
+            self.fail_unless(f'isinstance({local}, dict)')
+        elif (rest := Rest.position(term)) is not None:
+            self.fail_unless(f'isinstance({local}, list) and '
+                             f'len({local}) >= {len(term) - 1}')
+            n_after = len(term) - rest - 1
+            for step in self.list_steps(term):
+                sub = self.locals[path + (step,)] = self.new_local()
+                if step == '*':
+                    self.lines.append(f'{sub} = ListView({local}, {rest}, '
+                                      f'len({local}) - {n_after})')
+                else:
+                    self.lines.append(f'{sub} = {local}[{step}]')
+        else:
+            self.fail_unless(f'isinstance({local}, list) and '
+                             f'len({local}) == {len(term)}')
+            if term:
+                subs = [self.new_local() for _ in term]
+                self.lines.append(f'{", ".join(subs)}, = {local}')
+                for i, sub in enumerate(subs):
+                    self.locals[path + (i,)] = sub
+
+    def emit_constant(self, term, local):
+        typ = 'int' if isinstance(term, int) else 'str'
+        self.fail_unless(f'isinstance({local}, {typ}) and '
+                         f'{local} == {self.const(term)}')
+
+    def emit_var(self, var, local):
+        checks = []
+        if var.check is not None:
+            checks.append(f'{self.const(var.check)}({local})')
+        elif var.typ is not object and not isinstance(var, Rest):
+            checks.append(f'isinstance({local}, {self.const(var.typ)})')
+        if var in self.bindings:
+            checks.append(f'{self.bindings[var]} == {local}')
+        else:
+            self.bindings[var] = local
+        if checks:
+            self.fail_unless(' and '.join(checks))
+
+    def reorder(self):
+        """Order the constants by their rejection rates since the last
+        reorder, and generate the code again."""
+        evaluated = self.calls[0]
+        rates = {}
+        for i in self.order:
+            rates[i] = self.rejections[i] / evaluated if evaluated else 0.0
+            evaluated -= self.rejections[i]
+        order = sorted(self.order, key=lambda i: -rates[i])
+        self.rejections[:] = [0] * len(self.constants)
+        self.calls[0] = 1  # the call that is reordering
+        if order == self.order:
+            return
+        self.order = order
+        self.reorders += 1
+        # replace the code of the existing function, so that references to
+        # it use the new order too
+        match = self.match
+        match.__code__ = self.generate().__code__
+        self.namespace['match'] = self.match = match
+
+    def stats(self):
+        """Return the number of calls (in adaptive mode) and reorders, and
+        per constant, in the current order: its path, its value and how
+        often it was evaluated and rejected a value."""
+        evaluated = self.calls[0]
+        constants = []
+        for i in self.order:
+            path = self.constants[i]
+            constants.append({'path': list(path), 'value': self.terms[path],
+                              'evaluated': evaluated,
+                              'rejected': self.rejections[i]})
+            evaluated -= self.rejections[i]
+        return {'calls': self.calls[0], 'reorders': self.reorders,
+                'constants': constants}
+
+
+class SubstTemplate:
+    """A Pattern prepared for fast substitution.
+
+    When the SubstTemplate is created, it is determined which subtrees of
+    the pattern contain Vars. The pattern is then translated into a single
+    Python expression that builds the result: ground subtrees become
+    literal displays, which Python builds in one step, and only the path
+    down to each Var involves an actual substitution. With share_ground set,
+    ground subtrees are not copied at all; the result then shares them with
+    the pattern (and with every other result), so they must not be mutated.
+    Method subst returns the same value as Pattern.subst."""
+
+    pattern: Pattern
+
+    def __init__(self, pattern, share_ground=False):
+        self.pattern = pattern
+        self.share_ground = share_ground
+        self.namespace = {'splice': Rest.splice}
+        self.const_names = {}
+        self.source = f'def subst(b):\n    return {self.expr(pattern.val)}\n'
+        exec(compile(self.source, '<SubstTemplate>', 'exec'), self.namespace)
+        self.subst = self.namespace['subst']
+
+    def __repr__(self):
+        return f'SubstTemplate({self.pattern.val})'
+
+    def subst_many(self, bindings_iter):
+        """Yield the result of substituting each binding of bindings_iter."""
+        subst = self.subst
+        for bindings in bindings_iter:
+            yield subst(bindings)
+
+    const = CompiledPattern.const
+
+    @staticmethod
+    def is_ground(term):
+        if isinstance(term, Var):
+            return False
+        elif isinstance(term, dict):
+            return all(SubstTemplate.is_ground(v) for v in term.values())
+        elif isinstance(term, list):
+            return all(SubstTemplate.is_ground(el) for el in term)
+        return True
+
+    def expr(self, term):
+        """Return an expression that builds the substitution result for
+        term, following Pattern.subst_any."""
+        if isinstance(term, Var):
+            var = self.const(term)
+            if term.typ is object:
+                return f'b.get({var}, {var})'
+            # see Var.subst: an unbound Var, or one bound to a value of the
+            # wrong type, is left in place
+            if term.check is not None:
+                check = self.const(term.check)
+                return f'(x if {check}(x := b.get({var}, {var})) else {var})'
+            typ = self.const(term.typ)
+            return f'(x if isinstance(x := b.get({var}, {var}), {typ}) ' \
+                   f'else {var})'
+        elif isinstance(term, (dict, list)):
+            if self.share_ground and self.is_ground(term):
+                return self.const(term)
+            if isinstance(term, dict):
+                return '{' + ', '.join(f'{self.const(k)}: {self.expr(v)}'
+                                       for k, v in term.items()) + '}'
+            return '[' + ', '.join(
+                f'*splice(b, {self.const(el)})' if isinstance(el, Rest)
+                else self.expr(el) for el in term) + ']'
+        else:
+            return self.const(term)
+
+
+class PatternSet:
+    """A collection of Patterns that can be matched against a value all at
+    once.
+
+    The patterns are stored in a discrimination tree. Each pattern is
+    flattened, in depth-first order, into a sequence of tokens: a constant,
+    the keys of a dict, the length of a list, or ANY for a Var. Looking up a
+    value walks the tree along the tokens of the value, following the ANY
+    branch wherever one exists as well. So only patterns that agree with the
+    constant parts of the value are visited, and the cost of a lookup
+    depends on the size of the value rather than on the number of patterns.
+    (Dict tokens are the exception: all dict shapes at a node are tried,
+    since a dict pattern also matches dicts with extra keys.) The remaining
+    candidates are matched with their CompiledPattern, which checks the
+    types of Vars and Vars that occur more than once."""
+
+    ANY = object()
+
+    def __init__(self, patterns=()):
+        self.patterns = []
+        self.root = PatternSet.Node()
+        for pattern in patterns:
+            self.add(pattern)
+
+    class Node:
+        def __init__(self):
+            self.any = None  # child for a Var
+            self.children = {}  # constant or list token -> child
+            self.dicts = {}  # tuple of dict keys -> child
+            self.entries = []  # (index, pattern, match) of complete patterns
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def add(self, pattern, match=None):
+        """Add pattern, which is matched by match if given, e.g. a matcher
+        that was compiled already, and by its CompiledPattern otherwise."""
+        if match is None:
+            match = pattern.compile().match
+        entry = (len(self.patterns), pattern, match)
+        self.patterns.append(pattern)
+        tokens = []
+        if isinstance(pattern, FrozenPattern):
+            val = pattern.shape.pattern.val  # same tokens, no copy
+        else:
+            val = pattern.val
+        if not self.flatten(val, tokens):
+            return  # pattern never matches, so it need not be indexed
+        node = self.root
+        for token in tokens:
+            if token is PatternSet.ANY:
+                if node.any is None:
+                    node.any = PatternSet.Node()
+                node = node.any
+            elif isinstance(token[0], tuple):
+                node = node.dicts.setdefault(token[0], PatternSet.Node())
+            else:
+                node = node.children.setdefault(token, PatternSet.Node())
+        node.entries.append(entry)
+
+    @staticmethod
+    def flatten(term, tokens):
+        """Append the tokens of term to tokens. Return False if term can
+        never match (see Pattern.match_any)."""
+        if isinstance(term, int):
+            tokens.append((int, term))
+        elif isinstance(term, str):
+            tokens.append((str, term))
+        elif isinstance(term, Var):
+            tokens.append(PatternSet.ANY)
+        elif isinstance(term, dict):
+            tokens.append((tuple(term.keys()),))
+            return all(PatternSet.flatten(v, tokens) for v in term.values())
+        elif isinstance(term, list):
+            if Rest.position(term) is not None:
+                # matches lists of several lengths; left to the matcher
+                tokens.append(PatternSet.ANY)
+                return True
+            tokens.append((list, len(term)))
+            return all(PatternSet.flatten(el, tokens) for el in term)
+        else:
+            return False
+        return True
+
+    def candidates(self, ground_val):
+        """Return the entries of the patterns that agree with the constant
+        parts of ground_val, in the order in which they were added."""
+        found = []
+        # The values still to be looked at form a linked list of pairs
+        # (value, rest), so that branches can share it.
+        todo = [(self.root, (ground_val, None))]
+        while todo:
+            node, pending = todo.pop()
+            if pending is None:
+                found.extend(node.entries)
+                continue
+            g, rest = pending
+            if node.any is not None:
+                todo.append((node.any, rest))
+            if node.children:
+                if isinstance(g, int):
+                    child = node.children.get((int, g))
+                elif isinstance(g, str):
+                    child = node.children.get((str, g))
+                elif isinstance(g, list):
+                    child = node.children.get((list, len(g)))
+                    if child is not None:
+                        for el in reversed(g):
+                            rest = (el, rest)
+                else:
+                    child = None
+                if child is not None:
+                    todo.append((child, rest))
+            if node.dicts and isinstance(g, dict):
+                for keys, child in node.dicts.items():
+                    sub_rest = rest
+                    for k in reversed(keys):
+                        if k not in g:
+                            break
+                        sub_rest = (g[k], sub_rest)
+                    else:
+                        todo.append((child, sub_rest))
+        found.sort()
+        return found
+
+    def match_all(self, ground_val):
+        """Return a list of (pattern, MatchDict) pairs for all patterns that
+        match ground_val, in the order in which they were added."""
+        result = []
+        for _, pattern, match in self.candidates(ground_val):
+            bindings = match(ground_val)
+            if bindings is not None:
+                result.append((pattern, bindings))
+        return result
+
+    def match_first(self, ground_val):
+        """Return (pattern, MatchDict) for the first pattern that matches
+        ground_val, or None if there is none."""
+        for _, pattern, match in self.candidates(ground_val):
+            bindings = match(ground_val)
+            if bindings is not None:
+                return pattern, bindings
+        return None
+
+
+class FrozenDict(dict):
+    """A dict that cannot be changed. Its canonical form (see canonical) is
+    computed once, so it is cheap to look up in a MatchCache, and match
+    results that refer to it can be cached. Use freeze to create one."""
+    __slots__ = ('_key',)
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f'{type(self).__name__} cannot be changed')
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __hash__(self):
+        return self._key.hash
+
+    def __reduce__(self):
+        return freeze, (dict(self),)
+
+
+class FrozenList(list):
+    """A list that cannot be changed, see FrozenDict."""
+    __slots__ = ('_key',)
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f'{type(self).__name__} cannot be changed')
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = clear = _immutable
+    sort = reverse = _immutable
+
+    def __hash__(self):
+        return self._key.hash
+
+    def __reduce__(self):
+        return freeze, (list(self),)
+
+
+def freeze(value):
+    """Return value with its dicts and lists replaced by FrozenDicts and
+    FrozenLists."""
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return value
+    if isinstance(value, dict):
+        frozen = FrozenDict((k, freeze(v)) for k, v in value.items())
+    elif isinstance(value, list):
+        frozen = FrozenList(freeze(v) for v in value)
+    else:
+        return value
+    frozen._key = CanonicalKey(canonical(frozen, recompute=True))
+    return frozen
+
+
+class CanonicalKey:
+    """The canonical form of a frozen value, with its hash computed once.
+    It is equal to the canonical form of an equal plain value."""
+    __slots__ = ('value', 'hash')
+
+    def __init__(self, value):
+        self.value = value
+        self.hash = hash(value)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        if isinstance(other, CanonicalKey):
+            return self.value == other.value
+        return self.value == other
+
+
+def canonical(value, recompute=False):
+    """Return a hashable value that is equal for ground values that match
+    any pattern in the same way. Scalars are paired with their type,
+    because 1, 1.0 and True are equal but not matched alike. Raise
+    TypeError for unhashable values other than dicts and lists."""
+    typ = type(value)
+    if typ is str:
+        return value
+    if typ is dict:
+        return (dict, tuple([(k, canonical(v)) for k, v in value.items()]))
+    if typ is int:
+        return (int, value)
+    if (typ is FrozenDict or typ is FrozenList) and not recompute:
+        return value._key
+    if isinstance(value, dict):
+        return (dict, tuple([(k, canonical(v)) for k, v in value.items()]))
+    if isinstance(value, list):
+        return (list, tuple([canonical(v) for v in value]))
+    hash(value)
+    return (typ, value)
+
+
+def approx_size(key):
+    """Return an estimate of the number of bytes taken by a canonical
+    value, including the canonical forms of the frozen values in it."""
+    size = sys.getsizeof(key)
+    if type(key) is CanonicalKey:
+        size += approx_size(key.value)
+    elif type(key) is tuple:
+        for item in key:
+            size += approx_size(item)
+    return size
+
+
+class MatchCache:
+    """A bounded LRU cache of the results of a match function, such as
+    CompiledPattern.match, for ground values that repeat (heartbeats,
+    identical commands).
+
+    Values are looked up by their canonical form. This is a copy of the
+    structure of the value, so a value that is changed after it was matched
+    does not hit the entry of its old contents. A MatchDict that binds a
+    Var to a plain dict or list would refer to a part of the value that was
+    matched first, which may have changed since; for such results the
+    cache only remembers that the value matches, and matches it again on a
+    hit. Values made with freeze cannot change, so results that refer to
+    them are returned directly, and their canonical form is computed only
+    once.
+
+    The cache holds at most max_entries entries and, if max_bytes is given,
+    at most about that many bytes of canonical forms; the least recently
+    used entries are evicted first. A hit returns a new MatchDict, so
+    callers may change it. Values with unhashable parts, such as sets,
+    are matched without the cache.
+
+    Computing the canonical form of a plain dict or list walks it, as
+    matching does, which takes longer than a CompiledPattern takes to
+    match it. So such values are matched without the cache unless plain
+    is true, which pays off only for match functions that take longer
+    than that walk. A frozen value is looked up by the canonical form it
+    already has."""
+
+    REMATCH = object()
+
+    def __init__(self, match, max_entries=1024, max_bytes=None,
+                 plain=True):
+        self.match_uncached = match
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.plain = plain
+        # canonical value -> (result, size, canonical value)
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncacheable = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def match(self, ground_val):
+        typ = type(ground_val)
+        if typ is FrozenDict or typ is FrozenList:
+            key = ground_val._key
+            entry = self.entries.get(key)
+        elif not self.plain and (typ is dict or typ is list):
+            self.uncacheable += 1
+            return self.match_uncached(ground_val)
+        else:
+            try:
+                key = canonical(ground_val)
+                entry = self.entries.get(key)
+            except TypeError:
+                self.uncacheable += 1
+                return self.match_uncached(ground_val)
+        if entry is not None:
+            self.hits += 1
+            if entry[2] is key or type(key) is not CanonicalKey:
+                self.entries.move_to_end(key)
+            else:
+                # store it under key, which is then found by identity
+                del self.entries[key]
+                entry = self.entries[key] = (entry[0], entry[1], key)
+            result = entry[0]
+            if result is None:
+                return None
+            if result is self.REMATCH:
+                return self.match_uncached(ground_val)
+            return MatchDict(result)
+        self.misses += 1
+        result = self.match_uncached(ground_val)
+        stored = result
+        if result is not None:
+            for value in result.values():
+                if (isinstance(value, (dict, list, ListView))
+                        and not isinstance(value, (FrozenDict, FrozenList))):
+                    stored = self.REMATCH
+                    break
+            else:
+                stored = MatchDict(result)
+        size = 0 if self.max_bytes is None else approx_size(key)
+        self.entries[key] = (stored, size, key)
+        self.n_bytes += size
+        while (len(self.entries) > self.max_entries
+               or (self.max_bytes is not None
+                   and self.n_bytes > self.max_bytes
+                   and len(self.entries) > 1)):
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.n_bytes -= evicted_size
+            self.evictions += 1
+        return result
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'uncacheable': self.uncacheable,
+                'entries': len(self.entries), 'bytes': self.n_bytes}
+
+    def clear(self):
+        self.entries.clear()
+        self.n_bytes = 0
+
+
+class JSONMatcher:
+    """Matches a Pattern against JSON text (bytes, memoryview or str), as
+    Pattern.match would match the decoded value, but without decoding what
+    the pattern does not need.
+
+    First, if prefilter is set, the text is searched for the keys and string
+    constants of the pattern, in their JSON encoding; if one of them does
+    not occur, the text cannot match. This assumes that the producer does
+    not write these strings with \\u escapes. Then the text is scanned
+    along the pattern: a constant is compared as soon as it is reached,
+    values of keys that are not in the pattern are skipped without being
+    built, and only the values at the positions of Vars are decoded. Once
+    all keys of the outermost dict are matched, the rest of the text is not
+    looked at, so it is not checked to be valid JSON either. Text that is
+    found to be malformed does not match. As in json.loads, of duplicate
+    keys the last one counts, but the first one is matched already, so
+    such text should be avoided."""
+
+    # whitespace, the text of a JSON string, and anything up to the next
+    # bracket, passing over strings
+    WS = re.compile(r'[ \t\n\r]*')
+    STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+    TO_BRACKET = re.compile(r'[^"{}\[\]]*(?:"(?:[^"\\]|\\.)*"[^"{}\[\]]*)*',
+                            re.DOTALL)
+    SCALAR = re.compile(r'[^,}\]\s]*')
+    SAFE = re.compile(r'[ !#-.0-\[\]-~]*')  # printable ASCII but " / \\
+
+    def __init__(self, pattern, prefilter=True):
+        self.pattern = pattern
+        needles = set()
+        if prefilter:
+            self.collect_needles(pattern.val, needles)
+        # long needles are the least likely to occur by accident
+        self.needles = sorted(needles, key=len, reverse=True)
+        self.str_needles = [n.decode() for n in self.needles]
+        self.needle_res = [re.compile(re.escape(n)) for n in self.needles]
+        self.raw_decode = json.JSONDecoder().raw_decode
+
+    def __repr__(self):
+        return f'JSONMatcher({self.pattern.val})'
+
+    def collect_needles(self, term, needles):
+        if isinstance(term, str):
+            if self.SAFE.fullmatch(term):
+                needles.add(f'"{term}"'.encode())
+        elif isinstance(term, dict):
+            for k, v in term.items():
+                self.collect_needles(k, needles)
+                self.collect_needles(v, needles)
+        elif isinstance(term, list):
+            for v in term:
+                self.collect_needles(v, needles)
+
+    def match(self, data):
+        """Return a MatchDict if the value of JSON text data matches the
+        pattern, else None."""
+        if isinstance(data, str):
+            for needle in self.str_needles:
+                if needle not in data:
+                    return None
+            text = data
+        else:
+            if isinstance(data, memoryview):
+                for needle_re in self.needle_res:
+                    if needle_re.search(data) is None:
+                        return None
+            else:
+                for needle in self.needles:
+                    if needle not in data:
+                        return None
+            try:
+                text = str(data, 'utf-8')
+            except UnicodeDecodeError:
+                return None
+        bindings = {}
+        try:
+            pos = self.match_value(self.pattern.val, text,
+                                   self.WS.match(text).end(), bindings, False)
+        except (ValueError, IndexError):
+            return None
+        if pos is None:
+            return None
+        if pos >= 0 and self.WS.match(text, pos).end() != len(text):
+            return None
+        return MatchDict(bindings)
+
+    def match_value(self, term, s, pos, bindings, need_end=True):
+        """Match term against the JSON value at s[pos:]. Return the position
+        after the value, or -1 if it is not needed (not need_end) and was
+        not computed, or None if the value does not match."""
+        if isinstance(term, dict):
+            return self.match_object(term, s, pos, bindings, need_end)
+        elif isinstance(term, list):
+            if Rest.position(term) is not None:
+                # the Rest is bound to a view of the decoded list
+                value, pos = self.raw_decode(s, pos)
+                if not Pattern.match_any(term, value, bindings):
+                    return None
+                return pos
+            return self.match_array(term, s, pos, bindings)
+        elif isinstance(term, str):
+            if s[pos] != '"':
+                return None
+            value, pos = scanstring(s, pos + 1)
+            return pos if value == term else None
+        value, pos = self.raw_decode(s, pos)
+        return pos if Pattern.match_any(term, value, bindings) else None
+
+    def match_object(self, term, s, pos, bindings, need_end):
+        if s[pos] != '{':
+            return None
+        ws = self.WS.match
+        pos = ws(s, pos + 1).end()
+        n_matched = 0
+        if s[pos] == '}':
+            return pos + 1 if not term else None
+        while True:
+            if s[pos] != '"':
+                raise ValueError('expected a key')
+            key, pos = scanstring(s, pos + 1)
+            pos = ws(s, pos).end()
+            if s[pos] != ':':
+                raise ValueError("expected ':'")
+            pos = ws(s, pos + 1).end()
+            if key in term:
+                pos = self.match_value(term[key], s, pos, bindings)
+                if pos is None:
+                    return None
+                n_matched += 1
+                if n_matched == len(term) and not need_end:
+                    return -1
+            else:
+                pos = self.skip_value(s, pos)
+            pos = ws(s, pos).end()
+            if s[pos] == ',':
+                pos = ws(s, pos + 1).end()
+            elif s[pos] == '}':
+                return pos + 1 if n_matched == len(term) else None
+            else:
+                raise ValueError("expected ',' or '}'")
+
+    def match_array(self, term, s, pos, bindings):
+        if s[pos] != '[':
+            return None
+        ws = self.WS.match
+        pos = ws(s, pos + 1).end()
+        for i, element in enumerate(term):
+            if s[pos] == ']':
+                return None  # too short
+            if i > 0:
+                if s[pos] != ',':
+                    raise ValueError("expected ','")
+                pos = ws(s, pos + 1).end()
+            pos = self.match_value(element, s, pos, bindings)
+            if pos is None:
+                return None
+            pos = ws(s, pos).end()
+        return pos + 1 if s[pos] == ']' else None
+
+    def skip_value(self, s, pos):
+        """Return the position after the JSON value at s[pos:]."""
+        c = s[pos]
+        if c == '"':
+            return self.STRING.match(s, pos).end()
+        if c not in '{[':
+            return self.SCALAR.match(s, pos).end()
+        to_bracket = self.TO_BRACKET.match
+        depth = 0
+        while True:
+            pos = to_bracket(s, pos).end()
+            c = s[pos]
+            pos += 1
+            if c == '{' or c == '[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return pos
+
+
+class PatternShape:
+    """The shape of a pattern: the pattern with each of its Vars replaced by
+    a slot, i.e. a Var of the same type that belongs to the shape. Slots are
+    numbered in the order in which the Vars first occur, depth first.
+
+    Shapes are hash-consed: intern returns the one PatternShape for a given
+    structure, as long as it is in use, so shapes are equal only if they are
+    the same object. The key and its hash are computed once, and so is the
+    CompiledPattern, which all patterns of the shape share."""
+    __slots__ = ('key', 'hash', 'pattern', 'slots', '_compiled',
+                 '__weakref__')
+
+    table = weakref.WeakValueDictionary()  # key -> PatternShape
+
+    def __init__(self, key, pattern, slots):
+        self.key = key
+        self.hash = hash(key)
+        self.pattern = pattern
+        self.slots = slots
+        self._compiled = None
+
+    def __repr__(self):
+        return f'PatternShape({self.pattern.val})'
+
+    def __hash__(self):
+        return self.hash
+
+    @property
+    def compiled(self):
+        if self._compiled is None:
+            self._compiled = self.pattern.compile()
+        return self._compiled
+
+    @staticmethod
+    def intern(term):
+        """Return the PatternShape of term and the tuple of its Vars, in the
+        order of their slots."""
+        variables = {}  # Var -> slot number; ordered
+        key = PatternShape.make_key(term, variables)
+        shape = PatternShape.table.get(key)
+        if shape is None:
+            slots = tuple(type(var)(var.typ, var.sample)
+                          for var in variables)
+            mapping = dict(zip(variables, slots))
+            shape = PatternShape(
+                key, Pattern(PatternShape.replace(term, mapping)), slots)
+            PatternShape.table[key] = shape
+        return shape, tuple(variables)
+
+    @staticmethod
+    def make_key(term, variables):
+        if isinstance(term, Var):
+            slot = variables.setdefault(term, len(variables))
+            return (type(term), slot, term.typ, term.sample)
+        elif isinstance(term, dict):
+            return (dict, tuple([(k, PatternShape.make_key(v, variables))
+                                 for k, v in term.items()]))
+        elif isinstance(term, list):
+            return (list, tuple([PatternShape.make_key(el, variables)
+                                 for el in term]))
+        # scalars are paired with their type, as 1 == True
+        return (type(term), term)
+
+    @staticmethod
+    def replace(term, mapping):
+        """Return a copy of term with the Vars replaced by mapping."""
+        if isinstance(term, Var):
+            return mapping[term]
+        elif isinstance(term, dict):
+            return {k: PatternShape.replace(v, mapping)
+                    for k, v in term.items()}
+        elif isinstance(term, list):
+            return [PatternShape.replace(el, mapping) for el in term]
+        return term
+
+
+class FrozenPattern(Pattern):
+    """An immutable Pattern, interned: FrozenPattern(val) returns the same
+    object for the same structure with the same Vars, while it is in use.
+    So FrozenPatterns are equal only if they are identical, and can be
+    compared and hashed in constant time.
+
+    A FrozenPattern only holds its PatternShape and its Vars. Patterns that
+    differ only in their Vars, like the triggers of different instances of
+    a StateMachine class, share the shape and its compiled matcher, which
+    binds the slots of the shape; match maps these back to the Vars of the
+    pattern. Attribute val builds the pattern value when it is needed."""
+
+    table = weakref.WeakValueDictionary()  # (shape, ids of Vars) -> pattern
+
+    def __new__(cls, val):
+        shape, variables = PatternShape.intern(val)
+        # Var.__eq__ builds an expression, so compare Vars by id; the
+        # pattern keeps its Vars alive, so their ids are not reused
+        key = (shape, tuple(map(id, variables)))
+        pattern = FrozenPattern.table.get(key)
+        if pattern is None:
+            pattern = object.__new__(cls)
+            pattern.shape = shape
+            pattern.vars = variables
+            pattern.shape_match = shape.compiled.match
+            FrozenPattern.table[key] = pattern
+        return pattern
+
+    def __init__(self, val):
+        pass
+
+    @property
+    def val(self):
+        return PatternShape.replace(self.shape.pattern.val,
+                                    dict(zip(self.shape.slots, self.vars)))
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__:
+            raise AttributeError('FrozenPattern cannot be changed')
+        object.__setattr__(self, name, value)
+
+    def match(self, ground_val):
+        bindings = self.shape_match(ground_val)
+        if bindings is None:
+            return None
+        # the compiled matcher binds the slots in slot order
+        return MatchDict(zip(self.vars, bindings.values()))
+
+    def compile(self, adaptive=False, period=1000):
+        """Return self: the compiled matcher of the shape is used. Use
+        self.shape.pattern.compile for an adaptive one."""
+        return self
+
+    def frozen(self):
+        return self
 
 
 class TestPattern(unittest.TestCase):
@@ -192,6 +1613,47 @@ class TestPattern(unittest.TestCase):
         i_subst = i.subst({i: 'a'})
         self.assertEqual(i_subst, i)
 
+    def test_parameterized_types(self):
+        cases = [(list[int], [1, 2, True], [1, 'a']),
+                 (list[int], [], (1,)),
+                 (dict[str, float], {'a': 1.5}, {'a': 1}),
+                 (dict[str, list[int]], {'a': [1]}, {'a': [1.5]}),
+                 (tuple[int, ...], (1, 2), (1, 'a')),
+                 (tuple[int, str], (1, 'a'), (1, 2)),
+                 (set[str], {'a'}, {1}),
+                 (int | None, None, 'a'),
+                 (typing.Optional[list[str]], None, ['a', 1]),
+                 (list[int] | str, 'a', [None]),
+                 (list[typing.Any], [1, None], {}),
+                 (Sequence[float], array.array('d', [1.0]),
+                  array.array('i', [1]))]
+        for typ, good, bad in cases:
+            var = Var(typ)
+            p = Pattern({'x': var})
+            for value, ok in ((good, True), (bad, False)):
+                self.assertEqual(var.accepts(value), ok, (typ, value))
+                expected = {var: value} if ok else None
+                self.assertEqual(p.match({'x': value}), expected)
+                self.assertEqual(p.compile().match({'x': value}), expected)
+                self.assertEqual(p.template().subst({var: value}),
+                                 p.subst({var: value}))
+        self.assertEqual(str(Var(dict[str, float])), 'Var(dict[str, float])')
+
+    def test_sampled_types(self):
+        ticks = list(range(100_000))
+        ticks[1] = 'a'
+        self.assertFalse(Var(list[int]).accepts(ticks))
+        # only every 1000th element is checked
+        self.assertTrue(Var(list[int], sample=100).accepts(ticks))
+        ticks[1000] = 'a'
+        self.assertFalse(Var(list[int], sample=100).accepts(ticks))
+        self.assertTrue(Var(set[int], sample=10).accepts(set(range(100))))
+        rest = Rest(int, sample=2)
+        p = Pattern([rest])
+        self.assertIsNotNone(p.compile().match([1, 'a', 2, 3]))
+        self.assertIsNone(p.compile().match([1, 2, 'a', 3]))
+        self.assertIsNot(p.frozen(), Pattern([Rest(int)]).frozen())
+
     def test_pattern_list_subst(self):
         i = Var(int)
         e = Pattern([i])
@@ -236,6 +1698,339 @@ class TestPattern(unittest.TestCase):
         m = e.match({'arg1': 3, 'arg2': 4})
         self.assertEqual(bool(m), False)
 
+    def test_match_any_returns_flag(self):
+        x = Var(int)
+        bindings = {}
+        self.assertFalse(Pattern.match_any([x, 'a'], [1, 'b'], bindings))
+        self.assertTrue(Pattern.match_any({'k': x}, {'k': 1}, bindings))
+        self.assertEqual(bindings, {x: 1})
+
+    def test_compiled_same_as_match(self):
+        x = Var(int)
+        s = Var(str)
+        p = Pattern({'command': 'Start', 'args': [x, s, x], 'n': 7})
+        c = p.compile()
+        for val in [{'command': 'Start', 'args': [1, 'a', 1], 'n': 7},
+                    {'command': 'Start', 'args': [1, 'a', 2], 'n': 7},
+                    {'command': 'Stop', 'args': [1, 'a', 1], 'n': 7},
+                    {'command': 'Start', 'args': [1, 'a'], 'n': 7},
+                    {'command': 'Start', 'args': [1, 2, 1], 'n': 7},
+                    {'command': 'Start', 'args': [1, 'a', 1]},
+                    {'command': 'Start', 'args': [1, 'a', 1], 'n': '7',
+                     'extra': None},
+                    [], 'Start', None]:
+            self.assertEqual(c.match(val), p.match(val))
+        m = c.match({'command': 'Start', 'args': [1, 'a', 1], 'n': 7})
+        self.assertEqual(bool(m), True)
+        self.assertEqual(m, {x: 1, s: 'a'})
+
+    def test_compiled_empty_match(self):
+        m = Pattern(['abc', 3]).compile().match(['abc', 3])
+        self.assertEqual(m, {})
+        self.assertEqual(bool(m), True)
+
+    def test_compiled_unmatchable_term(self):
+        c = Pattern({'reply': None}).compile()
+        self.assertEqual(c.match({'reply': None}), None)
+
+    def test_compiled_order(self):
+        x = Var(int)
+        p = Pattern({'a': x, 'b': [x, 'u'], 'name': 'transfer',
+                     'meta': {'region': 'eu'}})
+        c = p.compile()
+        self.assertLess(c.source.index("'transfer'"), c.source.index("'eu'"))
+        self.assertLess(c.source.index("'eu'"), c.source.index('_c'))
+        for val in [{'a': 1, 'b': [1, 'u'], 'name': 'transfer',
+                     'meta': {'region': 'eu'}},
+                    {'a': 1, 'b': [True, 'u'], 'name': 'transfer',
+                     'meta': {'region': 'eu', 'x': 1}},
+                    {'a': 1, 'b': [2, 'u'], 'name': 'transfer',
+                     'meta': {'region': 'eu'}},
+                    {'a': 1, 'b': [1, 'u', 3], 'name': 'transfer',
+                     'meta': {'region': 'eu'}},
+                    {'a': 1, 'b': [1, 'u'], 'name': 'transfer', 'meta': []},
+                    {'a': 1, 'b': [1, 'u'], 'name': 'transfer'}]:
+            self.assertEqual(c.match(val), p.match(val))
+        m = c.match({'a': True, 'b': [1, 'u'], 'name': 'transfer',
+                     'meta': {'region': 'eu'}})
+        self.assertIs(m[x], True)  # bound at its first occurrence
+
+    def test_compiled_adaptive(self):
+        x = Var(int)
+        p = Pattern({'name': 'transfer', 'arg': x, 'region': 'eu'})
+        c = p.compile(adaptive=True, period=100)
+        match = c.match
+        self.assertEqual(c.stats()['constants'][0]['value'], 'transfer')
+        for i in range(250):
+            region = 'eu' if i % 10 == 0 else 'us'
+            val = {'name': 'transfer', 'arg': i, 'region': region}
+            self.assertEqual(match(val), p.match(val))
+        stats = c.stats()
+        self.assertEqual(stats['reorders'], 1)  # then the order stayed
+        self.assertEqual(stats['calls'], 52)
+        self.assertEqual([s['value'] for s in stats['constants']],
+                         ['eu', 'transfer'])
+        self.assertEqual(stats['constants'][0]['rejected'], 47)
+        self.assertIs(c.match, match)
+
+    def test_frozen_pattern(self):
+        def trigger(x):
+            y = Var(str)
+            a = Var(int)
+            trigger = {'name': 'transfer', 'arg1': y, 'arg2': a,
+                       'x': [x, a]}
+            return trigger, y, a
+        t1, y1, a1 = trigger(1)
+        t2, y2, a2 = trigger(1)
+        p1 = Pattern(t1).frozen()
+        self.assertIs(p1, FrozenPattern(t1))
+        self.assertIsNot(p1, Pattern(t2).frozen())
+        self.assertIs(p1.shape, Pattern(t2).frozen().shape)
+        self.assertIsNot(p1.shape, Pattern(trigger(True)[0]).frozen().shape)
+        self.assertEqual(len({p1, FrozenPattern(t1)}), 1)
+        self.assertEqual(p1.val, t1)
+        val = {'name': 'transfer', 'arg1': 'acc1', 'arg2': 5, 'x': [1, 5]}
+        self.assertEqual(p1.match(val), {y1: 'acc1', a1: 5})
+        self.assertEqual(FrozenPattern(t2).match(val), {y2: 'acc1', a2: 5})
+        self.assertIsNone(p1.match(dict(val, x=[1, 6])))
+        self.assertEqual(list(p1.match_many([val, {}])),
+                         [(0, {y1: 'acc1', a1: 5})])
+        with self.assertRaises(AttributeError):
+            p1.shape = None
+        ps = PatternSet([p1, Pattern(t2).frozen()])
+        self.assertEqual([b for _, b in ps.match_all(val)],
+                         [{y1: 'acc1', a1: 5}, {y2: 'acc1', a2: 5}])
+
+    def test_rest(self):
+        cmd = Var(str)
+        args = Rest(int)
+        last = Var(int)
+        p = Pattern({'command': cmd, 'args': [0, args, last]})
+        c = p.compile()
+        vals = [{'command': 'SetTicks', 'args': [0, 1, 2, 3]},
+                {'command': 'SetTicks', 'args': [0, 3]},
+                {'command': 'SetTicks', 'args': [0]},
+                {'command': 'SetTicks', 'args': [1, 2, 3]},
+                {'command': 'SetTicks', 'args': [0, 'a', 3]},
+                {'command': 'SetTicks', 'args': (0, 3)}]
+        for val in vals:
+            self.assertEqual(c.match(val), p.match(val), val)
+            self.assertEqual(p.frozen().match(val), p.match(val), val)
+        m = c.match(vals[0])
+        self.assertEqual(m, {cmd: 'SetTicks', args: [1, 2], last: 3})
+        self.assertIs(m[args].base, vals[0]['args'])
+        self.assertEqual(m[args][1:], [2])
+        self.assertEqual(p.subst(m), vals[0])
+        self.assertEqual(p.template().subst(m), vals[0])
+        self.assertEqual(p.subst({}), p.val)
+        self.assertEqual(p.template().subst({}), p.val)
+        self.assertEqual(c.match(vals[1])[args], [])
+        # a repeated Rest compares the segments
+        r = Rest()
+        q = Pattern([[r, 9], [r]])
+        for val in [[[1, 2, 9], [1, 2]], [[1, 2, 9], [1]], [[9], []]]:
+            self.assertEqual(q.compile().match(val), q.match(val))
+        ps = PatternSet([p, Pattern({'command': 'x', 'args': [1]})])
+        self.assertEqual(ps.match_all(vals[0]), [(p, m)])
+        matcher = p.json_matcher()
+        self.assertEqual(matcher.match(json.dumps(vals[0]).encode()), m)
+        with self.assertRaises(ValueError):
+            Pattern([Rest(), Rest()]).compile()
+        with self.assertRaises(ValueError):
+            Pattern({'a': Rest()}).match({'a': [1]})
+
+    def test_pattern_set(self):
+        i = Var(int)
+        s = Var(str)
+        patterns = [Pattern({'command': 'Start', 'arg': i}),
+                    Pattern({'command': 'Stop', 'arg': i}),
+                    Pattern({'command': s, 'arg': 3}),
+                    Pattern({'command': 'Start'}),
+                    Pattern([s, i]),
+                    Pattern([s, s]),
+                    Pattern(i),
+                    Pattern({'reply': None})]
+        ps = PatternSet(patterns)
+        self.assertEqual(len(ps), len(patterns))
+        for val in [{'command': 'Start', 'arg': 3},
+                    {'command': 'Stop', 'arg': 4, 'extra': [1]},
+                    {'command': 'Start', 'arg': 'x'},
+                    {'arg': 3},
+                    ['a', 1], ['a', 'a'], ['a'], 7, True, 'Start',
+                    {'reply': None}]:
+            expected = [(p, p.match(val)) for p in patterns if p.match(val)]
+            self.assertEqual(ps.match_all(val), expected)
+            self.assertEqual(ps.match_first(val),
+                             expected[0] if expected else None)
+
+    def test_pattern_set_candidates(self):
+        ps = PatternSet(Pattern({'command': f'c{n}', 'arg': Var(int)})
+                        for n in range(100))
+        self.assertEqual(len(ps.candidates({'command': 'c7', 'arg': 1})), 1)
+        self.assertEqual(ps.candidates({'command': 'x', 'arg': 1}), [])
+
+    def test_match_many(self):
+        x = Var(int)
+        p = Pattern({'command': 'Stop', 'arg': x})
+        vals = iter([{'command': 'Stop', 'arg': 1},
+                     {'command': 'Start', 'arg': 2},
+                     {'command': 'Stop', 'arg': 'a'},
+                     {'command': 'Stop', 'arg': 4}])
+        self.assertEqual(list(p.match_many(vals)), [(0, {x: 1}), (3, {x: 4})])
+
+    def test_filter(self):
+        p = Pattern([Var(str), 1])
+        self.assertEqual(list(p.filter([['a', 1], ['b', 2], 3, ['c', 1]])),
+                         [['a', 1], ['c', 1]])
+
+    def test_template_same_as_subst(self):
+        x = Var(int)
+        s = Var(str)
+        o = Var()
+        p = Pattern({'reply': 'Ok', 'args': [x, s, [1, {'a': 'b'}]],
+                     'meta': {'seq': [1, 2, 3], 'who': o}, 'none': None})
+        t = p.template()
+        for bindings in [{x: 1, s: 'a', o: [5]}, {x: 'wrong', s: 'a'}, {}]:
+            self.assertEqual(t.subst(bindings), p.subst(bindings))
+        self.assertEqual(Pattern(x).template().subst({x: 3}), 3)
+        self.assertEqual(Pattern([]).template().subst({}), [])
+
+    def test_template_share_ground(self):
+        x = Var(int)
+        p = Pattern({'head': {'seq': [1, 2, 3]}, 'arg': x})
+        r1 = p.template().subst({x: 1})
+        r2 = p.template().subst({x: 1})
+        self.assertIsNot(r1['head'], r2['head'])
+        t = p.template(share_ground=True)
+        self.assertIs(t.subst({x: 1})['head'], p.val['head'])
+        self.assertEqual(list(t.subst_many([{x: 1}, {x: 2}])),
+                         [{'head': {'seq': [1, 2, 3]}, 'arg': 1},
+                          {'head': {'seq': [1, 2, 3]}, 'arg': 2}])
+
+    def test_expr(self):
+        x = Var(int)
+        y = Var(str)
+        e = (y == 'acc1') & ~(x > 99) | (x == -1)
+        for bindings in [{x: 5, y: 'acc1'}, {x: 100, y: 'acc1'},
+                         {x: 5, y: 'acc2'}, {x: -1, y: 'acc2'}]:
+            expected = (bindings[y] == 'acc1' and not bindings[x] > 99
+                        or bindings[x] == -1)
+            self.assertEqual(e.evaluate(bindings), expected)
+            self.assertEqual(e.compile()(bindings), expected)
+
+    def test_expr_short_circuit(self):
+        x = Var(int)
+        y = Var(int)
+        e = (x > 0) & (y > 0)
+        self.assertEqual(e.compile()({x: 0}), False)  # y is not needed
+        self.assertEqual(e.evaluate({x: 0}), False)
+
+    def test_compile_term(self):
+        x = Var(int)
+        self.assertEqual(Expr.compile_term(True)({}), True)
+        y = Var(int)
+        self.assertEqual(Expr.variables(~(x > 1) | (y == x)), {x, y})
+        self.assertEqual(Expr.variables(True), set())
+        self.assertEqual(Expr.compile_term(x)({x: 3}), 3)
+
+    def test_expr_in(self):
+        x = Var(str)
+        s = {'a'}
+        e = BinaryExpr('not in', x, s)
+        self.assertEqual(e.compile()({x: 'a'}), False)
+        s.add('b')
+        self.assertEqual(e.evaluate({x: 'b'}), False)
+        self.assertEqual(e.compile()({x: 'c'}), True)
+
+    def test_match_cache(self):
+        x = Var(int)
+        cache = Pattern({'command': 'Stop', 'arg': x}).cached(max_entries=2,
+                                                              plain=True)
+        stop = {'command': 'Stop', 'arg': 1}
+        self.assertEqual(cache.match(stop), {x: 1})
+        result = cache.match(dict(stop))
+        self.assertEqual(result, {x: 1})
+        result[x] = 2  # does not change the cached result
+        self.assertEqual(cache.match(stop), {x: 1})
+        self.assertEqual(cache.match({'command': 'Stop', 'arg': True}),
+                         {x: True})
+        self.assertIsNone(cache.match({'command': 'Stop', 'arg': 'a'}))
+        stop['arg'] = 3  # a changed value does not hit the old entry
+        self.assertEqual(cache.match(stop), {x: 3})
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 2)
+        self.assertIsNone(cache.match({'command': 'Stop', 'arg': {1}}))
+        self.assertEqual(cache.uncacheable, 1)
+        # by default, only frozen values are looked up
+        cache = Pattern({'command': 'Stop', 'arg': x}).cached()
+        self.assertEqual(cache.match(stop), {x: 3})
+        self.assertEqual(cache.match(freeze(stop)), {x: 3})
+        self.assertEqual(cache.match(freeze(stop)), {x: 3})
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual((len(cache), cache.uncacheable), (1, 1))
+
+    def test_match_cache_containers(self):
+        x = Var(list)
+        cache = Pattern({'args': x}).cached(max_bytes=10_000, plain=True)
+        event = {'args': [1]}
+        self.assertIs(cache.match(event)[x], event['args'])
+        other = {'args': [1]}
+        self.assertIs(cache.match(other)[x], other['args'])  # matched again
+        frozen = freeze({'args': [2]})
+        self.assertIs(cache.match(frozen)[x], frozen['args'])
+        # the result refers to a frozen list, so it is returned on a hit
+        self.assertIs(cache.match(freeze({'args': [2]}))[x], frozen['args'])
+        self.assertEqual(cache.hits, 2)
+        self.assertLessEqual(cache.n_bytes, 10_000)
+        # the size of a frozen value counts its canonical form
+        self.assertGreater(approx_size(frozen._key),
+                           approx_size(canonical({'args': [2]})))
+        with self.assertRaises(TypeError):
+            frozen['args'].append(2)
+        self.assertEqual(frozen, {'args': [2]})
+        self.assertEqual(hash(frozen), hash(freeze({'args': [2]})))
+
+    def test_json_matcher(self):
+        n = Var(int)
+        rest = Var(object)
+        pat = Pattern({'command': 'SetTicks', 'args': [n, n], 'meta': rest})
+        matcher = pat.json_matcher()
+        texts = [
+            '{"command": "SetTicks", "args": [3, 3], "meta": {"a": [1]}}',
+            '{"id": {"x": "}]\\"{"}, "meta": null, "command": "SetTicks",'
+            ' "args": [4,4]}',
+            '{"command": "SetTicks", "args": [3, 4], "meta": 1}',
+            '{"command": "SetTicks", "args": [3], "meta": 1}',
+            '{"command": "SetTicks", "args": [3, 3, 3], "meta": 1}',
+            '{"command": "Stop", "args": [3, 3], "meta": 1}',
+            '{"command": "SetTicks", "args": [3, 3]}',
+            '{"command": "SetTicks", "args": ["3", 3], "meta": 1}',
+            '{"command": "Set\\u0054icks", "args": [1, 1], "meta": 1}',
+            '["command", "SetTicks", "args", "meta"]',
+        ]
+        for text in texts[:8] + texts[9:]:
+            expected = pat.match(json.loads(text))
+            self.assertEqual(matcher.match(text.encode()), expected, text)
+            self.assertEqual(matcher.match(memoryview(text.encode())),
+                             expected, text)
+        self.assertEqual(matcher.match(texts[1]), {n: 4, rest: None})
+        # \\u escapes of the constants are missed by the prefilter only
+        self.assertIsNone(matcher.match(texts[8]))
+        self.assertEqual(pat.json_matcher(prefilter=False).match(texts[8]),
+                         {n: 1, rest: 1})
+
+    def test_json_matcher_malformed(self):
+        matcher = Pattern({'a': Var(int), 'b': {'c': 'd'}}).json_matcher()
+        self.assertEqual(matcher.match(b'{"a": 1, "b": {"c": "d"}} '),
+                         {matcher.pattern.val['a']: 1})
+        # the rest of the text after the last key is not looked at
+        self.assertIsNotNone(matcher.match(b'{"a": 1, "b": {"c": "d"}, x'))
+        for text in (b'{"a" 1, "b": {"c": "d"}}', b'\xff"a" "b" "c" "d"',
+                     b'{"b": {"c": "d"} "a": 1}',
+                     b'{"a": 1, "b": {"c": "e"}}'):
+            self.assertIsNone(matcher.match(text), text)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,202 @@
+"""Asyncio runtime for StateMachine instances."""
+
+import asyncio
+import unittest
+
+from statemachine import current_runtime, RunQueue
+
+
+class Runtime:
+    """Runs many StateMachines on one asyncio event loop.
+
+    Each machine that is added (see StateMachine.activate) gets a bounded
+    mailbox and a task that takes events from it and steps the machine.
+    Method send waits while the mailbox of the receiving machine is full,
+    so that producers are slowed down to the pace of the machines
+    (backpressure). A machine handles at most quantum events (or
+    spontaneous transitions) before it yields to the other tasks, so a busy
+    machine cannot starve the others.
+
+    Right after it is added, and after each event, a machine executes its
+    transitions without trigger as long as one of these is enabled. Their
+    guards are evaluated only when something they read may have changed: a
+    RunQueue tracks the writes to the state of each machine, and queues the
+    machines to evaluate. A write by another machine or from outside wakes
+    an idle machine. Every value in the response of a transition is passed
+    to on_response, together with the machine that emitted it. Machines
+    that are activated by the update of a transition are added to the
+    runtime of the machine that executes it.
+
+    Methods add, send, broadcast, join and close must be called while the
+    event loop runs."""
+
+    def __init__(self, mailbox_size=100, quantum=10, on_response=None):
+        self.mailbox_size = mailbox_size
+        self.quantum = quantum
+        self.on_response = on_response
+        self.mailboxes = {}  # machine -> asyncio.Queue
+        self.tasks = {}  # machine -> asyncio.Task
+        self.run_queue = RunQueue(wake=self.wake)
+
+    def add(self, machine):
+        if machine in self.mailboxes:
+            return
+        self.mailboxes[machine] = mailbox = asyncio.Queue(self.mailbox_size)
+        self.tasks[machine] = asyncio.get_running_loop().create_task(
+            self.run_machine(machine, mailbox))
+        self.run_queue.watch(machine)
+
+    def wake(self, machine):
+        """Make the task of machine, which was queued in the run queue,
+        evaluate its transitions without trigger. If its mailbox holds
+        events, it does so after the next one anyway."""
+        mailbox = self.mailboxes.get(machine)
+        if mailbox is not None and mailbox.empty():
+            # None stands for: execute transitions without trigger
+            mailbox.put_nowait(None)
+
+    async def send(self, machine, event):
+        """Put event in the mailbox of machine; wait if the mailbox is
+        full."""
+        await self.mailboxes[machine].put(event)
+
+    async def broadcast(self, event):
+        """Send event to every machine in the runtime."""
+        for mailbox in list(self.mailboxes.values()):
+            await mailbox.put(event)
+
+    async def join(self):
+        """Wait until all events sent so far have been handled, also by any
+        machines that were added in the meantime."""
+        while True:
+            mailboxes = list(self.mailboxes.values())
+            for mailbox in mailboxes:
+                await mailbox.join()
+            if len(mailboxes) == len(self.mailboxes):
+                return
+
+    async def close(self):
+        """Stop the tasks of all machines."""
+        for machine, task in self.tasks.items():
+            task.cancel()
+            self.run_queue.unwatch(machine)
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.mailboxes = {}
+        self.tasks = {}
+
+    def deliver(self, machine, event):
+        """Step machine with event (or without event, if it is None), and
+        emit the response. Return whether a transition was executed."""
+        response = machine.step(event)
+        if response is None:
+            return False
+        if self.on_response is not None:
+            for value in response:
+                self.on_response(machine, value)
+        return True
+
+    async def run_machine(self, machine, mailbox):
+        current_runtime.set(self)  # for machines activated by an update
+        handled = 0
+        while True:
+            event = await mailbox.get()
+            try:
+                if event is not None:
+                    self.deliver(machine, event)
+                    handled += 1
+                while self.run_queue.take(machine):
+                    self.deliver(machine, None)
+                    handled += 1
+                    if handled >= self.quantum:
+                        handled = 0
+                        await asyncio.sleep(0)
+            except Exception as e:
+                print(f'error: {machine} failed on event {event}: {e!r}')
+            finally:
+                mailbox.task_done()
+            if handled >= self.quantum:
+                handled = 0
+                await asyncio.sleep(0)
+
+
+class TestRuntime(unittest.TestCase):
+
+    def test_balances(self):
+        from bank import KickOff, Acc
+        balances = []
+
+        async def run():
+            runtime = Runtime()
+            KickOff().activate(runtime)
+            for y, a in [('acc1', 10), ('acc2', 20), ('acc1', 5),
+                         ('acc1', 200), ('acc1', 1)]:
+                await runtime.broadcast({'name': 'transfer',
+                                         'arg1': y, 'arg2': a})
+                await runtime.join()
+            for m in runtime.mailboxes:
+                if isinstance(m, Acc):
+                    balances.append(m.state.total)
+            await runtime.close()
+
+        asyncio.run(run())
+        # acc1: 10 + 5 + 200 (total was still < 100), then 1 is refused
+        self.assertEqual(balances, [215, 20])
+
+    def test_spontaneous_and_responses(self):
+        from task_control import TaskControl
+        responses = []
+
+        async def run():
+            runtime = Runtime(
+                on_response=lambda m, value: responses.append(value))
+            tc = TaskControl()
+            tc.activate(runtime)
+            await runtime.send(tc, {'command': 'Start', 'arg': 1})
+            await runtime.join()
+            await runtime.close()
+
+        asyncio.run(run())
+        self.assertEqual(responses, [{'reply': None},
+                                     {'notification': 'Ready', 'arg': 1},
+                                     {'notification': 'Completed', 'arg': 1}])
+
+    def test_write_wakes_idle_machine(self):
+        from statemachine import TestStateMachine
+        m = TestStateMachine.Task()
+
+        async def run():
+            runtime = Runtime()
+            runtime.add(m)
+            await runtime.send(m, {'command': 'Start', 'arg': 4})
+            await runtime.join()
+            self.assertIs(m.state.loc, m.on)  # count 4 < 10: idle
+            m.state.count = 20
+            await runtime.join()
+            await runtime.close()
+
+        asyncio.run(run())
+        self.assertIs(m.state.loc, m.done)
+
+    def test_run_queue_does_not_grow(self):
+        from statemachine import TestStateMachine
+        machines = [TestStateMachine.Task() for _ in range(100)]
+
+        async def run():
+            runtime = Runtime()
+            for m in machines:
+                runtime.add(m)
+            for arg in (1, 2, 3):
+                for m in machines:
+                    await runtime.send(m, {'command': 'Start', 'arg': arg})
+                    await runtime.send(m, {'command': 'Stop'})
+                await runtime.join()
+            self.assertEqual(len(runtime.run_queue), 0)
+            self.assertLessEqual(len(runtime.run_queue.queue), 16)
+            await runtime.close()
+
+        asyncio.run(run())
+        self.assertEqual([m.state.count for m in machines], [6] * 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
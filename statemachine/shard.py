@@ -0,0 +1,288 @@
+"""Multi-process execution of StateMachines, sharded by a routing key."""
+
+import multiprocessing
+import unittest
+import zlib
+
+from statemachine import current_runtime, RunQueue
+
+
+class ShardedExecutor:
+    """Runs StateMachines in a number of worker processes (shards).
+
+    Each machine has a routing key, given by machine_key(cls, args, kwargs)
+    for a machine created by cls(*args, **kwargs), e.g. the account id of
+    an Acc. Each event has a routing key too, given by event_key(event).
+    A machine lives on the shard determined by a hash of its key, and an
+    event with a key is delivered only to the machines with the same key,
+    on that shard. Machines with key None are global: they live on shard 0
+    and receive all events. Events with key None go to all machines.
+
+    This router process numbers the events, and collects them in a batch
+    per shard, which is sent to the workers when batch_size events have
+    been collected, or on flush. Global machines are served first, so that
+    machines they spawn (KickOff creating an Acc) are created on their home
+    shard before the other shards get the events of the same batch. A
+    machine spawned by a keyed machine for another shard is created there
+    from the next batch on. A spawned machine never receives the event
+    during which it was spawned.
+
+    Machines are passed between processes as (class, args, kwargs), see
+    StateMachine.init_args, so their classes must be importable, and
+    machine_key and event_key must be picklable (module-level functions)
+    unless processes are started by forking. Responses are passed to
+    on_response in the order of the events that caused them."""
+
+    def __init__(self, num_shards, event_key, machine_key, batch_size=1000,
+                 on_response=None):
+        self.num_shards = num_shards
+        self.event_key = event_key
+        self.machine_key = machine_key
+        self.batch_size = batch_size
+        self.on_response = on_response
+        self.seq = 0  # number of the last event
+        self.has_global = False
+        self.spawns = [[] for _ in range(num_shards)]
+        self.events = [[] for _ in range(num_shards)]
+        self.n_pending = 0
+        self.connections = []
+        self.processes = []
+        for shard in range(num_shards):
+            conn, worker_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=ShardWorker.main,
+                args=(worker_conn, shard, num_shards, machine_key),
+                daemon=True)
+            process.start()
+            self.connections.append(conn)
+            self.processes.append(process)
+
+    def shard_of(self, key):
+        return shard_of(key, self.num_shards)
+
+    def spawn(self, cls, *args, **kwargs):
+        """Create machine cls(*args, **kwargs) on its home shard."""
+        self.route_spawn((self.seq, cls, args, kwargs))
+
+    def route_spawn(self, spawn):
+        _, cls, args, kwargs = spawn
+        key = self.machine_key(cls, args, kwargs)
+        if key is None:
+            self.has_global = True
+        self.spawns[self.shard_of(key)].append(spawn)
+
+    def send(self, event):
+        self.seq += 1
+        key = self.event_key(event)
+        if key is None:
+            shards = range(self.num_shards)
+        elif self.has_global and self.shard_of(key) != 0:
+            shards = (0, self.shard_of(key))
+        else:
+            shards = (self.shard_of(key),)
+        for shard in shards:
+            self.events[shard].append((self.seq, key, event))
+        self.n_pending += 1
+        if self.n_pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Send the pending events to the shards, and wait until they have
+        been handled."""
+        responses = []
+        shards = list(range(self.num_shards))
+        if self.has_global:
+            # global machines first, for the spawns of this batch
+            responses.extend(self.run_batches([0]))
+            shards.remove(0)
+        responses.extend(self.run_batches(shards))
+        self.n_pending = 0
+        if self.on_response is not None:
+            responses.sort(key=lambda seq_value: seq_value[0])
+            for _, value in responses:
+                self.on_response(value)
+
+    def run_batches(self, shards):
+        for shard in shards:
+            self.connections[shard].send(
+                ('batch', self.spawns[shard], self.events[shard]))
+            self.spawns[shard] = []
+            self.events[shard] = []
+        responses = []
+        for shard in shards:
+            shard_responses, spawns = self.connections[shard].recv()
+            responses.extend(shard_responses)
+            for spawn in spawns:
+                self.route_spawn(spawn)
+        return responses
+
+    def query(self, fn):
+        """Flush, and return the list of fn(machine) for all machines on
+        all shards."""
+        self.flush()
+        for conn in self.connections:
+            conn.send(('query', fn))
+        results = []
+        for conn in self.connections:
+            results.extend(conn.recv())
+        return results
+
+    def close(self):
+        self.flush()
+        for conn in self.connections:
+            conn.send(('stop',))
+        for process in self.processes:
+            process.join()
+
+
+def shard_of(key, num_shards):
+    """Return the shard of a routing key. This uses a stable hash, unlike
+    hash() of a str, which differs between processes."""
+    if key is None:
+        return 0
+    return zlib.crc32(repr(key).encode()) % num_shards
+
+
+class ShardWorker:
+    """The machines of one shard, in a worker process. The worker is the
+    current runtime of its process, so that it is told about machines that
+    are activated by updates."""
+
+    def __init__(self, shard, num_shards, machine_key):
+        self.shard = shard
+        self.num_shards = num_shards
+        self.machine_key = machine_key
+        self.keyed = {}  # key -> list of (machine, seq it was spawned at)
+        self.global_machines = []  # ditto, for key None
+        self.seq = 0  # number of the event being handled
+        self.responses = []  # (seq, value)
+        self.remote_spawns = []  # (seq, cls, args, kwargs)
+        self.run_queue = RunQueue()
+
+    @staticmethod
+    def main(conn, shard, num_shards, machine_key):
+        worker = ShardWorker(shard, num_shards, machine_key)
+        current_runtime.set(worker)
+        while True:
+            message = conn.recv()
+            if message[0] == 'batch':
+                conn.send(worker.run_batch(message[1], message[2]))
+            elif message[0] == 'query':
+                conn.send([message[1](m) for m, _ in worker.entries()])
+            else:
+                return
+
+    def entries(self):
+        result = list(self.global_machines)
+        for entries in self.keyed.values():
+            result.extend(entries)
+        return result
+
+    def run_batch(self, spawns, events):
+        for seq, cls, args, kwargs in spawns:
+            self.seq = seq
+            cls(*args, **kwargs).activate(self)
+        for seq, key, event in events:
+            self.seq = seq
+            if key is None:
+                targets = self.entries()
+            else:
+                targets = self.keyed.get(key, []) + self.global_machines
+            for m, since in targets:
+                if since < seq:
+                    self.deliver(m, event)
+            # machines whose state was written by the update of another
+            self.run_queue.run(self.deliver_spontaneous)
+        responses, self.responses = self.responses, []
+        remote_spawns, self.remote_spawns = self.remote_spawns, []
+        return responses, remote_spawns
+
+    def add(self, machine):
+        args, kwargs = machine.init_args
+        key = self.machine_key(type(machine), args, kwargs)
+        if shard_of(key, self.num_shards) != self.shard:
+            self.remote_spawns.append((self.seq, type(machine), args, kwargs))
+            return
+        entry = (machine, self.seq)
+        if key is None:
+            self.global_machines.append(entry)
+        else:
+            self.keyed.setdefault(key, []).append(entry)
+        self.run_queue.watch(machine)
+        self.deliver_spontaneous(machine)
+
+    def deliver(self, machine, event):
+        """Step machine, and after an event also execute its transitions
+        without trigger. Return whether a transition was executed."""
+        try:
+            response = machine.step(event)
+        except Exception as e:
+            print(f'error: {machine} failed on event {event}: {e!r}')
+            return False
+        if response is None:
+            return False
+        self.responses.extend((self.seq, value) for value in response)
+        if event is not None:
+            self.deliver_spontaneous(machine)
+        return True
+
+    def deliver_spontaneous(self, machine):
+        """Execute the transitions without trigger of machine as long as
+        one is enabled, if the run queue says that one may be."""
+        while self.run_queue.take(machine):
+            self.deliver(machine, None)
+
+
+def account_key(cls, args, kwargs):
+    """Routing key for the machines of bank.py: the account of an Acc."""
+    from bank import Acc
+    return args[0] if cls is Acc else None
+
+
+def transfer_key(event):
+    """Routing key for the events of bank.py."""
+    return event.get('arg1')
+
+
+def balance(m):
+    args, _ = m.init_args
+    return (args[0], m.state.total) if args else (None, None)
+
+
+class TestShardedExecutor(unittest.TestCase):
+
+    def test_shard_of(self):
+        self.assertEqual(shard_of('acc1', 4), shard_of('acc1', 4))
+        self.assertEqual(shard_of(None, 4), 0)
+
+    def test_bank(self):
+        from bank import KickOff
+        events = [{'name': 'transfer', 'arg1': f'acc{i % 7}', 'arg2': i}
+                  for i in range(40)]
+        for batch_size in (1, 5, 100):
+            executor = ShardedExecutor(3, transfer_key, account_key,
+                                       batch_size=batch_size)
+            executor.spawn(KickOff)
+            for event in events:
+                executor.send(event)
+            balances = dict(b for b in executor.query(balance)
+                            if b[0] is not None)
+            executor.send({'command': 'reconcile'})
+            totals = [b[1] for b in executor.query(balance)
+                      if b[0] is not None]
+            executor.close()
+            self.assertEqual(totals, [0] * 7)
+            # each account starts with its first transfer, and accepts
+            # transfers while its total is below 100
+            expected = {}
+            for event in events:
+                y, a = event['arg1'], event['arg2']
+                if y not in expected:
+                    expected[y] = a
+                elif expected[y] < 100:
+                    expected[y] += a
+            self.assertEqual(balances, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
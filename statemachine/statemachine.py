@@ -1,11 +1,39 @@
 """State machines with reflective features."""
 
 
-from pat2 import Var
+from pat2 import Var, Pattern, FrozenPattern, PatternSet, Expr
+import collections
+import contextlib
+import contextvars
+import functools
+import inspect
+import io
+import time
 import types
+import unittest
 
 
-class StateMachine:
+# The runtime that executes the current transition, if any. StateMachines
+# that are activated by the update of a transition are added to it.
+current_runtime = contextvars.ContextVar('current_runtime', default=None)
+
+
+class MachineClass(type):
+    """The type of StateMachine and its subclasses. It creates the instances
+    of flyweight subclasses from their Template, without calling
+    __init__."""
+
+    def __call__(cls, *args, **kwargs):
+        if cls.flyweight:
+            template = cls.__dict__.get('_template')
+            if template is None:
+                template = cls._template = Template(cls)
+            if template.prototype is not None:
+                return template.instantiate(args, kwargs)
+        return super().__call__(*args, **kwargs)
+
+
+class StateMachine(metaclass=MachineClass):
     """State Machine, possibly with data variables (aka Extended State Machine).
 
     Specific types of state machines inherit from this class. A StateMachine
@@ -18,7 +46,31 @@ class StateMachine:
     example, a transition that should be present as a self loop on all
     locations has to be defined only once, this way. Another example is an
     "error" transition that goes from every location to a designated error
-    location. """
+    location.
+
+    If class attribute flyweight is True, the locations, transitions and
+    structure are built only once for the class, and shared by all its
+    instances; see Template. """
+
+    # an Instrumentation, see instrument()
+    instrumentation = None
+
+    # a Journal, see record()
+    journal = None
+
+    # whether the instances share a Template
+    flyweight = False
+
+    # the bindings of the constructor parameters of a flyweight instance
+    init_bindings = None
+
+    def __new__(cls, *args, **kwargs):
+        """Record the arguments of the constructor in attribute init_args, so
+        that the machine can be created again, e.g. in another process."""
+        m = super().__new__(cls)
+        m.init_args = (args, kwargs)
+        return m
+
     def __init__(self):
         #print('__init__ of StateMachine')
         self.structure = Structure()
@@ -35,9 +87,13 @@ class StateMachine:
             if value.name is not None:
                 print(f'warning: renaming Transition {value.name} to {name}')
             value.name = name
+        if name == 'state' and type(value) is State and not value._vars:
+            value = State.for_machine(type(self), value)
         # Other allowed attributes are:
         # - state
         # - structure
+        # - init_args
+        # - init_bindings
         # TODO disallow others?
         object.__setattr__(self, name, value)
 
@@ -48,13 +104,106 @@ class StateMachine:
     def add_transition(self, trans, source, target):
         self.structure.add_transition(trans, source, target)
 
-    def check(self):
-        # TODO various checks:
-        # - ...
-        pass
-
-    def activate(self):
-        pass
+    def step(self, event=None):
+        """Execute one transition for event, from the current location.
+
+        The candidate transitions are those leaving the current location
+        whose trigger matches event, or, if event is None, those without a
+        trigger. The first candidate (in the order in which the transitions
+        were added) whose condition holds is executed: its update is called
+        with the trigger bindings in param_bindings, the location is set to
+        its target, and its response is returned as a list of values, with
+        the bindings substituted. If no transition is enabled, None is
+        returned and the state is unchanged."""
+        if self.journal is not None:
+            return self.journal.step(self, event)
+        fired = self.fire(event, instrumentation=self.instrumentation)
+        return None if fired is None else fired[1]
+
+    def fire(self, event=None, respond=True, instrumentation=None):
+        """Like step, but return the pair (bound_trans, response) of the
+        executed transition, or None. If respond is false, the response is
+        not computed, and is None. If instrumentation is given, counts and
+        latencies are recorded in it (see instrument)."""
+        state = self.state
+        clock = time.perf_counter_ns
+        stats = None
+        for bound_trans, params in self.structure.candidates(
+                state.loc, event, self, instrumentation):
+            if instrumentation is not None:
+                stats = instrumentation.transition(self, bound_trans)
+                stats.matches += 1
+                start = clock()
+            bindings = dict(state._bindings)
+            if self.init_bindings:
+                bindings.update(self.init_bindings)
+            bindings.update(params)
+            enabled = bound_trans['guard'](bindings)
+            if stats is not None:
+                stats.guard.record(clock() - start)
+                if not enabled:
+                    stats.rejections += 1
+            if not enabled:
+                continue
+            trans = bound_trans['transition']
+            trans.param_bindings = params
+            try:
+                if stats is not None:
+                    start = clock()
+                if trans.update is not None:
+                    trans.update(self)
+                if stats is not None:
+                    stats.update.record(clock() - start)
+                    start = clock()
+                if respond:
+                    # the response may refer to state variables set by update
+                    bindings.update(state._bindings)
+                    response = bound_trans['response'].subst(bindings)
+                else:
+                    response = None
+                if stats is not None:
+                    stats.response.record(clock() - start)
+            finally:
+                trans.param_bindings = {}
+            state.loc = bound_trans['target']
+            if stats is not None:
+                stats.firings += 1
+            return bound_trans, response
+        return None
+
+    def instrument(self, instrumentation):
+        """Record statistics of the steps of this machine in
+        instrumentation (see instrument.py), or stop recording if it is
+        None. To instrument all instances of a class, assign the class
+        attribute instead."""
+        self.instrumentation = instrumentation
+
+    def record(self, journal):
+        """Record the events delivered to this machine, and its responses,
+        in journal (see journal.py), or stop recording if it is None. To
+        record all machines, including those activated by updates, assign
+        the class attribute of StateMachine instead."""
+        self.journal = journal
+
+    def check(self, alphabet, **options):
+        """Explore the states that this machine, and the machines that it
+        activates, can reach from its current state through the events in
+        alphabet and transitions without trigger. Return a Report of the
+        deadlocks, unreachable locations and transitions that never fire;
+        see explore.explore for the options."""
+        from explore import explore
+        return explore([self], alphabet, **options)
+
+    def activate(self, runtime=None):
+        """Add this machine to runtime, so that it starts processing events.
+        By default, this is the runtime that executes the current
+        transition. Outside of a runtime, this does nothing."""
+        if self.journal is not None:
+            self.journal.spawned(self)
+        if runtime is None:
+            runtime = current_runtime.get()
+        if runtime is not None:
+            runtime.add(self)
 
     # TODO also check for adding attributes with dupl names
 
@@ -63,9 +212,17 @@ class Structure:
     """Graph structure of a StateMachine.
 
     Each state machine has a structure, which is the graph formed by
-    locations (nodes) and transitions (edges). """
+    locations (nodes) and transitions (edges). Besides the list of edges in
+    graph, the structure keeps an index that maps each source location to a
+    Dispatch, so that the transitions that can be triggered by an event are
+    found without scanning all edges. """
     def __init__(self):
         self.graph = []
+        self.index = {}
+        # Transitions are typically added before their trigger, condition,
+        # etc. are set (see Transition.__init__), so new edges are indexed
+        # at the first lookup after they were added.
+        self.pending = []
 
     def add_transition(self, trans, source, target):
         bound_trans = {
@@ -74,6 +231,88 @@ class Structure:
             'target': target,
         }
         self.graph.append(bound_trans)
+        self.pending.append(bound_trans)
+
+    def index_pending(self):
+        for bound_trans in self.pending:
+            trans = bound_trans['transition']
+            # a missing condition means that the transition is always enabled
+            condition = True if trans.condition is None else trans.condition
+            bound_trans['guard'] = Expr.compile_term(condition)
+            bound_trans['reads'] = Expr.variables(condition)
+            response = [] if trans.response is None else trans.response
+            bound_trans['response'] = Pattern(response).template()
+            dispatch = self.index.get(bound_trans['source'])
+            if dispatch is None:
+                dispatch = self.index[bound_trans['source']] = Dispatch()
+            dispatch.add(bound_trans)
+        self.pending = []
+
+    def spontaneous_reads(self, source):
+        """Return the set of Vars that the conditions of the transitions
+        without trigger from source read, or None if there are no such
+        transitions."""
+        if self.pending:
+            self.index_pending()
+        dispatch = self.index.get(source)
+        if dispatch is None or not dispatch.spontaneous:
+            return None
+        return dispatch.reads
+
+    def candidates(self, source, event, machine=None,
+                   instrumentation=None):
+        """Yield the pairs (bound_trans, bindings) of the transitions from
+        source whose trigger matches event, in the order in which they were
+        added. If event is None, yield those without a trigger instead. If
+        instrumentation is given, record the outcome and latency of each
+        trigger match of machine in it."""
+        if self.pending:
+            self.index_pending()
+        dispatch = self.index.get(source)
+        if dispatch is None:
+            return
+        if event is None:
+            for bound_trans in dispatch.spontaneous:
+                yield bound_trans, {}
+            return
+        clock = time.perf_counter_ns
+        for i, _, match in dispatch.triggers.candidates(event):
+            if instrumentation is not None:
+                start = clock()
+            bindings = match(event)
+            if instrumentation is not None:
+                elapsed = clock() - start
+                stats = instrumentation.pattern(
+                    machine, dispatch.bound_transitions[i])
+                stats.match.record(elapsed)
+                if bindings is None:
+                    stats.misses += 1
+                else:
+                    stats.matches += 1
+            if bindings is not None:
+                yield dispatch.bound_transitions[i], bindings
+
+
+class Dispatch:
+    """The transitions leaving one location, indexed on the constant parts
+    of their triggers (such as the value of 'command') in a PatternSet.
+    Triggers are FrozenPatterns, so the instances of a StateMachine class
+    share the compiled matchers of their triggers."""
+    def __init__(self):
+        self.triggers = PatternSet()
+        # bound transitions, by the index of their trigger in triggers
+        self.bound_transitions = []
+        self.spontaneous = []  # bound transitions without trigger
+        self.reads = set()  # Vars that the conditions of those read
+
+    def add(self, bound_trans):
+        trigger = bound_trans['transition'].trigger
+        if trigger is None:
+            self.spontaneous.append(bound_trans)
+            self.reads |= bound_trans['reads']
+        else:
+            self.triggers.add(FrozenPattern(trigger))
+            self.bound_transitions.append(bound_trans)
 
 
 class Location:
@@ -111,24 +350,28 @@ class Transition:
     the trigger and response patterns, and that may also occur in the
     condition and update. When the transition is executed, these parameters
     will become bound, e.g. by matching the trigger pattern to an incoming
-    event. Any such bindings are stored in the instance attribute
-    param_bindings, but only during the execution of the transition. After
-    each execution of the transition, param_bindings is reset to the empty
-    dictionary. Parameters must be instances of Var. The override of
-    __getattribute__ makes sure that when a parameter is accessed, its bound
-    value (if any) is returned. """
+    event. Any such bindings are set through param_bindings, but only during
+    the execution of the transition. After each execution of the transition,
+    param_bindings is reset to the empty dictionary. Parameters must be
+    instances of Var. A parameter attribute holds its Var while it is
+    unbound and its value while it is bound, so reading a parameter is a
+    plain attribute access; the Vars themselves are kept in _params. """
+    __slots__ = ('name', 'trigger', 'condition', 'update', 'response',
+                 '_params', '_machine', '__dict__')
+
     def __init__(self, sm=None, name=None, source=None, target=None):
         """sm is the StateMachine to which this Transition is added; name is
         the name of this Transition. Note that source and target are not
         stored in the Transition; they go into the StateMachine Structure."""
         if sm is None and name is not None:
             print('error: Transition with name but no StateMachine')
+        object.__setattr__(self, '_params', {})  # parameter name -> Var
+        object.__setattr__(self, '_machine', sm)
         self.name = name
         self.trigger = None
         self.condition = None
         self.update = None
         self.response = None
-        self.param_bindings = {}
         if sm is not None:
             if name is None:
                 print('error: adding Transition without name on StateMachine')
@@ -147,33 +390,99 @@ class Transition:
 
     def __setattr__(self, name, new_value):
         if name == 'update':
-            object.__setattr__(self, name,
-                               types.MethodType(lambda x: new_value(), self)
-                               )
+            if new_value is not None:
+                new_value = self.bind_update(new_value)
+            object.__setattr__(self, name, new_value)
             return
-        try:
-            existing_value = object.__getattribute__(self, name)
-            if isinstance(existing_value, Var):
-                if isinstance(new_value, existing_value.typ):
-                    self.param_bindings[existing_value] = new_value
-                else:
-                    print('type error')
-            else:
-                # if the attribute exists and is not a Var, just set new value
+        param = self._params.get(name)
+        if param is not None:
+            if param.accepts(new_value):
                 object.__setattr__(self, name, new_value)
-        except AttributeError:
-            if isinstance(new_value, Var):
-                new_value.name = name
-                # TODO also set fully qualified name (e.g. SM().start.i ?)
-            object.__setattr__(self, name, new_value)
-
-    def __getattribute__(self, item):
-        attr_value = object.__getattribute__(self, item)
-        if isinstance(attr_value, Var):
-            #print(f'__getattribute__({m}, {attr_value}) of Var')
-            if attr_value in self.param_bindings:
-                return self.param_bindings[attr_value]
-        return attr_value
+            else:
+                print('type error')
+            return
+        if isinstance(new_value, Var) and not hasattr(self, name):
+            new_value.name = name
+            # TODO also set fully qualified name (e.g. SM().start.i ?)
+            self._params[name] = new_value
+        # if the attribute exists and is not a parameter, just set new value
+        object.__setattr__(self, name, new_value)
+
+    @property
+    def param_bindings(self):
+        """The bindings of the parameters that are currently bound."""
+        bindings = {}
+        for name, param in self._params.items():
+            value = getattr(self, name)
+            if value is not param:
+                bindings[param] = value
+        return bindings
+
+    @param_bindings.setter
+    def param_bindings(self, bindings):
+        """Bind the parameters to their values in bindings, and unbind the
+        other parameters."""
+        for name, param in self._params.items():
+            object.__setattr__(self, name, bindings.get(param, param))
+
+    def bind_update(self, update):
+        """Return a method that calls function update.
+
+        An update function usually refers to its transition through a
+        variable of the enclosing function, such as t in
+        'with Transition(...) as t'. That variable is rebound by the next
+        with statement, long before the update is called. So the closure
+        cells of update that hold this transition now are made to hold it
+        again on every call.
+
+        The method takes the machine that executes the transition. If that
+        is not the machine of this transition, which is the prototype of a
+        flyweight class (see Template), the cells that hold the prototype
+        or one of its constructor parameters are made to hold the machine
+        and its own arguments, during the call."""
+        cells = []
+        swaps = []  # cells that hold the machine or a constructor parameter
+        sm = self._machine
+        for cell in update.__closure__ or ():
+            try:
+                value = cell.cell_contents
+            except ValueError:
+                continue  # cell is still empty
+            if value is self:
+                cells.append(cell)
+            elif value is sm and sm is not None or isinstance(value, Param):
+                swaps.append((cell, value))
+
+        if len(swaps) == 1 and swaps[0][1] is sm:
+            # the usual case, which is kept fast
+            swap_cell = swaps[0][0]
+
+            def swap_update(machine):
+                saved = swap_cell.cell_contents
+                swap_cell.cell_contents = machine
+                try:
+                    return update()
+                finally:
+                    swap_cell.cell_contents = saved
+        else:
+            def swap_update(machine):
+                saved = [cell.cell_contents for cell, _ in swaps]
+                for cell, value in swaps:
+                    cell.cell_contents = (machine if value is sm
+                                          else machine.init_bindings[value])
+                try:
+                    return update()
+                finally:
+                    for (cell, _), value in zip(swaps, saved):
+                        cell.cell_contents = value
+
+        def call_update(trans, machine=None):
+            for cell in cells:
+                cell.cell_contents = trans
+            if machine is None or machine is sm or not swaps:
+                return update()
+            return swap_update(machine)
+        return types.MethodType(call_update, self)
 
     def __enter__(self):
         """Support use of Transition() in with statements with a target."""
@@ -185,42 +494,514 @@ class Transition:
 
 class State:
     """An instance of State represents a state vector of a StateMachine. Its
-    attributes must be Vars. Any set or get of such an attribute is
-    redirected via the current Var bindings of the State instance."""
+    attributes must be Vars, which are declared by assigning a Var to a new
+    attribute. Assigning a value to a declared attribute binds its Var.
+
+    An attribute holds its Var while it is unbound, and its value after it is
+    bound, so reading an attribute is a plain attribute access. Only
+    assignments are intercepted, to check the type of the value. The Vars
+    themselves are kept in _vars, and _bindings gives the bindings of the
+    bound ones.
+
+    The first State that is assigned to an instance of a StateMachine
+    subclass keeps its attributes in a __dict__. The States of the later
+    instances of that subclass are instances of a subclass of State that is
+    generated for it, with __slots__ for the attributes of the first one
+    (see for_machine). Attributes that were not declared by the first
+    instance still go into the __dict__ of such a State.
+
+    If _on_write is set (see add_write_hook), it is called with the Var of
+    each attribute that is assigned a value."""
+    __slots__ = ('_vars', '__dict__')
+
+    _on_write = None
+
     def __init__(self):
-        self._bindings = {}
+        object.__setattr__(self, '_vars', {})  # attribute name -> Var
 
     def __setattr__(self, name, new_value):
-        #print(f'__setattr__({m}, {name}, {new_value})')
-        if name in ['_bindings', '__class__']:
-            object.__setattr__(self, name, new_value)
-            return
-        try:
-            existing_value = object.__getattribute__(self, name)
-            # attribute already exists (must be Var); set new value in _bindings
-            if not isinstance(existing_value, Var):
-                print(f'internal error: attribute {name} of {self} is not Var')
-            if isinstance(new_value, existing_value.typ):
-                self._bindings[existing_value] = new_value
+        var = self._vars.get(name)
+        if var is not None:
+            # attribute already exists; bind its Var
+            if var.accepts(new_value):
+                object.__setattr__(self, name, new_value)
+                if self._on_write is not None:
+                    self._on_write(var)
+            elif isinstance(new_value, Param):
+                # the initial value of a flyweight instance (see Template)
+                object.__setattr__(self, name, new_value)
             else:
                 print('type error')
-        except AttributeError:
-            # new attribute; set new value (must be Var) on self
-            if not isinstance(new_value, Var):
-                print('new state attribute must be assigned a Var')
+        elif isinstance(new_value, Var):
+            # new attribute; declare it
             new_value.name = name  # store name in Var for convenience
+            self._vars[name] = new_value
             object.__setattr__(self, name, new_value)
+        else:
+            print('new state attribute must be assigned a Var')
+
+    @property
+    def _bindings(self):
+        bindings = {}
+        for name, var in self._vars.items():
+            value = getattr(self, name)
+            if value is not var:
+                bindings[var] = value
+        return bindings
+
+    @staticmethod
+    def for_machine(machine_class, state):
+        """Return the State to be used for a new instance of machine_class,
+        which was given state (a new, empty State)."""
+        state_class = machine_class.__dict__.get('_state_class')
+        if state_class is not None:
+            return state_class()
+        first = machine_class.__dict__.get('_first_state')
+        if first is None:
+            machine_class._first_state = state
+            return state
+        machine_class._state_class = type(
+            f'{machine_class.__name__}State', (State,),
+            {'__slots__': tuple(first._vars)})
+        return machine_class._state_class()
+
+
+class WriteHooks(list):
+    """The write hooks of a State, if it has more than one."""
+
+    def __call__(self, var):
+        for hook in self:
+            hook(var)
+
+
+def add_write_hook(state, hook):
+    """Make state call hook with the Var of each attribute that is assigned
+    a value, besides any other hooks (used by RunQueue and Checkpointer)."""
+    current = state._on_write
+    if current is None:
+        object.__setattr__(state, '_on_write', hook)
+    elif isinstance(current, WriteHooks):
+        current.append(hook)
+    else:
+        object.__setattr__(state, '_on_write', WriteHooks([current, hook]))
+
+
+def remove_write_hook(state, hook):
+    current = state._on_write
+    if current is hook:
+        object.__setattr__(state, '_on_write', None)
+    elif isinstance(current, WriteHooks) and hook in current:
+        current.remove(hook)
+        if len(current) == 1:
+            object.__setattr__(state, '_on_write', current[0])
+
+
+class Param(Var):
+    """A constructor parameter of a flyweight StateMachine class, which
+    stands for the argument while its Template is built."""
+
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
 
-    def __getattribute__(self, item):
-        if item in ['_bindings', '__class__']:
-            return object.__getattribute__(self, item)
-        # if item exists, it must be a Var
-        attr_value = object.__getattribute__(self, item)
-        if not isinstance(attr_value, Var):
-            print(f'internal error: attribute {item} of {self} is not Var')
-        if attr_value in self._bindings:
-            # if bound, return bound value
-            return self._bindings[attr_value]
+class Template:
+    """The shared part of the instances of a flyweight StateMachine class:
+    its locations, transitions and structure, including the compiled
+    triggers, guards and responses.
+
+    To build it, __init__ is called once, on a prototype, with a Param for
+    each argument. A Param may be used in conditions and responses, where
+    it is bound to the argument when an instance fires a transition (see
+    init_bindings), as the initial value of a state variable, and in
+    updates. The cells of update closures that hold the prototype or a
+    Param hold the instance and its argument during the call (see
+    Transition.bind_update). An instance gets a copy of the attributes of
+    the prototype, and a State with the initial values, where a list,
+    dict, set or bytearray is copied.
+
+    So __init__ must not compute with its arguments, or use one in a
+    trigger: the class is then built per instance, with a warning. And the
+    transitions of the instances are the same objects: a condition must
+    refer to state variables through their Vars, not to a container that
+    is a state value, and an update must not step another instance of its
+    class through the same transition."""
+
+    mutable = (list, dict, set, bytearray)
+
+    def __init__(self, machine_class):
+        self.machine_class = machine_class
+        self.prototype = None
+        signature = inspect.signature(machine_class.__init__)
+        parameters = list(signature.parameters.values())[1:]  # not self
+        if any(p.kind in (p.VAR_POSITIONAL, p.VAR_KEYWORD)
+               for p in parameters):
+            print(f'warning: {machine_class.__name__} cannot be a flyweight: '
+                  f'__init__ takes *args or **kwargs')
+            return
+        self.signature = signature.replace(parameters=parameters)
+        self.params = {p.name: Param(p.name) for p in parameters}
+        args = [self.params[p.name] for p in parameters
+                if p.kind != p.KEYWORD_ONLY]
+        kwargs = {p.name: self.params[p.name] for p in parameters
+                  if p.kind == p.KEYWORD_ONLY}
+        self.positional = args if not kwargs else None
+        prototype = object.__new__(machine_class)
+        try:
+            machine_class.__init__(prototype, *args, **kwargs)
+        except Exception as e:
+            print(f'warning: {machine_class.__name__} cannot be a flyweight: '
+                  f'{e!r}')
+            return
+        for bound_trans in prototype.structure.graph:
+            trans = bound_trans['transition']
+            if has_param(trans.trigger):
+                print(f'warning: {machine_class.__name__} cannot be a '
+                      f'flyweight: the trigger of {trans.name} refers to a '
+                      f'constructor parameter')
+                return
+        self.prototype = prototype
+        self.attributes = {name: value for name, value
+                           in vars(prototype).items() if name != 'state'}
+        state = prototype.state
+        self.state_vars = state._vars
+        self.state_class = type(State.for_machine(machine_class, State()))
+        self.shared = []  # (name, value)
+        self.copied = []  # (name, value)
+        self.bound = []  # (name, Var, Param)
+        for name, var in state._vars.items():
+            value = getattr(state, name)
+            if isinstance(value, Param):
+                self.bound.append((name, var, value))
+            elif type(value) in self.mutable:
+                self.copied.append((name, value))
+            else:
+                self.shared.append((name, value))
+
+    def instantiate(self, args, kwargs):
+        """Return a new instance, created with args and kwargs."""
+        if kwargs or self.positional is None or \
+                len(args) != len(self.positional):
+            arguments = self.signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            init_bindings = {self.params[name]: value for name, value
+                             in arguments.arguments.items()}
         else:
-            # if not bound, return the Var
-            return attr_value
+            init_bindings = dict(zip(self.positional, args))
+        m = object.__new__(self.machine_class)
+        d = m.__dict__
+        d.update(self.attributes)
+        d['init_args'] = (args, kwargs)
+        d['init_bindings'] = init_bindings
+        state = self.state_class()
+        set_value = object.__setattr__
+        set_value(state, '_vars', self.state_vars)
+        for name, value in self.shared:
+            set_value(state, name, value)
+        for name, value in self.copied:
+            set_value(state, name, value.copy())
+        for name, var, param in self.bound:
+            value = init_bindings[param]
+            if not var.accepts(value):
+                print('type error')
+                value = var
+            set_value(state, name, value)
+        d['state'] = state
+        return m
+
+
+def has_param(term):
+    """Return whether term, a trigger pattern, contains a Param."""
+    if isinstance(term, Param):
+        return True
+    elif isinstance(term, dict):
+        return any(has_param(value) for value in term.values())
+    elif isinstance(term, (list, tuple)):
+        return any(has_param(value) for value in term)
+    return False
+
+
+class RunQueue:
+    """The machines of a runtime whose transitions without trigger may have
+    become enabled, in the order in which they were queued.
+
+    Whether such a transition is enabled depends only on the location and
+    on the state variables that its condition reads (see
+    Structure.spontaneous_reads). So a machine whose guards were evaluated
+    need not be evaluated again until one of these is written, e.g. by an
+    update. The queue watches the writes to the State of each machine it
+    was given, and queues the machine when a variable that a guard at its
+    location reads is written, or when its location is set to one that has
+    transitions without trigger. Idle machines are never evaluated.
+    Changes inside a container, such as adding to a set, are not writes;
+    assign the variable to make them visible.
+
+    wake, if given, is called with each machine that is queued."""
+
+    def __init__(self, wake=None):
+        self.wake = wake
+        self.queue = collections.deque()  # may hold stale entries
+        self.queued = set()
+        self.hooks = {}  # machine -> write hook
+
+    def __len__(self):
+        return len(self.queued)
+
+    def __contains__(self, machine):
+        return machine in self.queued
+
+    def watch(self, machine):
+        """Watch the writes to the state of machine, and queue it, since its
+        guards were not evaluated yet."""
+        if machine not in self.hooks:
+            hook = self.hooks[machine] = functools.partial(self.written,
+                                                           machine)
+            add_write_hook(machine.state, hook)
+        self.push(machine)
+
+    def unwatch(self, machine):
+        hook = self.hooks.pop(machine, None)
+        if hook is not None:
+            remove_write_hook(machine.state, hook)
+        self.queued.discard(machine)
+
+    def written(self, machine, var):
+        if machine in self.queued:
+            return
+        state = machine.state
+        reads = machine.structure.spontaneous_reads(state.loc)
+        if reads is not None and (var in reads
+                                  or var is state._vars.get('loc')):
+            self.push(machine)
+
+    def push(self, machine):
+        self.queued.add(machine)
+        self.queue.append(machine)
+        if self.wake is not None:
+            self.wake(machine)
+
+    def take(self, machine):
+        """Remove machine from the queue. Return whether it was queued.
+        The entry in the deque becomes stale; when most entries are, the
+        deque is rebuilt, so that it does not grow when machines are only
+        taken, as in a Runtime."""
+        if machine in self.queued:
+            self.queued.remove(machine)
+            if len(self.queue) > 2 * len(self.queued) + 16:
+                self.compact()
+            return True
+        return False
+
+    def compact(self):
+        """Drop the stale entries from the deque."""
+        queue = collections.deque()
+        seen = set()
+        for machine in self.queue:
+            if machine in self.queued and machine not in seen:
+                seen.add(machine)
+                queue.append(machine)
+        self.queue = queue
+
+    def pop(self):
+        """Remove and return the machine that was queued first, or None if
+        the queue is empty."""
+        while self.queue:
+            machine = self.queue.popleft()
+            if machine in self.queued:
+                self.queued.remove(machine)
+                return machine
+        return None
+
+    def run(self, step):
+        """Call step(machine) for each queued machine, until the queue is
+        empty. step should evaluate the transitions without trigger of the
+        machine; executing one sets the location, which queues the machine
+        again if needed."""
+        while (machine := self.pop()) is not None:
+            step(machine)
+
+
+class TestStateMachine(unittest.TestCase):
+
+    class Task(StateMachine):
+        def __init__(m):
+            super().__init__()
+            m.locations('off', 'on', 'done')
+            m.state = State()
+            m.state.loc = Var(Location)
+            m.state.count = Var(int)
+            with Transition(m, 'start', m.off, m.on) as t:
+                t.i = Var(int)
+                t.trigger = {'command': 'Start', 'arg': t.i}
+                t.condition = t.i > 0
+                def update():
+                    m.state.count += t.i
+                t.update = update
+                t.response = [{'reply': 'Started', 'arg': t.i}]
+            with Transition(m, 'stop', m.on, m.off) as t:
+                t.trigger = {'command': 'Stop'}
+                t.condition = m.state.count < 10
+                t.update = None
+                t.response = [{'reply': 'Stopped', 'count': m.state.count}]
+            with Transition(m, 'finish', m.on, m.done) as t:
+                t.trigger = None
+                t.condition = m.state.count > 9
+                t.update = None
+                t.response = []
+            m.state.loc = m.off
+            m.state.count = 0
+
+    def test_step(self):
+        m = self.Task()
+        self.assertEqual(m.step({'command': 'Stop'}), None)
+        self.assertEqual(m.step({'command': 'Start', 'arg': 0}), None)
+        self.assertIs(m.state.loc, m.off)
+        self.assertEqual(m.step({'command': 'Start', 'arg': 3}),
+                         [{'reply': 'Started', 'arg': 3}])
+        self.assertIs(m.state.loc, m.on)
+        self.assertEqual(m.start.param_bindings, {})
+        self.assertEqual(m.step(), None)
+        self.assertEqual(m.step({'command': 'Stop', 'x': 1}),
+                         [{'reply': 'Stopped', 'count': 3}])
+        m.step({'command': 'Start', 'arg': 8})
+        self.assertEqual(m.step({'command': 'Stop'}), None)
+        self.assertEqual(m.step(), [])
+        self.assertIs(m.state.loc, m.done)
+
+    def test_index_is_incremental(self):
+        m = self.Task()
+        m.step({'command': 'Stop'})
+        self.assertEqual(len(m.structure.index[m.on].triggers), 1)
+        with Transition(m, 'abort', m.on, m.off) as t:
+            t.trigger = {'command': 'Abort'}
+        m.step({'command': 'Start', 'arg': 1})
+        self.assertEqual(m.step({'command': 'Abort'}), [])
+        self.assertEqual(len(m.structure.index[m.on].triggers), 2)
+
+    def test_state(self):
+        class Task(self.Task):
+            pass
+        m1 = Task()
+        m2 = Task()
+        self.assertIs(type(m1.state), State)
+        self.assertIn('count', type(m2.state).__slots__)
+        for m in (m1, m2):
+            count = m.state._vars['count']
+            self.assertEqual(m.state.count, 0)
+            self.assertEqual(m.state._bindings[count], 0)
+            m.state.count = 'a'  # type error, ignored
+            self.assertEqual(m.state.count, 0)
+            m.state.extra = Var(int)
+            self.assertIs(m.state.extra, m.state._vars['extra'])
+            self.assertNotIn(m.state.extra, m.state._bindings)
+
+    def test_run_queue(self):
+        m = self.Task()
+        queue = RunQueue()
+        steps = []
+
+        def step(machine):
+            steps.append(machine.state.loc.name)
+            machine.step()
+        queue.watch(m)
+        self.assertIn(m, queue)
+        queue.run(step)
+        m.step({'command': 'Start', 'arg': 4})  # to on, where finish is
+        self.assertIn(m, queue)
+        queue.run(step)  # count is 4, so finish is not enabled
+        m.step({'command': 'Start', 'arg': 1})  # no match, no writes
+        self.assertEqual(len(queue), 0)
+        m.state.count = 20  # read by the condition of finish
+        self.assertIn(m, queue)
+        queue.run(step)
+        self.assertIs(m.state.loc, m.done)
+        self.assertEqual(steps, ['off', 'on', 'on'])
+        m.state.count = 30  # no transitions without trigger from done
+        self.assertEqual(len(queue), 0)
+        queue.unwatch(m)
+        m.state.loc = m.on
+        self.assertEqual(len(queue), 0)
+        # taking, as a Runtime does, leaves no stale entries behind
+        others = [self.Task() for _ in range(100)]
+        for _ in range(10):
+            for other in others:
+                queue.push(other)
+                self.assertTrue(queue.take(other))
+        self.assertEqual(len(queue), 0)
+        self.assertLessEqual(len(queue.queue), 16)
+
+    def test_flyweight(self):
+        class Counter(StateMachine):
+            flyweight = True
+
+            def __init__(m, name, start, limit=10):
+                super().__init__()
+                m.locations('counting')
+                m.state = State()
+                m.state.loc = Var(Location)
+                m.state.count = Var(int)
+                m.state.seen = Var(list)
+                with Transition(m, 'add', m.counting, m.counting) as t:
+                    t.i = Var(int)
+                    t.trigger = {'add': t.i}
+                    t.condition = m.state.count < limit
+                    def update():
+                        m.state.count += t.i
+                        m.state.seen.append((name, t.i))
+                    t.update = update
+                    t.response = [{'name': name, 'count': m.state.count}]
+                m.state.loc = m.counting
+                m.state.count = start
+                m.state.seen = []
+
+        a = Counter('a', 1)
+        b = Counter('b', 5, limit=20)
+        self.assertIs(a.structure, b.structure)
+        self.assertIs(a.add, b.add)
+        self.assertEqual(b.init_args, (('b', 5), {'limit': 20}))
+        self.assertEqual(a.step({'add': 2}),
+                         [{'name': 'a', 'count': 3}])
+        self.assertEqual(b.step({'add': 12}),
+                         [{'name': 'b', 'count': 17}])
+        a.step({'add': 9})
+        self.assertIsNone(a.step({'add': 1}))  # 12 is not below 10
+        self.assertEqual(b.step({'add': 1}),  # 17 is below 20
+                         [{'name': 'b', 'count': 18}])
+        self.assertEqual((a.state.seen, b.state.seen),
+                         ([('a', 2), ('a', 9)], [('b', 12), ('b', 1)]))
+        self.assertIs(a.state.loc, a.counting)
+        self.assertEqual(a.add.param_bindings, {})
+
+        class Echo(StateMachine):
+            flyweight = True
+
+            def __init__(m, command):
+                super().__init__()
+                m.locations('idle')
+                m.state = State()
+                m.state.loc = Var(Location)
+                m.state.loc = m.idle
+                with Transition(m, 'echo', m.idle, m.idle) as t:
+                    t.trigger = {'command': command}
+                    t.response = [command]
+
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            echo1, echo2 = Echo('x'), Echo('y')
+        self.assertIn('cannot be a flyweight', out.getvalue())
+        self.assertIsNot(echo1.structure, echo2.structure)
+        self.assertEqual(echo2.step({'command': 'y'}), ['y'])
+
+    def test_param_bindings(self):
+        m = self.Task()
+        t = m.start
+        i = t._params['i']
+        self.assertIs(t.i, i)
+        t.param_bindings = {i: 4}
+        self.assertEqual(t.i, 4)
+        self.assertEqual(t.param_bindings, {i: 4})
+        t.param_bindings = {}
+        self.assertIs(t.i, i)
+
+
+if __name__ == '__main__':
+    unittest.main()
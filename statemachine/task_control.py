@@ -5,6 +5,8 @@ from statemachine import StateMachine, State, Location, Transition
 class TaskControl(StateMachine):
     """State machine TaskControl models the Start and Stop commands that a
     client issues to a TaskControl server."""
+    flyweight = True
+
     def __init__(m):
         super().__init__()
 
@@ -43,6 +45,8 @@ class TaskControl(StateMachine):
 class ReadyCompleted(StateMachine):
     """State machine ReadyComplete models the Ready and Complete
     notifications from a single task with a given task_id."""
+    flyweight = True
+
     def __init__(m, task_id):
         super().__init__()
 
@@ -53,6 +57,7 @@ class ReadyCompleted(StateMachine):
 
         # initialize state vector: location
         m.state = State()
+        m.state.loc = Var(Location)
         m.state.loc = m.waiting
 
         # transitions